@@ -0,0 +1,43 @@
+"""
+Compares tracing in the calling thread with the thread pool of OpticalPath for growing numbers of rays.
+
+    python benchmarks/thread_pool.py [threads] [block_size]
+"""
+import sys
+import time
+import warnings
+
+from raypy2d.elements import Aperture, Lens, Mirror, Sensor
+from raypy2d.paths import OpticalPath
+
+
+def trace(n: int, **kwargs):
+    path = OpticalPath(angle=[-20, 20], n=n, history=False, **kwargs)
+    path.append(Aperture(4., [5., 0.]))
+    for i in range(8):
+        path.append(Lens(20., 12., [10. + 5. * i, 0.]))
+    path.append(Mirror(12., [60., 0.], theta=170.))
+    path.append(Sensor(12., [20., 10.], theta=10.))
+    return path
+
+
+def best_of(repeat: int, n: int, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        trace(n, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2 ** 16
+
+    print('{:>10} {:>10} {:>10} {:>8}'.format('rays', 'serial', 'threads', 'speedup'))
+    for n in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 4 * 10 ** 6]:
+        serial = best_of(3, n)
+        threaded = best_of(3, n, threads=threads, block_size=block_size)
+        print('{:>10d} {:>9.3f}s {:>9.3f}s {:>7.2f}x'.format(n, serial, threaded, serial / threaded))
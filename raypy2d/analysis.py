@@ -2,9 +2,78 @@ import numpy as np
 from matplotlib.axes import Axes
 
 from raypy2d.paths import OpticalPath
+from raypy2d.rays import PropertyTable
 from raypy2d.utils import wavelength_to_rgb
 
 
+def sensor_statistics(path: OpticalPath, only_wavelength=False, chunk_size: int = None):
+    """
+    Calculates the distribution of the rays on the last element in the path per group and wavelength. The traced
+    rays are read chunk by chunk (see TracedRays.chunks), also for an out-of-core history.
+    Args:
+        path: (OpticalPath)
+        only_wavelength: (bool) if the rays are only grouped by wavelength
+        chunk_size: (int, optional) number of rays per chunk, see TracedRays.chunks
+
+    Returns:
+        statistics, efficiency (dict, float) arrays of the keys 'group' (not with only_wavelength), 'wavelength',
+                'mean', 'std', 'min' and 'max' of the y coordinate on the element, sorted by group and wavelength, and
+                the fraction of the rays reaching the element
+    """
+
+    # assumes the last element in the path to be the sensor element
+    s = path.elements[-1]
+    names = ['wavelength'] if only_wavelength else ['group', 'wavelength']
+
+    # (group, wavelength), count, mean, sum of squared deviations, minimum and maximum per key and chunk
+    moments = [np.empty((0, 2))] + [np.empty(0)] * 5
+    n_total = 0
+    for chunk in path.rays.traced_rays().chunks(chunk_size):
+        n_total += chunk.n
+        last = chunk.array[:, -1, :]
+        hit = ~np.isnan(last).any(axis=1)
+        y = s.points_to_object_frame_of_reference(last[hit, :2])[:, 1]
+
+        properties = np.nan_to_num(chunk.properties_array[hit])
+        if only_wavelength:
+            properties[:, 0] = 0.
+        table = PropertyTable(properties)
+        keys = table.keys
+
+        count = np.bincount(keys)
+        present = np.flatnonzero(count)
+        mean = np.bincount(keys, weights=y)[present] / count[present]
+        centers = np.zeros(count.shape[0])
+        centers[present] = mean
+        deviations = np.bincount(keys, weights=(y - centers[keys]) ** 2)[present]
+        low, high = np.full(count.shape[0], np.inf), np.full(count.shape[0], -np.inf)
+        np.minimum.at(low, keys, y)
+        np.maximum.at(high, keys, y)
+
+        n_wavelengths = table.wavelengths.shape[0]
+        rows = np.stack([table.groups[present // n_wavelengths], table.wavelengths[present % n_wavelengths]], axis=1)
+        for i, values in enumerate([rows, count[present], mean, deviations, low[present], high[present]]):
+            moments[i] = np.concatenate([moments[i], values])
+
+    # merge the moments of the chunks per key (Chan et al.)
+    rows, counts, means, deviations, lows, highs = moments
+    _, first, inverse = np.unique(PropertyTable(rows).keys, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    count = np.bincount(inverse, weights=counts, minlength=first.shape[0])
+    mean = np.bincount(inverse, weights=counts * means, minlength=first.shape[0]) / np.maximum(count, 1)
+    squares = np.bincount(inverse, weights=deviations + counts * (means - mean[inverse]) ** 2,
+                          minlength=first.shape[0])
+    low, high = np.full(first.shape[0], np.inf), np.full(first.shape[0], -np.inf)
+    np.minimum.at(low, inverse, lows)
+    np.maximum.at(high, inverse, highs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(squares / (count - 1))
+
+    statistics = dict(zip(names, rows[first, -len(names):].T))
+    statistics.update({'mean': mean, 'std': std, 'min': low, 'max': high})
+    return statistics, np.sum(count) / max(n_total, 1)
+
+
 def plot_sensor_img(path: OpticalPath, ax: Axes, only_wavelength=False, pixel=3280):
     """
     Plots a ray path and plots the ray distribution on the last element in the path
@@ -25,24 +94,10 @@ def plot_sensor_img(path: OpticalPath, ax: Axes, only_wavelength=False, pixel=32
     # assumes the last element in the path to be the sensor element
     s = path.elements[-1]
 
-    sensor_image = s.to_element_frame_of_reference(path.rays)
-
     mm_px = s.diameter / pixel
 
-    img = pd.DataFrame(
-        sensor_image.array,
-        columns=['x', 'y', 'tan_theta', 'forward', 'group', 'wavelength'])
-
-    img = img.dropna(subset=['x', 'y', 'tan_theta']).fillna(0)
-    efficiency = img.shape[0] / sensor_image.array.shape[0]
-
-    if not only_wavelength:
-        img = img.groupby(['group', 'wavelength'])
-    else:
-        img = img.groupby('wavelength')
-
-    img = img.y.agg(['mean', 'std', 'min', 'max'])
-    img = img.reset_index()
+    statistics, efficiency = sensor_statistics(path, only_wavelength)
+    img = pd.DataFrame(statistics)
 
     x = np.linspace(-s.diameter / 2., s.diameter / 2., pixel)
     y = np.exp(-0.5 * ((x[:, None] - img['mean'].values[None, :]) / img['std'].values[None, :]) ** 2)
@@ -68,4 +123,4 @@ def plot_sensor_img(path: OpticalPath, ax: Axes, only_wavelength=False, pixel=32
         ax.text(img['mean'].values[i], 1.6, "{:.1f}px".format((img['max'] - img['min']).values[i] / mm_px),
                 ha='center')
 
-    return sensor_image
+    return img
@@ -0,0 +1,325 @@
+import numpy as np
+from typing import List, Union, TYPE_CHECKING
+
+from .rays import Rays
+from .utils import assure_number_of_columns
+
+if TYPE_CHECKING:
+    from .elements import Element
+    from .optimize import Variable
+    from .paths import OpticalPath
+
+
+class Dual:
+
+    def __init__(self, value, tangent=0.):
+        """
+        Dual number for forward mode differentiation, a value with its derivatives with respect to p parameters. The
+        arithmetic follows numpy broadcasting, the derivatives are the last axis of the tangent.
+        Args:
+            value: (float, numpy.array) value
+            tangent: (float, numpy.array, optional) derivatives with shape value.shape + (p,), 0 for constants
+        """
+        self.value = value
+        self.tangent = tangent
+
+    # numpy arrays and scalars defer to the arithmetic of the dual number instead of creating object arrays
+    __array_ufunc__ = None
+
+    @staticmethod
+    def lift(other):
+        return other if isinstance(other, Dual) else Dual(other)
+
+    @staticmethod
+    def _scale(tangent, factor):
+        # derivatives multiplied with a value of the same shape as the value of the dual number
+        return tangent * np.asarray(factor)[..., None]
+
+    def __add__(self, other):
+        other = Dual.lift(other)
+        return Dual(self.value + other.value, self.tangent + other.tangent)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = Dual.lift(other)
+        return Dual(self.value - other.value, self.tangent - other.tangent)
+
+    def __rsub__(self, other):
+        return Dual.lift(other) - self
+
+    def __neg__(self):
+        return Dual(-self.value, -self.tangent)
+
+    def __mul__(self, other):
+        other = Dual.lift(other)
+        return Dual(self.value * other.value,
+                    self._scale(self.tangent, other.value) + self._scale(other.tangent, self.value))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        other = Dual.lift(other)
+        value = self.value / other.value
+        return Dual(value, self._scale(self.tangent - self._scale(other.tangent, value), 1. / other.value))
+
+    def __rtruediv__(self, other):
+        return Dual.lift(other) / self
+
+    def sqrt(self):
+        value = np.sqrt(self.value)
+        return Dual(value, self._scale(self.tangent, 0.5 / value))
+
+    def sin(self):
+        return Dual(np.sin(self.value), self._scale(self.tangent, np.cos(self.value)))
+
+    def cos(self):
+        return Dual(np.cos(self.value), self._scale(self.tangent, -np.sin(self.value)))
+
+    def where(self, mask, other):
+        """
+        Selects the entries of this dual number where the mask is true and of the other elsewhere
+        Args:
+            mask: (numpy.array) boolean mask with the shape of the value
+            other: (Dual, float) entries where the mask is false
+
+        Returns:
+            (Dual) the selection
+        """
+        other = Dual.lift(other)
+        value = np.where(mask, self.value, other.value)
+        tangent = np.where(np.asarray(mask)[..., None], self.tangent, other.tangent)
+        return Dual(value, tangent)
+
+
+# parameters of the elements that can be differentiated, see optimize.Variable
+_names = ('x', 'y', 'theta', 'f', 'grating')
+
+
+class _State:
+    # columns of the traced rays, the positions and directions as dual numbers
+
+    def __init__(self, rays: Rays, p: int):
+        zeros = np.zeros((rays.n, p))
+        self.x = Dual(rays.x.astype(float), zeros)
+        self.y = Dual(rays.y.astype(float), zeros)
+        self.tan_theta = Dual(rays.tan_theta.astype(float), zeros)
+        self.forward = rays.forward.astype(float)
+        self.alive = rays.alive.copy()
+        self.wavelength = rays.wavelength.astype(float)
+
+    def propagate(self, x: float):
+        dx = x - self.x
+        self.y = self.y + self.tan_theta * dx
+        self.x = Dual(np.full_like(self.x.value, x), np.zeros_like(self.x.tangent))
+
+        # block rays travelling in the opposite direction
+        backwards = (dx.value > 0.) ^ (self.forward > 0.)
+        self.y = self.y.where(~backwards, np.nan)
+        self.alive &= ~backwards
+
+    def rotate_directions(self, matrix):
+        # see Rays.rotate_directions, tan_theta=+-inf are rays perpendicular to the abscissa, their direction (0, +-1)
+        # is constant to first order in tan_theta
+        perpendicular = np.isinf(self.tan_theta.value)
+        with np.errstate(invalid='ignore'):
+            cos_theta = 1. / (1. + self.tan_theta * self.tan_theta).sqrt()
+            sin_theta = self.tan_theta * cos_theta
+        cos_theta = cos_theta.where(~perpendicular, 0.)
+        sin_theta = sin_theta.where(~perpendicular, np.sign(self.tan_theta.value))
+        backwards = self.forward < 0.
+        cos_theta = cos_theta.where(~backwards, -cos_theta)
+        sin_theta = sin_theta.where(~backwards, -sin_theta)
+
+        cos_theta, sin_theta = _transform(cos_theta, sin_theta, matrix)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.tan_theta = sin_theta / cos_theta
+        self.forward = (cos_theta.value > 0.) - 0.5
+
+    def block(self, radius):
+        with np.errstate(invalid='ignore'):
+            passed = np.abs(self.y.value) <= radius
+        self.alive &= passed
+        self.tan_theta = self.tan_theta.where(passed, np.nan)
+
+
+def _transform(u: Dual, v: Dual, matrix):
+    # rows (u, v) multiplied with a 2x2 matrix of dual numbers from the right, see utils.transform_columns
+    return u * matrix[0][0] + v * matrix[1][0], u * matrix[0][1] + v * matrix[1][1]
+
+
+class _Element:
+    # parameters of an element as dual numbers with the derivatives of the selected variables
+
+    def __init__(self, element: 'Element', variables: list):
+        p = len(variables)
+
+        def dual(name, value):
+            tangent = np.zeros(p)
+            for j, variable in enumerate(variables):
+                if variable.element is element and variable.name == name:
+                    tangent[j] = 1.
+            return Dual(float(value), tangent)
+
+        self.element = element
+        self.x = dual('x', element.origin[0])
+        self.y = dual('y', element.origin[1])
+        theta = dual('theta', element.theta) * (np.pi / 180.)
+        cos_theta, sin_theta = theta.cos(), theta.sin()
+        self.rotation = ((cos_theta, -sin_theta), (sin_theta, cos_theta))
+        self.inverse = ((cos_theta, sin_theta), (-sin_theta, cos_theta))
+        self.f = dual('f', element.f) if hasattr(element, 'f') else None
+        self.grating = dual('grating', element.grating) if hasattr(element, 'grating') else None
+
+    def to_element_frame_of_reference(self, state: _State):
+        state.x, state.y = _transform(state.x - self.x, state.y - self.y, self.rotation)
+        state.rotate_directions(self.rotation)
+
+    def to_global_frame_of_reference(self, state: _State):
+        x, y = _transform(state.x, state.y, self.inverse)
+        state.x, state.y = x + self.x, y + self.y
+        state.rotate_directions(self.inverse)
+
+    def intersection_with(self, state: _State):
+        # see ParabolicMirror.intersection_with
+        from .elements import ParabolicMirror
+
+        if type(self.element).intersection_with is not ParabolicMirror.intersection_with:
+            return
+
+        f, a = self.f, state.tan_theta
+        with np.errstate(invalid='ignore'):
+            ay = a * state.y
+            x = -(state.y * state.y / (((f - ay) * f).sqrt() * 2. - ay + 2. * f))
+            y = state.y - a * x
+            missed = ~(np.abs(y.value) <= self.element.diameter / 2.)
+
+        x = x.where(~missed, -(1. / (4. * f)) * (self.element.diameter / 2.) ** 2)
+        y = y.where(~missed, state.y - a * x)
+        state.x, state.y = -x, y
+
+    def transform_rays(self, state: _State, index=None):
+        from .elements import DiffractionGrating, Lens
+
+        if index is not None:
+            # refraction at the interfaces of a prism, the refractive index does not depend on the parameters
+            state.tan_theta = state.tan_theta * index
+        elif isinstance(self.element, DiffractionGrating):
+            # see DiffractionGrating.transform_rays, which applies the sine to sin(arctan(tan_theta)) a second time
+            # since the original implementation (np.sin(np.sin(np.arctan(t)))). The copy keeps this, such that the
+            # derivatives are the ones of the traced rays.
+            with np.errstate(invalid='ignore'):
+                sin_theta = (state.tan_theta / (1. + state.tan_theta * state.tan_theta).sqrt()).sin()
+                sin_theta = sin_theta - state.wavelength * self.element.interference / self.grating / 1000.
+                state.tan_theta = sin_theta / (1. - sin_theta * sin_theta).sqrt()
+            state.alive &= np.isfinite(state.tan_theta.value)
+        else:
+            matrix = self.element.matrix
+            if isinstance(self.element, Lens):
+                matrix = ((1., 0.), (-1. / self.f, float(matrix[1][1])))
+            y, tan_theta = _transform(state.y, state.tan_theta, ((matrix[0][0], matrix[1][0]),
+                                                                 (matrix[0][1], matrix[1][1])))
+            state.y, state.tan_theta = y, tan_theta
+            if self.element.mirroring:
+                state.forward = -state.forward
+
+    def block(self, state: _State):
+        from .elements import Element
+
+        if type(self.element).block is not Element.block:
+            state.block(self.element.diameter / 2.)
+
+    def trace(self, state: _State, index=None):
+        # see Element.trace
+        self.to_element_frame_of_reference(state)
+        state.propagate(0.)
+        self.intersection_with(state)
+        self.transform_rays(state, index)
+        self.block(state)
+        self.to_global_frame_of_reference(state)
+
+
+def _elements(steps: list) -> list:
+    # elements of the steps with loops unrolled
+    from .loop import Loop
+
+    elements = []
+    for step in steps:
+        if isinstance(step, Loop):
+            elements.extend(step.elements * step.n)
+        else:
+            elements.append(step)
+    return elements
+
+
+# the dual trace copies the kernels of the supported elements and of the rays, test_jacobian compares it with the
+# traced rays and finite differences for each kind of step
+def _check(element: 'Element'):
+    from .elements import Element, DiffractionGrating, DiffractionPrism, ParabolicMirror
+
+    supported = type(element).trace in (Element.trace, DiffractionPrism.trace) and \
+        type(element).transform_rays in (Element.transform_rays, DiffractionGrating.transform_rays,
+                                         DiffractionPrism.transform_rays) and \
+        type(element).intersection_with in (Element.intersection_with, ParabolicMirror.intersection_with)
+    if not supported:
+        raise ValueError('{} cannot be differentiated'.format(type(element).__name__))
+
+
+def trace_with_jacobian(source: Union[Rays, np.array], steps: Union['OpticalPath', List[Union['Element', float]]],
+                        variables: List['Variable']):
+    """
+    Traces rays through the steps of a path with forward mode derivatives, i.e. the positions and directions of the
+    rays are dual numbers carrying their derivatives with respect to parameters of the elements. One trace gives the
+    Jacobian instead of one trace per parameter for finite differences. Supported are propagations, loops, the
+    generic elements (lenses, mirrors, apertures, sensors), parabolic mirrors, diffraction gratings and prisms.
+    Rays without wavelength are replicated with the default wavelengths of the first dispersive element before
+    tracing, as this element would do.
+    Args:
+        source: (Rays, numpy.array) rays entering the path, they are not changed
+        steps: (OpticalPath, list[Element, Loop, float]) path or its steps, the path is not changed
+        variables: (list[Variable]) parameters of the elements, 'x' or 'y' of the origin, 'theta', 'f' of lenses and
+                parabolic mirrors or 'grating' of diffraction gratings (see optimize.Variable)
+
+    Returns:
+        rays, jacobian (Rays, numpy.array) the traced rays without history and the derivatives of x, y and tan_theta
+        of each ray with respect to the variables with shape (rays, 3, variables), NaN for blocked rays
+    """
+    from .elements import DiffractionPrism
+
+    for variable in variables:
+        if variable.name not in _names:
+            raise ValueError('{} cannot be differentiated'.format(variable.name))
+
+    elements = _elements(getattr(steps, 'steps', steps))
+    for element in elements:
+        if not np.isscalar(element):
+            _check(element)
+
+    array = assure_number_of_columns(source.array if isinstance(source, Rays) else source, 6)
+    rays = Rays(np.array(array), keep_history=False)
+    if isinstance(source, Rays):
+        rays.alive = source.alive
+    dispersive = [e for e in elements if hasattr(e, 'default_wavelengths')]
+    if len(dispersive) > 0:
+        rays.replicate_wavelengths(np.isnan(rays.wavelength), dispersive[0].default_wavelengths)
+
+    state = _State(rays, len(variables))
+    for element in elements:
+        if np.isscalar(element):
+            state.propagate(float(element))
+        elif isinstance(element, DiffractionPrism):
+            index = element.refractive_index(state.wavelength)
+            _Element(element, variables).trace(state, 1. / index)
+            _Element(element.second_interface, variables).trace(state, index)
+        else:
+            _Element(element, variables).trace(state)
+
+    rays.x, rays.y, rays.tan_theta = state.x.value, state.y.value, state.tan_theta.value
+    rays.forward = state.forward
+    rays.alive = state.alive
+
+    jacobian = np.stack([state.x.tangent, state.y.tangent, state.tan_theta.tangent], axis=1)
+    jacobian[~state.alive] = np.nan
+
+    return rays, jacobian
@@ -1,4 +1,4 @@
-from .base import RotateObject, Element, plot_blockers
+from .base import RotateObject, Element, MultiElement, plot_blockers
 from .aperture import Aperture
 from .mirror import Mirror
 from .lens import Lens
@@ -3,6 +3,7 @@ from matplotlib.axes import Axes
 
 from .. import plotting
 from ..rays import Rays
+from ..utils import Workspace
 from .base import Element
 
 
@@ -26,12 +27,28 @@ class Aperture(Element):
 
         Element.__init__(self, diameter, origin, theta, flipped)
 
-        self.diameter = self.aperture
+    def _get_diameter(self):
+        return self.aperture
 
-    def block(self, rays: Rays):
-        abs_y = np.abs(rays.y)
-        abs_y[np.isnan(abs_y)] = float("+Inf")
-        rays.array[abs_y > self.diameter / 2., 2] = np.nan
+    def _set_diameter(self, diameter):
+        self.aperture = diameter
+
+    diameter = property(_get_diameter, _set_diameter, doc="(float) diameter of the aperture")
+
+    def block(self, rays: Rays, workspace: Workspace = None):
+        if workspace is None:
+            workspace = Workspace()
+
+        abs_y = workspace.get('block_abs_y', rays.n, rays.dtype)
+        passed = workspace.get('block_passed', rays.n, bool)
+
+        # comparisons with NaN are false, rays already blocked stay blocked
+        np.abs(rays.y, out=abs_y)
+        np.less_equal(abs_y, self.diameter / 2., out=passed)
+        np.logical_and(rays.alive, passed, out=rays.alive)
+
+        np.logical_not(passed, out=passed)
+        np.copyto(rays.tan_theta, np.nan, where=passed)
         return rays
 
     def plot(self, ax: Axes):
@@ -3,7 +3,8 @@ from matplotlib.axes import Axes
 
 from .. import plotting
 from ..rays import propagate, Rays
-from ..utils import rotation_matrix
+from ..utils import rotation_matrix, transform_columns, Workspace
+from .. import kernels
 from typing import List
 
 plot_blockers = True
@@ -11,6 +12,9 @@ plot_blockers = True
 
 class RotateObject:
 
+    # public attributes that only change how the object is plotted, not how rays are traced
+    _plot_attributes = frozenset(['flipped', 'draw_arcs', 'blocker_diameter'])
+
     def __init__(self, origin=[0., 0.], theta=0.):
         """
         Creates an object that is rotated with respect to the original coordinate system
@@ -18,9 +22,61 @@ class RotateObject:
             origin: position of the center of the element
             theta: rotation angle in degrees of element (with respect the abscissa)
         """
-        self.origin = np.array(origin)
+        self.origin = origin
         self.theta = theta
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+
+        # every change of a public attribute or property that affects tracing, e.g. origin, theta, f or diameter,
+        # is a new revision
+        if not name.startswith('_') and name not in self._plot_attributes:
+            object.__setattr__(self, '_revision', getattr(self, '_revision', 0) + 1)
+
+    @property
+    def revision(self):
+        """
+        (int) counter of the changes of the public attributes of the object that affect tracing, the origin cannot
+        be changed in place
+        """
+        return self._revision
+
+    def _get_origin(self):
+        return self._origin
+
+    def _set_origin(self, origin):
+        # read-only, such that every change sets the origin and is a new revision
+        self._origin = np.array(origin, dtype=float)
+        self._origin.flags.writeable = False
+
+    origin = property(_get_origin, _set_origin, doc="(numpy.array) read-only position of the center of the object")
+
+    def _get_theta(self):
+        return self._theta
+
+    def _set_theta(self, theta):
+        self._theta = theta
+        self._rotation = rotation_matrix(theta)
+
+    theta = property(_get_theta, _set_theta, doc="(float) rotation angle in degrees (with respect the abscissa)")
+
+    @property
+    def rotation(self):
+        """
+        (numpy.array) 2x2 rotation matrix of the object, recomputed only if theta changes
+        """
+        return self._rotation
+
+    @property
+    def transform(self):
+        """
+        (numpy.array) homogeneous 3x3 transformation from the object to the global frame of reference
+        """
+        transform = np.eye(3)
+        transform[:2, :2] = self._rotation
+        transform[:2, 2] = self._origin
+        return transform
+
     def points_to_object_frame_of_reference(self, points):
         """
         transform the passed points to the objects frame of reference (e.g. rotated and translated)
@@ -36,10 +92,9 @@ class RotateObject:
         # translation
         points = points - self.origin[None, :]
 
-        # rotation
+        # rotation by -theta, the inverse of the rotation matrix is its transpose
         if self.theta != 0.:
-            r = rotation_matrix(-self.theta)
-            points = np.dot(r, points.T).T
+            points = np.dot(points, self._rotation)
 
         return points
 
@@ -57,59 +112,60 @@ class RotateObject:
 
         # rotation
         if self.theta != 0.:
-            r = rotation_matrix(self.theta)
-            points = np.dot(r, points.T).T
+            points = np.dot(points, self._rotation.T)
 
         # translation
         points = points + self.origin[None, :]
 
         return points
 
-    def to_element_frame_of_reference(self, rays: Rays):
+    def to_element_frame_of_reference(self, rays: Rays, workspace: Workspace = None):
         """
         transform the passed rays to the global frame of reference (e.g. rotated and translated)
         assuming they are in the object frame of reference
         Args:
             rays: (numpy.array) two dimensional array with two columns shape (n, 2) where the first
                     column is interpreted as the x coordinate and the second the y coordinate.
+            workspace: (Workspace, optional) scratch buffers
 
         Returns:
             (Rays) with the transformed coordinates
         """
 
-        # transform points
-        rays.points = self.points_to_object_frame_of_reference(rays.points)
-
-        # rotate the forward information
-        rays_theta = np.arctan(rays.tan_theta) * 180. / np.pi + (rays.forward < 0.) * 180.
-        rays_theta = rays_theta - self.theta
+        if workspace is None:
+            workspace = Workspace()
 
-        # rotate ray direction
-        tan_theta = np.tan(self.theta * np.pi / 180.)
-        rays.tan_theta = (rays.tan_theta - tan_theta) / (1. + tan_theta * rays.tan_theta)
+        # translation
+        np.subtract(rays.x, self.origin[0], out=rays.x)
+        np.subtract(rays.y, self.origin[1], out=rays.y)
 
-        m = np.floor(rays_theta / 360.)
-        rays_theta = (rays_theta - m * 360.)
+        # rotation by -theta, the inverse of the rotation matrix is its transpose
+        rotate = self.theta != 0.
+        if np.any(rotate):
+            transform_columns(rays.x, rays.y, self._rotation, workspace, where=rotate)
 
-        rays_theta[np.isnan(rays_theta)] = 90.
-        rays.forward = ((rays_theta < 90.) | (rays_theta > 270.)).astype(float) - 0.5
+        # rotate ray direction, this updates the forward information as well
+        rays.rotate_directions(self._rotation, workspace)
 
         return rays
 
-    def to_global_frame_of_reference(self, rays: Rays):
+    def to_global_frame_of_reference(self, rays: Rays, workspace: Workspace = None):
+
+        if workspace is None:
+            workspace = Workspace()
+
+        # rotation
+        rotate = self.theta != 0.
+        if np.any(rotate):
+            transform_columns(rays.x, rays.y, np.swapaxes(self._rotation, 0, 1), workspace, where=rotate)
 
         # translation
-        rays.points = self.points_to_global_frame_of_reference(rays.points)
+        np.add(rays.x, self.origin[0], out=rays.x)
+        np.add(rays.y, self.origin[1], out=rays.y)
 
-        # rotate the forward information
-        rays_theta = np.arctan(rays.tan_theta) * 180. / np.pi + (rays.forward < 0.) * 180.
-        new_theta = rays_theta + self.theta
-        new_theta[np.isnan(new_theta)] = 90.
-        rays.forward = ((new_theta < 90.) | (new_theta > 270.)).astype(float) - 0.5
+        # rotate ray direction, this updates the forward information as well
+        rays.rotate_directions(np.swapaxes(self._rotation, 0, 1), workspace)
 
-        # rotate ray direction
-        tan_theta = np.tan(self.theta * np.pi / 180.)
-        rays.tan_theta = (tan_theta + rays.tan_theta) / (1. - tan_theta * rays.tan_theta)
         return rays
 
 
@@ -143,38 +199,52 @@ class Element(RotateObject):
 
         return self.points_to_global_frame_of_reference(points)
 
-    def trace_in_element_frame_of_reference(self, rays: Rays) -> Rays:
+    def trace_in_element_frame_of_reference(self, rays: Rays, workspace: Workspace = None) -> Rays:
+        if workspace is None:
+            workspace = Workspace()
+
         # propagation in air
-        rays = propagate(rays, 0.)
+        rays = propagate(rays, 0., workspace)
 
-        rays.points = self.intersection_with(rays)
+        points = self.intersection_with(rays, workspace)
+        if not np.may_share_memory(points, rays.array):
+            rays.points = points
 
-        rays = self.transform_rays(rays)
+        rays = self.transform_rays(rays, workspace=workspace)
 
-        rays = self.block(rays)
+        rays = self.block(rays, workspace)
 
         return rays
 
-    def transform_rays(self, rays: Rays) -> Rays:
-        # ABCD transformation of element
-        rays.za = np.dot(self.matrix, rays.za.T).T
+    def transform_rays(self, rays: Rays, workspace: Workspace = None) -> Rays:
+        if workspace is None:
+            workspace = Workspace()
 
-        if self.mirroring:
-            rays.forward = -rays.forward
+        # ABCD transformation of element, (z, a) rows are multiplied with the transposed matrix
+        transform_columns(rays.y, rays.tan_theta, np.swapaxes(self.matrix, 0, 1), workspace)
+
+        if np.any(self.mirroring):
+            np.negative(rays.forward, out=rays.forward, where=self.mirroring)
 
         return rays
 
-    def trace(self, rays: Rays) -> Rays:
-        rays = self.to_element_frame_of_reference(rays)
-        rays = self.trace_in_element_frame_of_reference(rays)
-        rays = self.to_global_frame_of_reference(rays)
+    def trace(self, rays: Rays, workspace: Workspace = None) -> Rays:
+        if kernels.trace(self, rays):
+            return rays
+
+        if workspace is None:
+            workspace = Workspace()
+
+        rays = self.to_element_frame_of_reference(rays, workspace)
+        rays = self.trace_in_element_frame_of_reference(rays, workspace)
+        rays = self.to_global_frame_of_reference(rays, workspace)
 
         return rays
 
-    def block(self, rays: Rays) -> Rays:
+    def block(self, rays: Rays, workspace: Workspace = None) -> Rays:
         return rays
 
-    def intersection_with(self, rays: Rays):
+    def intersection_with(self, rays: Rays, workspace: Workspace = None):
         return rays.points
 
     def plot(self, ax: Axes):
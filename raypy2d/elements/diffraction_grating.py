@@ -3,6 +3,7 @@ from matplotlib.axes import Axes
 
 from .. import plotting
 from ..rays import Rays
+from ..utils import Workspace
 from . import plot_blockers
 from .base import Element
 from .aperture import Aperture
@@ -34,20 +35,36 @@ class DiffractionGrating(Aperture):
         self.interference = interference
         self.default_wavelengths = default_wavelengths
 
-    def transform_rays(self, rays: Rays):
+    def transform_rays(self, rays: Rays, workspace: Workspace = None):
+        if workspace is None:
+            workspace = Workspace()
 
         I_split = np.isnan(rays.wavelength)
         if np.any(I_split):
-            rays.wavelength[I_split] = self.default_wavelengths[0]
-
-            original_rays = rays.array[I_split, :].copy()
-            for w in self.default_wavelengths[1:]:
-                new_rays = Rays(original_rays)
-                new_rays.wavelength = w
-                rays.append(new_rays)
-
-        rays.tan_theta = np.tan(np.arcsin(
-            np.sin(np.sin(np.arctan(rays.tan_theta))) - self.interference * rays.wavelength / self.grating / 1000.))
+            rays.replicate_wavelengths(I_split, self.default_wavelengths)
+
+        sin_theta = workspace.get('grating_sin_theta', rays.n, rays.dtype)
+        t = workspace.get('grating_t', rays.n, rays.dtype)
+
+        # sin(arctan(t)) = t / sqrt(1 + t^2) and tan(arcsin(s)) = s / sqrt(1 - s^2)
+        np.hypot(1., rays.tan_theta, out=sin_theta)
+        np.divide(rays.tan_theta, sin_theta, out=sin_theta)
+        np.sin(sin_theta, out=sin_theta)
+
+        np.multiply(rays.wavelength, self.interference, out=t)
+        np.divide(t, self.grating, out=t)
+        np.divide(t, 1000., out=t)
+        np.subtract(sin_theta, t, out=sin_theta)
+
+        np.multiply(sin_theta, sin_theta, out=t)
+        np.subtract(1., t, out=t)
+        np.sqrt(t, out=t)
+        np.divide(sin_theta, t, out=rays.tan_theta)
+
+        # evanescent orders with |sin(theta)| > 1 do not leave the grating, they are blocked
+        propagating = workspace.get('grating_propagating', rays.n, bool)
+        np.isfinite(rays.tan_theta, out=propagating)
+        np.logical_and(rays.alive, propagating, out=rays.alive)
 
         return rays
 
@@ -5,6 +5,7 @@ from typing import List
 
 from .. import plotting
 from ..rays import Rays, propagate
+from ..utils import Workspace
 from .base import Element, MultiElement
 from .aperture import Aperture
 from .mirror import Mirror
@@ -49,43 +50,73 @@ class DiffractionPrism(Aperture, MultiElement):
 
         self.second_interface = Aperture(self.aperture, origin2, theta=theta+60.)
 
-    def refractive_index(self, wavelength: np.array):
-        w2 = (wavelength * 1e-3) ** 2
+    def refractive_index(self, wavelength: np.array, out: np.array = None, workspace: Workspace = None):
+        """
+        Calculates the refractive index of the glass with the Sellmeier equation
+        Args:
+            wavelength: (numpy.array) wavelengths in nm
+            out: (numpy.array, optional) array the refractive indices are written to
+            workspace: (Workspace, optional) scratch buffers
+
+        Returns:
+            (numpy.array) refractive indices
+        """
+
+        if workspace is None:
+            workspace = Workspace()
+
+        n = np.shape(wavelength)[0]
+        if out is None:
+            out = np.empty(n, dtype=np.result_type(wavelength, np.float32))
+        w2 = workspace.get('sellmeier_w2', n, out.dtype)
+        term = workspace.get('sellmeier_term', n, out.dtype)
+
+        np.multiply(wavelength, 1e-3, out=w2)
+        np.multiply(w2, w2, out=w2)
+
         c1 = self.constants[self.glass][0]
         c2 = self.constants[self.glass][1]
-        return np.sqrt(np.sum(c1[:, None] * w2[None, :] / (w2[None, :] - c2[:, None]), axis=0) + 1)
 
-    def transform_rays(self, rays: Rays, out: bool = False):
+        out[:] = 0.
+        for b, c in zip(c1, c2):
+            np.subtract(w2, c, out=term)
+            np.divide(w2, term, out=term)
+            np.multiply(term, b, out=term)
+            np.add(out, term, out=out)
+
+        np.add(out, 1., out=out)
+        return np.sqrt(out, out=out)
+
+    def transform_rays(self, rays: Rays, out: bool = False, workspace: Workspace = None):
+        if workspace is None:
+            workspace = Workspace()
 
         index_split = np.isnan(rays.wavelength)
         if np.any(index_split):
-            rays.wavelength[index_split] = self.default_wavelengths[0]
-
-            original_rays = rays.array[index_split, :].copy()
-            for w in self.default_wavelengths[1:]:
-                new_rays = Rays(original_rays)
-                new_rays.wavelength = w
-                rays.append(new_rays)
+            rays.replicate_wavelengths(index_split, self.default_wavelengths)
 
+        index = self.refractive_index(rays.wavelength, workspace.get('prism_index', rays.n, rays.dtype), workspace)
         if not out:
-            rays.tan_theta = 1. / self.refractive_index(rays.wavelength) * rays.tan_theta
-        else:
-            rays.tan_theta = self.refractive_index(rays.wavelength) * rays.tan_theta
+            np.divide(1., index, out=index)
+        np.multiply(index, rays.tan_theta, out=rays.tan_theta)
 
         return rays
 
-    def trace(self, rays: Rays) -> Rays:
-        rays = self.to_element_frame_of_reference(rays)
-        rays = self.trace_in_element_frame_of_reference(rays)
-        rays = self.to_global_frame_of_reference(rays)
+    def trace(self, rays: Rays, workspace: Workspace = None) -> Rays:
+        if workspace is None:
+            workspace = Workspace()
+
+        rays = self.to_element_frame_of_reference(rays, workspace)
+        rays = self.trace_in_element_frame_of_reference(rays, workspace)
+        rays = self.to_global_frame_of_reference(rays, workspace)
 
         rays.store()
 
-        rays = self.second_interface.to_element_frame_of_reference(rays)
-        rays = propagate(rays, 0.)
-        rays = self.transform_rays(rays, out=True)
-        rays = self.second_interface.block(rays)
-        rays = self.second_interface.to_global_frame_of_reference(rays)
+        rays = self.second_interface.to_element_frame_of_reference(rays, workspace)
+        rays = propagate(rays, 0., workspace)
+        rays = self.transform_rays(rays, out=True, workspace=workspace)
+        rays = self.second_interface.block(rays, workspace)
+        rays = self.second_interface.to_global_frame_of_reference(rays, workspace)
 
         return rays
 
@@ -27,11 +27,26 @@ class Lens(Aperture):
 
         self.f = focal_length
 
-        self.matrix = np.array([[1., 0],
-                                [-1. / self.f, 1.]])
-
         self.draw_arcs = False
 
+    def _get_f(self):
+        return self._f
+
+    def _set_f(self, focal_length):
+        self._f = focal_length
+        self.matrix = self.lens_matrix()
+
+    f = property(_get_f, _set_f, doc="(float) focal length, setting it updates the ABCD matrix of the lens")
+
+    def lens_matrix(self):
+        """
+        Returns the ABCD matrix of the lens for the current focal length
+        Returns:
+            (numpy.array) 2x2 matrix
+        """
+        return np.array([[1., 0],
+                         [-1. / self.f, 1.]])
+
     def plot(self, ax: Axes):
         """
         Plots the lens into the passed matplotlib axes
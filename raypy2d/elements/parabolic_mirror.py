@@ -3,6 +3,7 @@ from matplotlib.axes import Axes
 
 from .. import plotting
 from ..rays import Rays
+from ..utils import Workspace
 from . import plot_blockers
 from .base import Element
 from .lens import Lens
@@ -24,9 +25,18 @@ class ParabolicMirror(Lens):
 
         Lens.__init__(self, focal_length, diameter, origin, theta, blocker_diameter, flipped)
         self.mirroring = True
-        self.matrix[1, 1] *= -1.0
 
-        self.x_blocker = 1. / (4 * self.f) * (self.diameter / 2.) ** 2
+    def lens_matrix(self):
+        matrix = Lens.lens_matrix(self)
+        matrix[1, 1] *= -1.0
+        return matrix
+
+    @property
+    def x_blocker(self):
+        """
+        (float) x-coordinate of the edge of the mirror, derived from the focal length and the diameter
+        """
+        return 1. / (4 * self.f) * (self.diameter / 2.) ** 2
 
     def edges(self):
         points = np.array([[self.x_blocker, self.diameter / 2.],
@@ -37,26 +47,45 @@ class ParabolicMirror(Lens):
 
         return self.points_to_global_frame_of_reference(points)
 
-    def intersection_with(self, rays: Rays):
-        a = rays.tan_theta
-        y = rays.y.copy()
-        ay = a * y
-        x = (2 * np.sqrt(self.f * (self.f - ay)) + ay - 2 * self.f) / a ** 2
-
-        zero_elements = (a == 0)
-        if zero_elements.any():
-            x[zero_elements] = y[zero_elements] * y[zero_elements] / (4. * self.f)
-
-        y = rays.y - a * x
+    def intersection_with(self, rays: Rays, workspace: Workspace = None):
+        if workspace is None:
+            workspace = Workspace()
 
-        abs_y = np.abs(y)
-        abs_y[np.isnan(abs_y)] = float("+Inf")
-        I = (abs_y > self.diameter / 2.)
-        x[I] = -self.x_blocker
-        y[I] = rays.y[I] - a[I] * x[I]
-
-        rays.x = -x
-        rays.y = y
+        n = rays.n
+        a = rays.tan_theta
+        x = workspace.get('parabolic_x', n, rays.dtype)
+        y = workspace.get('parabolic_y', n, rays.dtype)
+        ay = workspace.get('parabolic_ay', n, rays.dtype)
+        mask = workspace.get('parabolic_mask', n, bool)
+
+        # x = (2 * sqrt(f * (f - ay)) + ay - 2 * f) / a ** 2, expanded with the conjugate to
+        # x = -y ** 2 / (2 * sqrt(f * (f - ay)) + 2 * f - ay) to avoid the cancellation for small angles
+        np.multiply(a, rays.y, out=ay)
+        np.subtract(self.f, ay, out=x)
+        np.multiply(x, self.f, out=x)
+        np.sqrt(x, out=x)
+        np.multiply(x, 2, out=x)
+        np.subtract(x, ay, out=x)
+        np.add(x, 2 * self.f, out=x)
+        np.multiply(rays.y, rays.y, out=y)
+        np.divide(y, x, out=x)
+        np.negative(x, out=x)
+
+        # y = rays.y - a * x
+        np.multiply(a, x, out=y)
+        np.subtract(rays.y, y, out=y)
+
+        # rays missing the mirror are intersected with the plane of its edge
+        np.abs(y, out=ay)
+        np.less_equal(ay, self.diameter / 2., out=mask)
+        np.logical_not(mask, out=mask)
+        np.copyto(x, -self.x_blocker, where=mask)
+        np.multiply(a, x, out=ay)
+        np.subtract(rays.y, ay, out=ay)
+        np.copyto(y, ay, where=mask)
+
+        np.negative(x, out=rays.x)
+        np.copyto(rays.y, y)
 
         return rays.points
 
@@ -0,0 +1,151 @@
+import os
+import numpy as np
+
+
+class MemmapHistory:
+
+    def __init__(self, directory: str, dtype=np.float64, chunk_size: int = 2 ** 20):
+        """
+        Out-of-core history of rays for traces that do not fit into memory. Each stored state is kept in its own
+        memory-mapped file with shape (rays, 3) in the passed directory, such that a state is written contiguously
+        while it is traced and the history is never copied when rays or states are added.
+        Args:
+            directory: (str) directory of the state files, created if it does not exist
+            dtype: (numpy.dtype, optional) floating point type of the stored states, should match the traced rays
+            chunk_size: (int, optional) number of rays that are read or filled at once
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+
+        self._states = []
+        self._capacity = 0
+
+    @property
+    def n_states(self):
+        return len(self._states)
+
+    def _path(self, state: int):
+        return os.path.join(self.directory, 'state_{:05d}.dat'.format(state))
+
+    def _fill(self, state: np.memmap, start: int, stop: int):
+        for i in range(start, stop, self.chunk_size):
+            state[i:min(i + self.chunk_size, stop)] = np.nan
+
+    def _open(self, state: int, mode: str):
+        # numpy extends the file if the requested shape is larger
+        return np.memmap(self._path(state), dtype=self.dtype, mode=mode, shape=(self._capacity, 3))
+
+    def reserve(self, rows: int, states: int):
+        """
+        Makes sure the history can hold the passed number of rays and states. The rays grow by doubling, new
+        entries are filled with NaN.
+        Args:
+            rows: (int) number of rays
+            states: (int) number of states
+        """
+        if rows > self._capacity:
+            capacity = self._capacity
+            self._capacity = max(rows, 2 * capacity)
+            for i, state in enumerate(self._states):
+                state.flush()
+                self._states[i] = self._open(i, 'r+')
+                self._fill(self._states[i], capacity, self._capacity)
+
+        for i in range(self.n_states, states):
+            self._states.append(self._open(i, 'w+'))
+            self._fill(self._states[i], 0, self._capacity)
+
+    def write(self, state: int, rows: int, values: np.array, ids: np.array = None):
+        """
+        Writes a state of the rays, the rays not contained in values are NaN in this state
+        Args:
+            state: (int) index of the state
+            rows: (int) number of rays in the history
+            values: (numpy.array) positions and angles with shape (n, 3)
+            ids: (numpy.array, optional) index of each passed ray in the history, by default the first n rays
+        """
+        self.reserve(rows, state + 1)
+
+        out = self._states[state]
+        if ids is None:
+            n = values.shape[0]
+            for i in range(0, n, self.chunk_size):
+                out[i:i + self.chunk_size] = values[i:i + self.chunk_size]
+            self._fill(out, n, rows)
+        else:
+            self._fill(out, 0, rows)
+            out[ids] = values
+
+    def state(self, state: int, rows: int):
+        """
+        Returns a state of the rays
+        Args:
+            state: (int) index of the state
+            rows: (int) number of rays in the history
+        Returns:
+            (numpy.memmap) with shape (rows, 3)
+        """
+        return self._states[state][:rows]
+
+    def array(self, rows: int, states: int):
+        """
+        Returns the history as an array-like object that reads the states from disk when it is indexed
+        Args:
+            rows: (int) number of rays in the history
+            states: (int) number of states
+        Returns:
+            (HistoryArray) with shape (rows, states, 3)
+        """
+        return HistoryArray(self, rows, states)
+
+    def flush(self):
+        for state in self._states:
+            state.flush()
+
+
+class HistoryArray:
+
+    def __init__(self, history: MemmapHistory, rows: int, states: int):
+        """
+        Read-only view to an out-of-core history with shape (rows, states, 3). Indexing reads only the selected
+        rays and states into memory, converting it to a numpy array reads the complete history.
+        Args:
+            history: (MemmapHistory) history the states are read from
+            rows: (int) number of rays
+            states: (int) number of states
+        """
+        self.history = history
+        self.shape = (rows, states, 3)
+        self.dtype = history.dtype
+        self.ndim = 3
+
+    @property
+    def chunk_size(self):
+        return self.history.chunk_size
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        ix, iy, iz = item + (slice(None),) * (3 - len(item))
+
+        states = np.arange(self.shape[1])[iy]
+        if np.ndim(states) == 0:
+            return np.array(self.history.state(states, self.shape[0])[ix, iz])
+
+        if states.size == 0:
+            return np.empty((self.shape[0], 0, 3), dtype=self.dtype)[ix, :, iz]
+
+        selected = [self.history.state(state, self.shape[0])[ix, iz] for state in states]
+        return np.stack(selected, axis=int(isinstance(ix, slice) or np.ndim(ix) > 0))
+
+    def __array__(self, dtype=None):
+        array = self[:, :, :]
+        return array if dtype is None else array.astype(dtype)
+
+    def copy(self):
+        return self[:, :, :]
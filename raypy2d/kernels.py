@@ -0,0 +1,234 @@
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# trace elements and propagations with the fused kernels if numba is installed, set to True to enable them
+use_numba = False
+
+
+def available() -> bool:
+    """
+    Returns if the fused kernels can be used, i.e. numba is installed
+    Returns:
+        (bool) True if numba is installed
+    """
+    return numba is not None
+
+
+def _jit(function):
+    if numba is None:
+        return function
+    # numpy error model: divisions by zero result in inf and NaN as in numpy instead of raising. The kernels are not
+    # cached on disk, the package directory might be read-only.
+    return numba.njit(nogil=True, error_model='numpy')(function)
+
+
+@_jit
+def _transform(u, v, m00, m01, m10, m11):
+    # same order of operations as utils.transform_columns
+    return u * m00 + v * m10, u * m01 + v * m11
+
+
+@_jit
+def _rotate_direction(tan_theta, forward, m00, m01, m10, m11):
+    # same order of operations as Rays.rotate_directions
+    cos_theta = 1. / math.hypot(1., tan_theta)
+    sin_theta = tan_theta * cos_theta
+    if math.isinf(tan_theta):
+        sin_theta = 1. if tan_theta > 0. else -1.
+    if forward < 0.:
+        cos_theta = -cos_theta
+        sin_theta = -sin_theta
+
+    cos_theta, sin_theta = _transform(cos_theta, sin_theta, m00, m01, m10, m11)
+
+    return sin_theta / cos_theta, (1. if cos_theta > 0. else 0.) - 0.5
+
+
+@_jit
+def _propagate_ray(x, y, tan_theta, forward, alive, x_plane):
+    dx = x_plane - x
+    y = y + tan_theta * dx
+
+    # block rays travelling in the opposite direction
+    if (dx > 0.) != (forward > 0.):
+        y = np.nan
+        alive = False
+
+    return x_plane, y, alive
+
+
+@_jit
+def _trace_ray(x, y, tan_theta, forward, alive, ox, oy, r00, r01, r10, r11, rotate, m00, m01, m10, m11, mirroring,
+               blocking, radius, parabolic, f, x_blocker):
+    # to the element frame of reference
+    x = x - ox
+    y = y - oy
+    if rotate:
+        x, y = _transform(x, y, r00, r01, r10, r11)
+    tan_theta, forward = _rotate_direction(tan_theta, forward, r00, r01, r10, r11)
+
+    # propagation in air up to the element
+    x, y, alive = _propagate_ray(x, y, tan_theta, forward, alive, 0.)
+
+    # intersection with the parabolic surface, see ParabolicMirror.intersection_with
+    if parabolic:
+        ay = tan_theta * y
+        px = math.sqrt((f - ay) * f) * 2.
+        px = -(y * y / (px - ay + 2. * f))
+        py = y - tan_theta * px
+        if not abs(py) <= radius:
+            px = -x_blocker
+            py = y - tan_theta * px
+        x, y = -px, py
+
+    # ABCD transformation of the element, the (y, tan_theta) rows are multiplied with the transposed matrix
+    y, tan_theta = _transform(y, tan_theta, m00, m10, m01, m11)
+    if mirroring:
+        forward = -forward
+
+    # aperture
+    if blocking and not abs(y) <= radius:
+        alive = False
+        tan_theta = np.nan
+
+    # back to the global frame of reference
+    if rotate:
+        x, y = _transform(x, y, r00, r10, r01, r11)
+    x = x + ox
+    y = y + oy
+    tan_theta, forward = _rotate_direction(tan_theta, forward, r00, r10, r01, r11)
+
+    return x, y, tan_theta, forward, alive
+
+
+@_jit
+def _propagate(array, alive, x_plane):
+    for i in range(array.shape[0]):
+        array[i, 0], array[i, 1], alive[i] = _propagate_ray(array[i, 0], array[i, 1], array[i, 2], array[i, 3],
+                                                            alive[i], x_plane)
+
+
+@_jit
+def _trace_element(array, alive, origin, rotation, rotate, matrix, mirroring, blocking, radius, parabolic, f,
+                   x_blocker):
+    ox, oy = origin[0], origin[1]
+    r00, r01, r10, r11 = rotation[0, 0], rotation[0, 1], rotation[1, 0], rotation[1, 1]
+    m00, m01, m10, m11 = matrix[0, 0], matrix[0, 1], matrix[1, 0], matrix[1, 1]
+
+    for i in range(array.shape[0]):
+        array[i, 0], array[i, 1], array[i, 2], array[i, 3], alive[i] = _trace_ray(
+            array[i, 0], array[i, 1], array[i, 2], array[i, 3], alive[i], ox, oy, r00, r01, r10, r11, rotate,
+            m00, m01, m10, m11, mirroring, blocking, radius, parabolic, f, x_blocker)
+
+
+@_jit
+def _trace_steps(array, alive, states, propagation, x_plane, origin, rotation, rotate, matrix, mirroring, blocking,
+                 radius, parabolic, f, x_blocker):
+    # one loop over the rays per step, the parameters of a step are constant within its loop
+    for j in range(propagation.shape[0]):
+        if propagation[j]:
+            _propagate(array, alive, x_plane[j])
+        else:
+            _trace_element(array, alive, origin[j], rotation[j], rotate[j], matrix[j], mirroring[j], blocking[j],
+                           radius[j], parabolic[j], f[j], x_blocker[j])
+
+        if states.shape[1] > 0:
+            for i in range(array.shape[0]):
+                states[i, j, 0], states[i, j, 1], states[i, j, 2] = array[i, 0], array[i, 1], array[i, 2]
+
+
+def _enabled(rays) -> bool:
+    return use_numba and numba is not None and rays.dtype == np.float64 and rays.array.flags.c_contiguous
+
+
+def propagate(rays, x: float) -> bool:
+    """
+    Propagates the rays with the fused kernel, see rays.propagate
+    Args:
+        rays: (Rays) rays to propagate
+        x: (float, numpy.array) x-coordinate of the plane up to which the rays should propagate, or one per ray
+
+    Returns:
+        (bool) False if the fused kernel is not used and the rays are unchanged
+    """
+    if not _enabled(rays) or np.ndim(x) > 0:
+        return False
+
+    _propagate(rays.array, rays.alive, float(x))
+    return True
+
+
+def element_parameters(element):
+    """
+    Returns the parameters of the fused kernel for an element. Elements with their own trace, transformation or
+    blocking (e.g. dispersive elements) are not supported.
+    Args:
+        element: (Element, Loop) element to trace
+
+    Returns:
+        (tuple, None) origin, rotation, rotate, matrix, mirroring, blocking, radius, parabolic, f, x_blocker or None
+                if the element is not supported
+    """
+    from .elements import Element, Aperture, ParabolicMirror
+
+    # other steps, e.g. loops, are traced by themselves
+    if not isinstance(element, Element):
+        return None
+
+    cls = type(element)
+    if cls.trace is not Element.trace or cls.transform_rays is not Element.transform_rays:
+        return None
+
+    # elements with one set of parameters per ray, see sweep.Sweep
+    if np.ndim(element.theta) > 0 or np.ndim(element.origin) > 1 or np.ndim(element.matrix) > 2 or \
+            np.ndim(element.mirroring) > 0:
+        return None
+
+    if cls.block is Aperture.block:
+        if np.ndim(element.diameter) > 0:
+            return None
+        blocking, radius = True, element.diameter / 2.
+    elif cls.block is Element.block:
+        blocking, radius = False, np.inf
+    else:
+        return None
+    if cls.intersection_with is ParabolicMirror.intersection_with:
+        if np.ndim(element.f) > 0 or np.ndim(element.x_blocker) > 0 or np.ndim(element.diameter) > 0:
+            return None
+        parabolic, f, x_blocker = True, float(element.f), float(element.x_blocker)
+        radius = element.diameter / 2.
+    elif cls.intersection_with is Element.intersection_with:
+        parabolic, f, x_blocker = False, 0., 0.
+    else:
+        return None
+
+    return (np.array(element.origin, dtype=np.float64), element.rotation.astype(np.float64), element.theta != 0.,
+            np.array(element.matrix, dtype=np.float64), bool(element.mirroring), blocking, float(radius), parabolic,
+            f, x_blocker)
+
+
+def trace(element, rays) -> bool:
+    """
+    Traces the rays through the element with one fused loop over the rays, see Element.trace and
+    element_parameters
+    Args:
+        element: (Element) element to trace
+        rays: (Rays) rays to trace
+
+    Returns:
+        (bool) False if the fused kernel is not used and the rays are unchanged
+    """
+    if not _enabled(rays):
+        return False
+
+    parameters = element_parameters(element)
+    if parameters is None:
+        return False
+
+    _trace_element(rays.array, rays.alive, *parameters)
+    return True
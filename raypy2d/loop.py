@@ -0,0 +1,178 @@
+import numpy as np
+from typing import List, TYPE_CHECKING
+
+from .paraxial import ParaxialSystem, paraxial_runs
+from .rays import Rays
+from .utils import Workspace
+
+if TYPE_CHECKING:
+    from .elements import Element
+
+
+class Loop:
+
+    def __init__(self, elements: List['Element'], n: int):
+        """
+        Sequence of elements the rays pass n times, e.g. the round trip of a folded cavity or a multi-pass cell, see
+        OpticalPath.repeat. The passes are traced without storing any state in the history. If the round trip from
+        the last element back to it is paraxial (see paraxial.paraxial_runs) and stable, the rays that cannot hit an
+        aperture in any pass skip the passes after the first with one power of the round trip matrix, the other
+        rays are traced exactly.
+        Args:
+            elements: (list[Element]) elements of one pass in the order they are traced
+            n: (int) number of passes
+        """
+        assert n >= 1
+        self.elements = list(elements)
+        self.n = n
+
+        # round trip and the revisions of the elements it was composed with
+        self._round_trip = None
+        self._round_trip_revisions = None
+
+    @property
+    def round_trip(self):
+        """
+        (ParaxialSystem, None) composed system from after the last element to after the last element of the next
+        pass, None if the loop is not paraxial. It is composed again if an element changed since, see
+        RotateObject.revision.
+        """
+        revisions = tuple(element.revision for element in self.elements)
+        if revisions != self._round_trip_revisions:
+            self._round_trip = self._compose_round_trip()
+            self._round_trip_revisions = revisions
+        return self._round_trip
+
+    def _compose_round_trip(self):
+        # (y - axis, tan_theta) from after the last element to after the last element of the next pass
+        steps = self.elements[-1:] + self.elements
+        if len(self.elements) > 1 and paraxial_runs(steps) == [(0, len(steps))]:
+            round_trip = ParaxialSystem(steps)
+            if round_trip.directions[0] == round_trip.directions[-1]:
+                return round_trip
+        return None
+
+    @property
+    def round_trip_matrix(self):
+        """
+        (numpy.array, None) ABCD matrix of one round trip on (y - axis, slope), None if the loop is not paraxial
+        """
+        if self.round_trip is None:
+            return None
+        unfold = np.diag([1., self.round_trip.directions[-1]])
+        return unfold @ self.round_trip.transfers[-1] @ unfold
+
+    @property
+    def round_trip_length(self):
+        """
+        (float) distance along the axis travelled in one round trip, NaN if the loop is not paraxial
+        """
+        return np.nan if self.round_trip is None else float(np.abs(np.diff(self.round_trip.planes)).sum())
+
+    @property
+    def stability(self):
+        """
+        (float) half the trace of the round trip matrix (A + D) / 2, the loop is stable if it is between -1 and 1
+        """
+        matrix = self.round_trip_matrix
+        return np.nan if matrix is None else (matrix[0, 0] + matrix[1, 1]) / 2.
+
+    @property
+    def stable(self):
+        """
+        (bool) if paraxial rays stay bounded for any number of passes
+        """
+        matrix = self.round_trip_matrix
+        return matrix is not None and abs(self.stability) < 1. and np.isclose(np.linalg.det(matrix), 1.)
+
+    @property
+    def round_trip_phase(self):
+        """
+        (float) phase advance of paraxial rays per round trip in radians, NaN if the loop is not stable
+        """
+        return float(np.arccos(self.stability)) if self.stable else np.nan
+
+    @property
+    def eigenvalues(self):
+        """
+        (numpy.array, None) eigenvalues of the round trip matrix, a complex conjugate pair on the unit circle for
+        stable loops
+        """
+        matrix = self.round_trip_matrix
+        return None if matrix is None else np.linalg.eigvals(matrix)
+
+    def _trace_pass(self, rays: Rays, workspace: Workspace) -> Rays:
+        for element in self.elements:
+            rays = element.trace(rays, workspace)
+        return rays
+
+    def _bounded(self, rays: Rays) -> np.array:
+        # the rays move on the ellipse of their Courant-Snyder invariant, the maximum of y on this ellipse at each
+        # plane bounds y over all passes
+        (a, b), (c, d) = self.round_trip.transfers[-1]
+        sin_mu = np.sign(b) * np.sqrt(1. - ((a + d) / 2.) ** 2)
+        beta, alpha, gamma = b / sin_mu, (a - d) / (2. * sin_mu), -c / sin_mu
+
+        y = rays.y - self.round_trip.axis
+        tan_theta = rays.tan_theta
+        invariant = gamma * y * y + 2. * alpha * y * tan_theta + beta * tan_theta * tan_theta
+
+        bounded = rays.alive & ((rays.forward > 0.) == (self.round_trip.directions[0] > 0.))
+        for transfer, radius in zip(self.round_trip.transfers[1:], self.round_trip.radii[1:]):
+            if np.isfinite(radius):
+                l0, l1 = transfer[0]
+                amplitude = invariant * (beta * l0 * l0 - 2. * alpha * l0 * l1 + gamma * l1 * l1)
+                bounded &= amplitude <= (radius * (1. - 1e-9)) ** 2
+        return bounded
+
+    def trace(self, rays: Rays, workspace: Workspace = None) -> Rays:
+        """
+        Traces the rays n times through the elements, without storing the passes in the history
+        Args:
+            rays: (Rays) rays to trace
+            workspace: (Workspace, optional) scratch buffers of the elements
+
+        Returns:
+            (Rays) the rays after the last pass
+        """
+        if workspace is None:
+            workspace = Workspace()
+
+        keep_history = rays.keep_history
+        rays.keep_history = False
+        try:
+            rays = self._trace_pass(rays, workspace)
+            if self.n > 1 and self.stable:
+                rays = self._trace_stable(rays, workspace)
+            else:
+                for _ in range(self.n - 1):
+                    rays = self._trace_pass(rays, workspace)
+        finally:
+            rays.keep_history = keep_history
+
+        return rays
+
+    def _trace_stable(self, rays: Rays, workspace: Workspace) -> Rays:
+        bounded = self._bounded(rays)
+
+        # rays that might hit an aperture, e.g. rays travelling in the wrong direction, are traced exactly
+        exact = rays.alive & ~bounded
+        if exact.any():
+            other = Rays(rays.array[exact], keep_history=False)
+            for _ in range(self.n - 1):
+                other = self._trace_pass(other, workspace)
+            rays.array[exact] = other.array
+            rays.alive[exact] = other.alive
+
+        (a, b), (c, d) = np.linalg.matrix_power(self.round_trip.transfers[-1], self.n - 1)
+        y = rays.y[bounded] - self.round_trip.axis
+        tan_theta = rays.tan_theta[bounded]
+        rays.y[bounded] = a * y + b * tan_theta + self.round_trip.axis
+        rays.tan_theta[bounded] = c * y + d * tan_theta
+
+        blocked = ~rays.alive
+        rays.x[blocked] = self.round_trip.planes[-1]
+        rays.y[blocked] = np.nan
+        rays.tan_theta[blocked] = np.nan
+
+        return rays
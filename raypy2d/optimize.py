@@ -0,0 +1,273 @@
+import time
+import numpy as np
+from typing import Callable, List, Tuple, Union, TYPE_CHECKING
+
+from .rays import Rays
+
+if TYPE_CHECKING:
+    from .elements import Element
+    from .paths import OpticalPath
+
+
+class Variable:
+
+    def __init__(self, element: 'Element', name: str, bounds: Tuple[float, float] = (-np.inf, np.inf),
+                 step: float = None):
+        """
+        Free parameter of an element of an optical path
+        Args:
+            element: (Element) element of the path
+            name: (str) 'x' or 'y' for the coordinates of the origin, otherwise the name of a float attribute, e.g.
+                    'theta' or 'f'
+            bounds: (tuple[float], optional) lower and upper bound of the value
+            step: (float, optional) initial step of the solver, by default 5% of the value or 1 if the value is zero
+        """
+        self.element = element
+        self.name = name
+        self.bounds = bounds
+        if step is None:
+            step = 0.05 * abs(self.value) if self.value != 0. else 1.
+        self.step = step
+
+    def _get_value(self):
+        if self.name in ('x', 'y'):
+            return float(self.element.origin['xy'.index(self.name)])
+        return float(getattr(self.element, self.name))
+
+    def _set_value(self, value):
+        # the attribute is set (not changed in place), such that the path sees the new revision of the element
+        if self.name in ('x', 'y'):
+            origin = self.element.origin.copy()
+            origin['xy'.index(self.name)] = value
+            self.element.origin = origin
+        else:
+            setattr(self.element, self.name, value)
+
+    value = property(_get_value, _set_value, doc="(float) current value of the parameter")
+
+    def clip(self, value: float) -> float:
+        return float(np.clip(value, *self.bounds))
+
+
+def _sensor_y(path: 'OpticalPath', sensor: 'Element', rays: Rays = None):
+    # positions of the not blocked rays in the frame of reference of the sensor, by default the last element
+    sensor = path.elements[-1] if sensor is None else sensor
+    rays = path.rays if rays is None else rays
+    alive = rays.alive & ~np.isnan(rays.y)
+    y = sensor.points_to_object_frame_of_reference(rays.points[alive])[:, 1]
+    wavelength = rays.wavelength[alive]
+    return y, np.where(np.isnan(wavelength), 0., wavelength)
+
+
+def rms_spot_size(sensor: 'Element' = None) -> Callable:
+    """
+    Merit function of the RMS spot size on a sensor, the mean over the wavelengths of the RMS of the positions of
+    each wavelength around its centroid. The rays are evaluated after the last step of the path.
+    Args:
+        sensor: (Element, optional) sensor defining the frame of reference, by default the last element of the path
+
+    Returns:
+        (callable) function of the path
+    """
+    def merit(path: 'OpticalPath') -> float:
+        y, wavelength = _sensor_y(path, sensor)
+        if y.size == 0:
+            return np.inf
+        return float(np.mean([np.std(y[wavelength == w]) for w in np.unique(wavelength)]))
+
+    return merit
+
+
+def dispersion_length(sensor: 'Element' = None) -> Callable:
+    """
+    Merit function of the length of the spectrum on a sensor, the distance between the outermost centroids of the
+    wavelengths as a fraction of the diameter of the sensor (see analysis.plot_sensor_img). Use a negative weight to
+    maximize it.
+    Args:
+        sensor: (Element, optional) sensor defining the frame of reference, by default the last element of the path
+
+    Returns:
+        (callable) function of the path
+    """
+    def merit(path: 'OpticalPath') -> float:
+        s = path.elements[-1] if sensor is None else sensor
+        y, wavelength = _sensor_y(path, s)
+        if y.size == 0:
+            return 0.
+        centroids = [np.mean(y[wavelength == w]) for w in np.unique(wavelength)]
+        return float((max(centroids) - min(centroids)) / s.diameter)
+
+    return merit
+
+
+def throughput() -> Callable:
+    """
+    Merit function of the fraction of the rays that are not blocked. Use a negative weight to maximize it.
+    Returns:
+        (callable) function of the path
+    """
+    def merit(path: 'OpticalPath') -> float:
+        return float(np.count_nonzero(path.rays.alive) / path.rays.n_total)
+
+    return merit
+
+
+class OptimizationResult:
+
+    def __init__(self, values: np.array, merit: float, evaluations: int, traced_steps: int, iterations: List[dict],
+                 converged: bool):
+        """
+        Result of an optimization, the variables of the path are set to the best values
+        Args:
+            values: (numpy.array) best values of the variables
+            merit: (float) merit at the best values
+            evaluations: (int) number of evaluations of the merit function, cached evaluations are not counted
+            traced_steps: (int) number of steps traced again by all evaluations
+            iterations: (list[dict]) per iteration the best merit, the evaluations and the wall time in seconds
+            converged: (bool) if the tolerances were met before the maximal number of iterations or evaluations
+        """
+        self.values = values
+        self.merit = merit
+        self.evaluations = evaluations
+        self.traced_steps = traced_steps
+        self.iterations = iterations
+        self.converged = converged
+
+
+class Optimizer:
+
+    def __init__(self, path: 'OpticalPath', variables: List[Variable],
+                 merit: Union[Callable, List[Tuple[Callable, float]]]):
+        """
+        Optimizes free parameters of the elements of a traced path, e.g. the distance and the tilt of a sensor. Each
+        evaluation only traces the path again from the first changed element on (see OpticalPath.retrace) and
+        evaluations of the same values are cached.
+        Args:
+            path: (OpticalPath) incremental path, i.e. created with incremental=True
+            variables: (list[Variable]) free parameters of the elements of the path
+            merit: (callable, list[tuple]) function of the path to minimize (see rms_spot_size, dispersion_length and
+                    throughput) or a list of functions and their weights, which are summed
+        """
+        assert path.incremental, 'the path has to be incremental'
+        self.path = path
+        self.variables = list(variables)
+        self.merit = merit if callable(merit) else \
+            lambda p: sum(weight * function(p) for function, weight in merit)
+
+        self.evaluations = 0
+        self.traced_steps = 0
+        self._cache = {}
+
+    def _apply(self, values):
+        # only changed variables are set, the path is traced again from the first changed element
+        for variable, value in zip(self.variables, values):
+            if variable.value != value:
+                variable.value = value
+        self.traced_steps += self.path.retrace()
+
+    def evaluate(self, values) -> float:
+        """
+        Sets the variables, traces the path again from the first changed element and evaluates the merit function.
+        The merits are cached per values until the next call of minimize, changes of the path other than by the
+        variables in between are not seen.
+        Args:
+            values: (iterable[float]) values of the variables, clipped to their bounds
+
+        Returns:
+            (float) merit, infinite if it is not a number, e.g. if all rays are blocked
+        """
+        values = tuple(v.clip(value) for v, value in zip(self.variables, values))
+        if values in self._cache:
+            return self._cache[values]
+
+        self._apply(values)
+        merit = float(self.merit(self.path))
+        if np.isnan(merit):
+            merit = np.inf
+
+        self.evaluations += 1
+        self._cache[values] = merit
+        return merit
+
+    def minimize(self, max_iterations: int = 200, max_evaluations: int = 1000, xtol: float = 1e-6,
+                 ftol: float = 1e-9) -> OptimizationResult:
+        """
+        Minimizes the merit function with the Nelder-Mead simplex method starting at the current values
+        Args:
+            max_iterations: (int, optional) maximal number of iterations
+            max_evaluations: (int, optional) maximal number of evaluations of the merit function, the n + 1 points of
+                    the initial simplex are always evaluated. An iteration stops before an evaluation, or a shrink of
+                    the simplex with n evaluations, that would exceed it.
+            xtol: (float, optional) tolerance of the values, relative to the initial steps
+            ftol: (float, optional) absolute tolerance of the merit
+
+        Returns:
+            (OptimizationResult) best values, merit, evaluations and timing of each iteration
+        """
+        n = len(self.variables)
+        steps = np.array([v.step for v in self.variables])
+        evaluations, traced_steps = self.evaluations, self.traced_steps
+
+        # the path or the merit function may have changed since the last minimization
+        self._cache = {}
+
+        def exhausted(k=1):
+            # if k further evaluations would exceed the maximal number of evaluations
+            return self.evaluations - evaluations + k > max_evaluations
+
+        simplex = np.array([v.value for v in self.variables])[None, :].repeat(n + 1, axis=0)
+        simplex[1:] += np.diag(steps)
+        simplex = np.array([[v.clip(value) for v, value in zip(self.variables, point)] for point in simplex])
+        merits = np.array([self.evaluate(point) for point in simplex])
+
+        iterations = []
+        converged = False
+        while len(iterations) < max_iterations and not exhausted():
+            start = time.perf_counter()
+            before = self.evaluations
+
+            order = np.argsort(merits, kind='stable')
+            simplex, merits = simplex[order], merits[order]
+            if np.all(np.abs(simplex[1:] - simplex[0]) <= xtol * steps) and \
+                    np.all(np.abs(merits[1:] - merits[0]) <= ftol):
+                converged = True
+                break
+
+            centroid = simplex[:-1].mean(axis=0)
+            reflected = centroid + (centroid - simplex[-1])
+            f_reflected = self.evaluate(reflected)
+            if f_reflected < merits[0] and not exhausted():
+                expanded = centroid + 2. * (centroid - simplex[-1])
+                f_expanded = self.evaluate(expanded)
+                if f_expanded < f_reflected:
+                    simplex[-1], merits[-1] = expanded, f_expanded
+                else:
+                    simplex[-1], merits[-1] = reflected, f_reflected
+            elif f_reflected < merits[-2]:
+                simplex[-1], merits[-1] = reflected, f_reflected
+            elif exhausted():
+                break
+            else:
+                # contraction towards the better of the worst and the reflected point
+                outside = f_reflected < merits[-1]
+                contracted = centroid + 0.5 * ((reflected if outside else simplex[-1]) - centroid)
+                f_contracted = self.evaluate(contracted)
+                if f_contracted < min(f_reflected, merits[-1]):
+                    simplex[-1], merits[-1] = contracted, f_contracted
+                elif exhausted(n):
+                    break
+                else:
+                    simplex[1:] = simplex[0] + 0.5 * (simplex[1:] - simplex[0])
+                    merits[1:] = [self.evaluate(point) for point in simplex[1:]]
+
+            # the evaluations clip to the bounds, the simplex stays inside them
+            simplex = np.array([[v.clip(value) for v, value in zip(self.variables, point)] for point in simplex])
+
+            iterations.append({'merit': float(merits.min()), 'evaluations': self.evaluations - before,
+                               'time': time.perf_counter() - start})
+
+        best = int(np.argmin(merits))
+        self._apply(simplex[best])
+
+        return OptimizationResult(simplex[best].copy(), float(merits[best]), self.evaluations - evaluations,
+                                  self.traced_steps - traced_steps, iterations, converged)
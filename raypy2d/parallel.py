@@ -0,0 +1,227 @@
+import importlib
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from .elements import RotateObject
+from .loop import Loop
+from .rays import Rays, propagate
+from .utils import assure_number_of_columns, Workspace
+
+
+def _describe(step):
+    # plain description of a step, the propagation distance, the passes and elements of a loop or the class and the
+    # parameters of an element with nested elements, e.g. the second interface of a prism, described in turn
+    if np.isscalar(step):
+        return float(step)
+    if isinstance(step, Loop):
+        return 'loop', step.n, tuple(_describe(element) for element in step.elements)
+    if not isinstance(step, RotateObject):
+        raise ValueError('{} cannot be traced in parallel'.format(type(step).__name__))
+
+    parameters = {name: _describe(value) if isinstance(value, RotateObject) else value
+                  for name, value in vars(step).items()}
+    return 'element', type(step).__module__, type(step).__qualname__, parameters
+
+
+def _build(description):
+    # the step of a description, see _describe
+    if np.isscalar(description):
+        return description
+    if description[0] == 'loop':
+        _, n, elements = description
+        return Loop([_build(element) for element in elements], n)
+
+    _, module, name, parameters = description
+    cls = getattr(importlib.import_module(module), name)
+    element = cls.__new__(cls)
+    # the parameters are restored as they are, without the revision bump of setting them
+    element.__dict__.update({name: _build(value) if isinstance(value, tuple) and value[:1] == ('element',) else value
+                             for name, value in parameters.items()})
+    return element
+
+
+def path_descriptor(path) -> tuple:
+    """
+    Returns a plain description of the steps of an optical path that only holds what is needed to trace rays: the
+    propagation distances, the passes of loops and the class and parameters (numbers, arrays and lists) of each
+    element. It does not hold any rays or element objects and is cheap to pickle, see build_steps.
+    Args:
+        path: (OpticalPath, list[Element, Loop, float]) optical path or its steps
+
+    Returns:
+        (tuple) description of each step
+    """
+    return tuple(_describe(step) for step in getattr(path, 'steps', path))
+
+
+def build_steps(descriptor: tuple) -> list:
+    """
+    Creates the steps of a path from their description, see path_descriptor
+    Args:
+        descriptor: (tuple) description of each step
+
+    Returns:
+        (list[Element, Loop, float]) elements, loops and propagation distances
+    """
+    return [_build(step) for step in descriptor]
+
+
+def _dispersive(steps: list):
+    # elements that replicate rays without wavelength in the order they are traced, loops are entered
+    for step in steps:
+        if isinstance(step, Loop):
+            yield from _dispersive(step.elements)
+        elif not np.isscalar(step) and not isinstance(step, RotateObject):
+            raise ValueError('the replication of {} cannot be described'.format(type(step).__name__))
+        elif getattr(step, 'default_wavelengths', None) is not None:
+            yield step
+
+
+def replication_layout(path, array: np.array):
+    """
+    Calculates where the rays replicated by the first dispersive element of a path end up, also if it is part of a
+    loop. This element assigns its first default wavelength to all rays without wavelength, including blocked ones,
+    and appends one replica of them for each further default wavelength in one block per wavelength. Later elements
+    find a wavelength for every ray and do not replicate any more. Tracing a block checks that the rays were
+    replicated this way.
+    Args:
+        path: (OpticalPath, list[Element, Loop, float]) optical path or its steps
+        array: (numpy.array) rays with at least 6 columns
+
+    Returns:
+        k, split (int, numpy.array) number of wavelengths and the number of replicated rays before each ray
+    """
+    first = next(_dispersive(getattr(path, 'steps', path)), None)
+    k = 1 if first is None else max(len(first.default_wavelengths), 1)
+
+    split = np.zeros(array.shape[0] + 1, dtype=np.int64)
+    if k > 1:
+        np.cumsum(np.isnan(array[:, 5]), out=split[1:])
+
+    return k, split
+
+
+def trace_block(steps: list, out: np.array, alive: np.array, start: int, stop: int, k: int, split: np.array):
+    """
+    Traces the rays out[start:stop] through the steps of a path and writes the traced rays and their replicas to
+    the positions they have when all rays are traced at once
+    Args:
+        steps: (list[Element, Loop, float]) elements, loops and propagation distances, see build_steps
+        out: (numpy.array) rays with the replicas appended, the rays of the block are traced in place
+        alive: (numpy.array) mask of the not blocked rays with one entry per row of out, rays of the block blocked
+                before tracing stay blocked
+        start: (int) first ray of the block
+        stop: (int) end of the block
+        k: (int) number of wavelengths, see replication_layout
+        split: (numpy.array) number of replicated rays before each ray, see replication_layout
+    """
+    n, m = split.shape[0] - 1, stop - start
+    n_split = split[-1]
+
+    rays = Rays(out[start:stop], keep_history=False)
+    rays.alive = alive[start:stop]
+    workspace = Workspace()
+    for step in steps:
+        if np.isscalar(step):
+            rays = propagate(rays, step, workspace)
+        else:
+            rays = step.trace(rays, workspace)
+
+    # the replicas of each wavelength are stored as one block of all rays to replicate
+    s = split[stop] - split[start]
+    if rays.n != m + (k - 1) * s:
+        raise RuntimeError('the path replicated {} rays instead of {}'.format(rays.n - m, (k - 1) * s))
+
+    if not np.may_share_memory(rays.array, out):
+        out[start:stop] = rays.array[:m]
+    alive[start:stop] = rays.alive[:m]
+
+    for c in range(k - 1):
+        i = n + c * n_split + split[start]
+        out[i:i + s] = rays.array[m + c * s:m + (c + 1) * s]
+        alive[i:i + s] = rays.alive[m + c * s:m + (c + 1) * s]
+
+
+_worker = {}
+
+
+def _attach(name: str, shape: tuple, dtype):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def _init_worker(descriptor: tuple, names: tuple, shape: tuple, dtype, k: int, split: np.array):
+    out_memory, out = _attach(names[0], shape, dtype)
+    alive_memory, alive = _attach(names[1], shape[:1], bool)
+    _worker.update(steps=build_steps(descriptor), memory=(out_memory, alive_memory), out=out, alive=alive, k=k,
+                   split=split)
+
+
+def _trace_worker_block(start: int, stop: int):
+    trace_block(_worker['steps'], _worker['out'], _worker['alive'], start, stop, _worker['k'], _worker['split'])
+
+
+def trace_parallel(path, source, processes: int = None, block_size: int = None) -> Rays:
+    """
+    Traces rays through the elements of a path with a pool of processes. The rays are split into contiguous blocks
+    that the processes trace in place in shared memory, the description of the path (see path_descriptor) is sent
+    once to every process. The result is identical to tracing all rays at once without compaction, only the sign of
+    NaN entries may differ.
+    Args:
+        path: (OpticalPath) optical path
+        source: (Rays, numpy.array) rays to trace, blocked rays of Rays stay blocked
+        processes: (int, optional) number of processes, by default the number of CPUs
+        block_size: (int, optional) number of rays per block, by default the rays are split evenly over the processes
+
+    Returns:
+        (Rays) the traced rays without history
+    """
+    # rays with NaN in y or tan_theta are blocked, as if the array was traced as Rays
+    if not isinstance(source, Rays):
+        source = Rays(source, keep_history=False)
+
+    array = assure_number_of_columns(source.array, 6)
+    n = array.shape[0]
+
+    if processes is None:
+        processes = os.cpu_count()
+    if block_size is None:
+        block_size = -(-n // processes)
+
+    k, split = replication_layout(path, array)
+    n_split = split[-1]
+    shape = (n + (k - 1) * n_split, array.shape[1])
+
+    out_memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * array.dtype.itemsize))
+    alive_memory = shared_memory.SharedMemory(create=True, size=max(1, shape[0]))
+    out, alive = None, None
+    try:
+        out = np.ndarray(shape, dtype=array.dtype, buffer=out_memory.buf)
+        alive = np.ndarray(shape[:1], dtype=bool, buffer=alive_memory.buf)
+        out[:n] = array
+        alive[:n] = source.alive
+
+        starts = list(range(0, n, block_size))
+        stops = [min(start + block_size, n) for start in starts]
+        with ProcessPoolExecutor(processes, initializer=_init_worker,
+                                 initargs=(path_descriptor(path), (out_memory.name, alive_memory.name), shape,
+                                           array.dtype, k, split)) as pool:
+            list(pool.map(_trace_worker_block, starts, stops))
+
+        rays = Rays(out.copy(), keep_history=False)
+        rays.alive = alive
+    finally:
+        # the buffers can only be released without views to them
+        out, alive = None, None
+        out_memory.close()
+        out_memory.unlink()
+        alive_memory.close()
+        alive_memory.unlink()
+
+    # replicas refer to the ray they were replicated from
+    replicated = np.flatnonzero(np.isnan(array[:, 5])) if k > 1 else np.empty(0, dtype=np.int64)
+    rays.parents[n:] = np.tile(replicated, k - 1)
+
+    return rays
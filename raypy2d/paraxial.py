@@ -0,0 +1,210 @@
+import numpy as np
+from typing import List, Union, TYPE_CHECKING
+
+from . import kernels
+from .rays import Rays
+
+if TYPE_CHECKING:
+    from .elements import Element
+
+
+def propagation_matrix(distance: float):
+    """
+    Returns the ABCD matrix of the free space propagation over the passed distance
+    Args:
+        distance: (float) distance along the optical axis
+
+    Returns:
+        (numpy.array) 2x2 matrix
+    """
+    return np.array([[1., distance], [0., 1.]])
+
+
+def element_matrix(element):
+    """
+    Returns the ABCD matrix of an element acting on (y - axis, tan_theta) in the global frame of reference, if the
+    element is linear and coaxial, i.e. it is rotated by 0 or 180 degrees and is not curved.
+    Args:
+        element: (Element) element
+
+    Returns:
+        (numpy.array, None) 2x2 matrix or None if the element has to be traced exactly
+    """
+    parameters = kernels.element_parameters(element)
+    if parameters is None:
+        return None
+
+    matrix, parabolic = parameters[3], parameters[7]
+    if parabolic:
+        return None
+
+    theta = element.theta % 360.
+    if theta == 0.:
+        return matrix
+    elif theta == 180.:
+        # y is mirrored in the frame of the element while tan_theta is not
+        flip = np.diag([-1., 1.])
+        return flip @ matrix @ flip
+
+    return None
+
+
+def _plane(step):
+    return float(step) if np.isscalar(step) else float(step.origin[0])
+
+
+def _axis(step):
+    return None if np.isscalar(step) else float(step.origin[1])
+
+
+def _mirroring(step):
+    return not np.isscalar(step) and bool(step.mirroring)
+
+
+def paraxial_runs(steps: List[Union['Element', float]]):
+    """
+    Finds the runs of consecutive steps of an optical path that collapse into one system matrix, i.e. coaxial linear
+    elements (see element_matrix) and propagations with at least one element. The planes of the steps follow the
+    direction the rays travel in, which is reversed by mirrors.
+    Args:
+        steps: (list[Element, float]) elements and propagation distances in the order they are traced
+
+    Returns:
+        (list[tuple]) start and stop of each run with at least two steps
+    """
+    runs = []
+    start, axis, direction = None, None, None
+    for i, step in enumerate(list(steps) + [None]):
+        linear = step is not None and (np.isscalar(step) or element_matrix(step) is not None)
+
+        joins = False
+        if linear and start is not None:
+            dx = np.sign(_plane(step) - _plane(steps[i - 1]))
+            joins = dx != 0. and direction in (None, dx) and (axis is None or _axis(step) in (None, axis))
+            if joins:
+                axis = _axis(step) if axis is None else axis
+                direction = -dx if _mirroring(step) else dx
+
+        if not joins:
+            if start is not None and i - start >= 2 and axis is not None:
+                runs.append((start, i))
+            start, axis, direction = (i, _axis(step), None) if linear else (None, None, None)
+
+    return runs
+
+
+class ParaxialSystem:
+
+    def __init__(self, steps: List[Union['Element', float]]):
+        """
+        Composed ABCD matrix of a run of coaxial linear steps, see paraxial_runs. The matrix acts on (y - axis, slope)
+        from the plane of the first step to the plane of the last step, where the slope is tan_theta along the
+        direction the rays travel in, i.e. the path is unfolded at mirrors.
+        Args:
+            steps: (list[Element, float]) elements and propagation distances of the run
+        """
+        elements = [step for step in steps if not np.isscalar(step)]
+        self.axis = float(elements[0].origin[1])
+        self.planes = np.array([_plane(step) for step in steps])
+
+        # direction the rays travel in along x after each step
+        self.directions = np.sign(np.diff(self.planes, prepend=self.planes[0]))
+        self.directions[0] = self.directions[1]
+        mirroring = np.array([_mirroring(step) for step in steps])
+        mirroring[0] = False
+        self.directions[mirroring] *= -1.
+
+        # radius of the aperture at each plane, infinite for propagations and elements not blocking
+        self.radii = np.full(len(steps), np.inf)
+        for i, step in enumerate(steps):
+            if not np.isscalar(step):
+                parameters = kernels.element_parameters(step)
+                self.radii[i] = parameters[6] if parameters[5] else np.inf
+
+        # transfer of (y - axis, tan_theta) from after the first step to after each step
+        matrices = [np.eye(2) if np.isscalar(step) else element_matrix(step) for step in steps]
+        self.transfers = np.empty((len(steps), 2, 2))
+        self.transfers[0] = np.eye(2)
+        for i in range(1, len(steps)):
+            step = matrices[i] @ propagation_matrix(self.planes[i] - self.planes[i - 1])
+            self.transfers[i] = step @ self.transfers[i - 1]
+
+        self.mirrors = sum(_mirroring(step) for step in steps[1:])
+
+        self.direction_in = -self.directions[0] if _mirroring(steps[0]) else self.directions[0]
+        self.matrix = np.diag([1., self.directions[-1]]) @ self.transfers[-1] @ matrices[0] @ \
+            np.diag([1., self.direction_in])
+
+    @property
+    def effective_focal_length(self):
+        """
+        (float) effective focal length -1 / C, infinite for afocal systems
+        """
+        c = self.matrix[1, 0]
+        return -1. / c if c != 0. else np.inf
+
+    @property
+    def back_focal_length(self):
+        """
+        (float) distance from the last plane to the back focal point, -A / C
+        """
+        return -self.matrix[0, 0] / self.matrix[1, 0] if self.matrix[1, 0] != 0. else np.inf
+
+    @property
+    def front_focal_length(self):
+        """
+        (float) distance from the front focal point to the first plane, -D / C
+        """
+        return -self.matrix[1, 1] / self.matrix[1, 0] if self.matrix[1, 0] != 0. else np.inf
+
+    @property
+    def principal_planes(self):
+        """
+        (tuple[float]) x-coordinates of the front and the back principal plane
+        """
+        (a, _), (c, d) = self.matrix
+        return self.planes[0] - self.direction_in * (1. - d) / c, self.planes[-1] + self.directions[-1] * (1. - a) / c
+
+    def image_distance(self, object_distance: float):
+        """
+        Calculates where the system images an object
+        Args:
+            object_distance: (float) distance of the object in front of the first plane
+
+        Returns:
+            (float) distance of the image behind the last plane, negative for virtual images
+        """
+        (a, b), (c, d) = self.matrix
+        return -(a * object_distance + b) / (c * object_distance + d)
+
+    def trace(self, rays: Rays) -> Rays:
+        """
+        Traces rays that already passed the first step through the remaining steps with one matrix multiplication,
+        the apertures are checked with the transfer to each plane. Rays travelling against the direction of the run
+        are blocked, blocked rays are NaN in y and tan_theta.
+        Args:
+            rays: (Rays) rays at the plane of the first step
+
+        Returns:
+            (Rays) rays at the plane of the last step
+        """
+        y = rays.y - self.axis
+        tan_theta = rays.tan_theta
+        passed = rays.alive & ((rays.forward > 0.) == (self.directions[0] > 0.))
+
+        for transfer, radius in zip(self.transfers[1:], self.radii[1:]):
+            if np.isfinite(radius):
+                passed &= np.abs(transfer[0, 0] * y + transfer[0, 1] * tan_theta) <= radius
+
+        (a, b), (c, d) = self.transfers[-1]
+        rays.y, rays.tan_theta = a * y + b * tan_theta + self.axis, c * y + d * tan_theta
+        rays.x = self.planes[-1]
+        if self.mirrors % 2 == 1:
+            np.negative(rays.forward, out=rays.forward)
+
+        blocked = ~passed
+        rays.y[blocked] = np.nan
+        rays.tan_theta[blocked] = np.nan
+        rays.alive = passed
+
+        return rays
@@ -2,16 +2,23 @@ from matplotlib.patches import Arrow
 from matplotlib.axes import Axes
 
 import numpy as np
-from .elements import Element, RotateObject, Sensor
-from .utils import place_relative_to
-from .rays import point_source_rays, propagate, Rays
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from .elements import Element, MultiElement, RotateObject, Sensor
+from .utils import place_relative_to, Workspace
+from .rays import point_source_rays, propagate, Rays, TracedRays
+from .history import MemmapHistory
+from .plan import TracePlan
+from .paraxial import ParaxialSystem, paraxial_runs
+from .loop import Loop
 from . import plotting
-from typing import List
+from typing import List, Iterable, Union
 
 
 class Object(RotateObject):
 
-    def __init__(self, height, origin=[0., 0.], theta: float = 0., fans=[0, 0.5, 1.0], n: int = 9, angle=[-75, 75]):
+    def __init__(self, height, origin=[0., 0.], theta: float = 0., fans=[0, 0.5, 1.0], n: int = 9, angle=[-75, 75],
+                 dtype=np.float64):
         """
         Creates an object subject to imaging. The object emits three fans of rays
         Args:
@@ -21,6 +28,7 @@ class Object(RotateObject):
             fans: (list[float]) position of the ray fans emitted from object
             n: (int) number of rays per fan
             angle: (list[float]) default emission angles for ray fans
+            dtype: (numpy.dtype, optional) floating point type of the rays (see Rays)
         """
 
         RotateObject.__init__(self, [0, 0], theta)
@@ -35,7 +43,7 @@ class Object(RotateObject):
             if isinstance(angle, int):
                 angle = [-angle, angle]
 
-            rays = point_source_rays([0, y0], angle=angle, n=n)
+            rays = point_source_rays([0, y0], angle=angle, n=n, dtype=dtype)
             rays = self.to_global_frame_of_reference(rays)
 
             self.rays.append(rays.array)
@@ -68,21 +76,199 @@ class Object(RotateObject):
         return [arrow]
 
 
+class TracedChunk:
+
+    def __init__(self, rays: Rays, sensor_hits: List[Rays], traced_rays: TracedRays = None, taps: dict = None):
+        """
+        Result of tracing one chunk of rays through an optical path
+        Args:
+            rays: (Rays) rays after the last element of the path
+            sensor_hits: (list[Rays]) for each sensor of the path the rays right after the sensor in the frame of
+                    reference of the sensor, blocked rays are marked in Rays.alive
+            traced_rays: (TracedRays, optional) history of the rays of the chunk
+            taps: (dict, optional) rays of the chunk right after each tapped element (see OpticalPath)
+        """
+        self.rays = rays
+        self.sensor_hits = sensor_hits
+        self.traced_rays = traced_rays
+        self.taps = {} if taps is None else taps
+
+
 class OpticalPath:
 
-    def __init__(self, obj: Object = None, **kwargs):
+    def __init__(self, obj: Object = None, compaction: float = None, history_store: MemmapHistory = None,
+                 history: bool = True, taps: List[Element] = (), threads: int = None, block_size: int = 2 ** 16,
+                 incremental: bool = False, **kwargs):
+        """
+        Creates an optical path starting with the rays of an object or of a point source
+        Args:
+            obj: (Object, optional) object emitting the rays, if None the rays of a point source are traced
+            compaction: (float, optional) if the fraction of not blocked rays drops below this value, the blocked
+                    rays are removed from the traced rays (see Rays.compact). By default blocked rays are traced on.
+            history_store: (MemmapHistory, optional) out-of-core store for the history of the rays, by default the
+                    history is kept in memory
+            history: (bool, optional) if the state of the rays is stored after every element. Without history only
+                    the current rays and the rays at the tapped elements are kept, which saves the memory and the
+                    copies of all intermediate states.
+            taps: (list[Element], optional) elements after which a copy of the rays is kept in taps, independent of
+                    the history
+            threads: (int, optional) number of threads tracing blocks of rays concurrently. numpy releases the GIL in
+                    its kernels, so large numbers of rays are traced in parallel without processes. By default the
+                    rays are traced in the calling thread. The threads run until the path is closed (see close),
+                    used as context manager or garbage collected.
+            block_size: (int, optional) number of rays per block traced by a thread
+            incremental: (bool, optional) if a checkpoint of the rays entering each step is kept, such that retrace
+                    only traces the steps from the first changed element on. Each checkpoint is a copy of the rays.
+            **kwargs: arguments passed to point_source_rays if no object is passed
+        """
 
         self.elements = []
+
+        # elements and propagation distances in the order they are traced
+        self.steps = []
+
         self.obj = obj
         if self.obj is None:
             self.rays = point_source_rays(**kwargs)
         else:
             self.rays = obj.rays
 
+        self.compaction = compaction
+
+        if history_store is not None:
+            self.rays.history_store = history_store
+        self.rays.keep_history = history
+
+        # copies of the rays right after the tapped elements
+        self.tapped = list(taps)
+        self.taps = {}
+
+        # scratch buffers reused by all elements
+        self.workspace = Workspace()
+
+        self.threads = threads
+        self.block_size = block_size
+        self._executor = None
+        self._finalizer = None
+        self._block_workspaces = []
+
+        # checkpoints of the rays entering each step and the revision each step was traced with
+        self.incremental = incremental
+        self._checkpoints = []
+        self._revisions = []
+
         self.rays.store()
 
         self.sensors = []
 
+    def close(self):
+        """
+        Stops the threads tracing blocks of rays, see threads. Tracing further steps starts new threads.
+        """
+        if self._executor is not None:
+            self._finalizer.detach()
+            self._executor.shutdown()
+            self._executor, self._finalizer = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _compact(self, rays: Rays):
+        if self.compaction is not None and np.count_nonzero(rays.alive) < self.compaction * rays.n:
+            rays.compact()
+
+    def _blockwise(self, rays: Rays, step: Union[Element, float]) -> bool:
+        if self.threads is None or rays.n <= self.block_size:
+            return False
+
+        # the blocks are traced in place, elements replicating rays or storing intermediate states need all rays
+        if isinstance(step, MultiElement) and rays.keep_history:
+            return False
+        elements = step.elements if isinstance(step, Loop) else [step]
+        return not (any(hasattr(e, 'default_wavelengths') for e in elements) and np.isnan(rays.wavelength).any())
+
+    def _trace_blocks(self, rays: Rays, step: Union[Element, float]):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads)
+            # the threads are stopped when the path is garbage collected without being closed
+            self._finalizer = weakref.finalize(self, self._executor.shutdown, wait=False)
+
+        starts = range(0, rays.n, self.block_size)
+        while len(self._block_workspaces) < len(starts):
+            self._block_workspaces.append(Workspace())
+
+        def trace(start, workspace):
+            block = rays.block(start, min(start + self.block_size, rays.n))
+            if isinstance(step, (Element, Loop)):
+                step.trace(block, workspace)
+            else:
+                propagate(block, step, workspace)
+
+        list(self._executor.map(trace, starts, self._block_workspaces))
+
+    def _trace(self, rays: Rays, step: Union[Element, float], workspace: Workspace, taps: dict) -> Rays:
+        if self._blockwise(rays, step):
+            self._trace_blocks(rays, step)
+        elif isinstance(step, (Element, Loop)):
+            rays = step.trace(rays, workspace)
+        else:
+            rays = propagate(rays, step, workspace)
+
+        if step in self.tapped:
+            taps[step] = rays.copy()
+
+        rays.store()
+        self._compact(rays)
+
+        return rays
+
+    @staticmethod
+    def _revision(step: Union[Element, Loop, float]):
+        if isinstance(step, Loop):
+            return tuple(element.revision for element in step.elements) + (step.n,)
+        return step if np.isscalar(step) else step.revision
+
+    def _trace_step(self, step: Union[Element, Loop, float]):
+        if self.incremental:
+            self._checkpoints.append(self.rays.checkpoint())
+            self._revisions.append(self._revision(step))
+        self.rays = self._trace(self.rays, step, self.workspace, self.taps)
+
+    def changed(self) -> int:
+        """
+        Returns the first step changed since it was traced, e.g. an element that was moved or got a new focal length
+        Returns:
+            (int, None) index of the first changed step, None if all steps are up to date
+        """
+        for i, (step, revision) in enumerate(zip(self.steps, self._revisions)):
+            if self._revision(step) != revision:
+                return i
+        return None
+
+    def retrace(self) -> int:
+        """
+        Traces the rays again from the first changed step on, starting with the rays that entered this step (see
+        changed). The steps before are not traced again. Requires an incremental path.
+        Returns:
+            (int) number of traced steps
+        """
+        assert self.incremental
+
+        start = self.changed()
+        if start is None:
+            return 0
+
+        self.rays.restore(self._checkpoints[start])
+        steps = self.steps[start:]
+        del self._checkpoints[start:], self._revisions[start:]
+        for step in steps:
+            self._trace_step(step)
+
+        return len(steps)
+
     def append(self, *elements: List[Element], distance=0., theta=0.):
         """
         Append an elements to the path at an optional distance relative to the previous element
@@ -102,12 +288,110 @@ class OpticalPath:
 
             if isinstance(element, Sensor):
                 self.sensors.append(element)
-            element.trace(self.rays)
-            self.rays.store()
+            self.steps.append(element)
+            self._trace_step(element)
+
+    def repeat(self, elements: List[Element], n: int) -> Loop:
+        """
+        Traces the rays n times through a sequence of elements placed in the global frame of reference, e.g. the
+        mirrors of a folded cavity, see Loop. Only the state after the last pass is stored in the history.
+        Args:
+            elements: (list[Element]) elements of one pass in the order they are traced
+            n: (int) number of passes
+
+        Returns:
+            (Loop) the loop with the round trip matrix and the stability of paraxial rays
+        """
+        loop = Loop(elements, n)
+        for element in loop.elements:
+            if not any(element is e for e in self.elements):
+                self.elements.append(element)
+                if isinstance(element, Sensor):
+                    self.sensors.append(element)
+
+        self.steps.append(loop)
+        self._trace_step(loop)
+
+        return loop
 
     def propagate(self, x):
-        self.rays = propagate(self.rays, x)
-        self.rays.store()
+        self.steps.append(x)
+        self._trace_step(x)
+
+    def trace_stream(self, source: Union[Rays, np.array, Iterable], chunk_size: int = 2 ** 16, history: bool = False):
+        """
+        Traces rays through the elements of the path chunk by chunk, such that the memory is bounded by the chunk
+        size instead of the number of rays. The rays of the path are not changed.
+        Args:
+            source: (Rays, numpy.array, iterable) rays to trace, either as Rays, as array of rays (see Rays) or as an
+                    iterable of them, e.g. a generator creating the rays on demand
+            chunk_size: (int, optional) maximal number of rays traced at once
+            history: (bool, optional) if the history of each chunk is kept and returned, the tapped elements are
+                    returned in any case
+
+        Returns:
+            (generator[TracedChunk]) the result of each chunk
+        """
+
+        if isinstance(source, (Rays, np.ndarray)):
+            source = [source]
+
+        for rays in source:
+            array = rays.array if isinstance(rays, Rays) else rays
+            for i in range(0, array.shape[0], chunk_size):
+                yield self._trace_chunk(Rays(np.array(array[i:i + chunk_size]), keep_history=history))
+
+    def trace_parallel(self, source: Union[Rays, np.array], processes: int = None, block_size: int = None) -> Rays:
+        """
+        Traces rays through the elements of the path with a pool of processes, see parallel.trace_parallel. The
+        result is identical to tracing all rays at once, the compaction of the path is not applied and the rays of
+        the path are not changed.
+        Args:
+            source: (Rays, numpy.array) rays to trace
+            processes: (int, optional) number of processes, by default the number of CPUs
+            block_size: (int, optional) number of rays per block, by default the rays are split evenly
+
+        Returns:
+            (Rays) the traced rays without history
+        """
+        # multiprocessing.shared_memory needs python 3.8, the other features of the path do not
+        from . import parallel
+
+        return parallel.trace_parallel(self, source, processes, block_size)
+
+    def compile(self, paraxial: bool = False) -> TracePlan:
+        """
+        Compiles the elements and propagations of the path into an immutable plan, that traces new batches of rays
+        without the per element overhead, see TracePlan
+        Args:
+            paraxial: (bool, optional) if runs of coaxial linear elements are collapsed into system matrices
+
+        Returns:
+            (TracePlan) plan of the path
+        """
+        return TracePlan(self.steps, paraxial)
+
+    def paraxial_systems(self) -> List[ParaxialSystem]:
+        """
+        Composes the system matrices of the runs of coaxial linear elements of the path, e.g. a row of lenses and
+        apertures on the same axis, see paraxial.paraxial_runs. Each system provides the effective focal length,
+        the principal planes and image distances of its run.
+        Returns:
+            (list[ParaxialSystem]) one system per run in the order of the path
+        """
+        return [ParaxialSystem(self.steps[start:stop]) for start, stop in paraxial_runs(self.steps)]
+
+    def _trace_chunk(self, rays: Rays) -> TracedChunk:
+        rays.store()
+
+        sensor_hits, taps = [], {}
+        for step in self.steps:
+            rays = self._trace(rays, step, self.workspace, taps)
+
+            if isinstance(step, Sensor):
+                sensor_hits.append(step.to_element_frame_of_reference(rays.copy(), self.workspace))
+
+        return TracedChunk(rays, sensor_hits, rays.traced_rays() if rays.keep_history else None, taps)
 
     def plot(self, ax: Axes):
 
@@ -0,0 +1,138 @@
+import copy
+import numpy as np
+from typing import List, Union, TYPE_CHECKING
+
+from . import kernels
+from .paraxial import ParaxialSystem, paraxial_runs
+from .rays import Rays, propagate
+from .utils import Workspace
+
+if TYPE_CHECKING:
+    from .elements import Element
+
+
+class TracePlan:
+
+    def __init__(self, steps: List[Union['Element', float]], paraxial: bool = False):
+        """
+        Immutable plan for tracing rays through an optical path, see OpticalPath.compile. The elements and
+        propagations are stored as flat parameter arrays and consecutive steps supported by the fused kernels (see
+        kernels.element_parameters) are traced in one loop over the rays, without any python call per element.
+        Other elements, e.g. dispersive elements, are traced by a copy of the element taken when compiling. Changes
+        of the elements after compiling are not reflected in the plan.
+        In paraxial mode runs of coaxial linear steps (see paraxial.paraxial_runs) are collapsed into their composed
+        system matrix: after the first step of a run the rays are traced with one matrix multiplication, the result
+        equals the exact trace up to rounding errors. Blocked rays are NaN in y and tan_theta and the steps of a run
+        are traced exactly if the history is kept.
+        Args:
+            steps: (list[Element, float]) elements and propagation distances in the order they are traced
+            paraxial: (bool, optional) if runs of coaxial linear steps are collapsed into system matrices
+        """
+        m = len(steps)
+        self.steps = tuple(s if np.isscalar(s) else copy.deepcopy(s) for s in steps)
+
+        self.propagation = np.zeros(m, dtype=bool)
+        self.x_plane = np.zeros(m)
+        self.origin = np.zeros((m, 2))
+        self.rotation = np.zeros((m, 2, 2))
+        self.rotate = np.zeros(m, dtype=bool)
+        self.matrix = np.zeros((m, 2, 2))
+        self.mirroring = np.zeros(m, dtype=bool)
+        self.blocking = np.zeros(m, dtype=bool)
+        self.radius = np.zeros(m)
+        self.parabolic = np.zeros(m, dtype=bool)
+        self.f = np.zeros(m)
+        self.x_blocker = np.zeros(m)
+
+        parameters = (self.origin, self.rotation, self.rotate, self.matrix, self.mirroring, self.blocking,
+                      self.radius, self.parabolic, self.f, self.x_blocker)
+
+        fused = np.zeros(m, dtype=bool)
+        for i, step in enumerate(self.steps):
+            if np.isscalar(step):
+                self.propagation[i], self.x_plane[i] = True, step
+                fused[i] = True
+            else:
+                values = kernels.element_parameters(step)
+                fused[i] = values is not None
+                if fused[i]:
+                    for array, value in zip(parameters, values):
+                        array[i] = value
+
+        # the first step of each run is traced exactly, it brings all rays to the plane the system starts at
+        runs = paraxial_runs(self.steps) if paraxial else []
+        self.systems = tuple(ParaxialSystem(self.steps[start:stop]) for start, stop in runs)
+        collapsed = {start + 1: (stop, system) for (start, stop), system in zip(runs, self.systems)}
+
+        # consecutive fused steps as (start, stop, None), other elements as (i, i + 1, element) and collapsed runs
+        # as (start, stop, system)
+        segments = []
+        i = 0
+        while i < m:
+            if i in collapsed:
+                stop, system = collapsed[i]
+                segments.append((i, stop, system))
+                i = stop
+                continue
+
+            if not fused[i]:
+                segments.append((i, i + 1, self.steps[i]))
+            elif len(segments) > 0 and segments[-1][2] is None and segments[-1][1] == i:
+                segments[-1] = (segments[-1][0], i + 1, None)
+            else:
+                segments.append((i, i + 1, None))
+            i += 1
+        self.segments = tuple(segments)
+
+        for array in (self.propagation, self.x_plane) + parameters:
+            array.flags.writeable = False
+
+    def _trace_fused(self, rays: Rays, start: int, stop: int, workspace: Workspace) -> Rays:
+        # the same conditions as the kernels of the elements, numba has to be installed and enabled
+        if not (kernels.use_numba and kernels.numba is not None) or rays.dtype != np.float64:
+            for step in self.steps[start:stop]:
+                if np.isscalar(step):
+                    rays = propagate(rays, step, workspace)
+                else:
+                    rays = step.trace(rays, workspace)
+                rays.store()
+            return rays
+
+        if rays.keep_history:
+            states = rays.store_states(stop - start)
+        else:
+            states = np.empty((rays.n, 0, 3))
+
+        kernels._trace_steps(rays.array, rays.alive, states, self.propagation[start:stop],
+                             self.x_plane[start:stop], self.origin[start:stop], self.rotation[start:stop],
+                             self.rotate[start:stop], self.matrix[start:stop], self.mirroring[start:stop],
+                             self.blocking[start:stop], self.radius[start:stop], self.parabolic[start:stop],
+                             self.f[start:stop], self.x_blocker[start:stop])
+        return rays
+
+    def trace(self, source: Union[Rays, np.array], history: bool = False) -> Rays:
+        """
+        Traces a batch of rays. Without numba, if it is not enabled (see kernels.use_numba) or for single precision
+        rays the steps are traced with numpy, the result is the same.
+        Args:
+            source: (Rays, numpy.array) rays to trace, they are not changed
+            history: (bool, optional) if the state after every step is kept as history of the returned rays
+
+        Returns:
+            (Rays) the traced rays
+        """
+        array = source.array if isinstance(source, Rays) else source
+        rays = Rays(np.array(array), keep_history=history)
+        rays.store()
+
+        workspace = Workspace()
+        for start, stop, element in self.segments:
+            if element is None or (isinstance(element, ParaxialSystem) and rays.keep_history):
+                rays = self._trace_fused(rays, start, stop, workspace)
+            elif isinstance(element, ParaxialSystem):
+                rays = element.trace(rays)
+            else:
+                rays = element.trace(rays, workspace)
+                rays.store()
+
+        return rays
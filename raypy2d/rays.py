@@ -1,12 +1,17 @@
 import numpy as np
 import operator
+import os
+import secrets
+import threading
+import weakref
 from itertools import cycle
 from matplotlib.axes import Axes
 from matplotlib import rcParams
 
-import uuid
-from .utils import assure_number_of_columns, wavelength_to_rgb, rolling_window
+from .utils import assure_number_of_columns, wavelength_to_rgb, transform_columns, Workspace
+from .history import MemmapHistory
 from . import plotting
+from . import kernels
 
 
 def _view_property(*args, attr='array'):
@@ -19,31 +24,85 @@ def _view_property(*args, attr='array'):
     return property(_get, _set_x)
 
 
+class _SharedHistory:
+    # read-only owner of the views of the history handed out by Rays.complete_array. Every array derived from such a
+    # view keeps this object alive, so the rays can tell if the history buffer is still referenced before writing it.
+
+    def __init__(self, history: np.array):
+        self.history = history
+        interface = dict(history.__array_interface__)
+        interface['data'] = (interface['data'][0], True)
+        self.__array_interface__ = interface
+
+
+def _grown(buffer: np.array, capacity: int, n: int):
+    grown = np.empty((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:n] = buffer[:n]
+    return grown
+
+
 class Rays:
 
-    def __init__(self, array: np.array):
+    def __init__(self, array: np.array, history_capacity: int = 4, history_store: MemmapHistory = None,
+                 keep_history: bool = True, dtype=None):
         """
         Interprets the passed array as a list of rays
         Args:
             array: (numpy.array) two dimensional with shape of (n, m) where m >= 3. Columns 1, 2 are interpreted as x
                     and y coordinate and column 3 as the propagation angle
+            history_capacity: (int, optional) number of stored states the history is initially allocated for, the
+                    history grows by doubling if more states are stored
+            history_store: (MemmapHistory, optional) out-of-core store the history is written to instead of memory
+            keep_history: (bool, optional) if False, store does not keep any state and the history only consists of
+                    the current state
+            dtype: (numpy.dtype, optional) floating point type of the rays and their history, by default the type
+                    of the passed array. numpy.float32 halves the memory and bandwidth, its relative precision is
+                    about 6e-8: positions are accurate to roughly 1e-7 times the extent of the setup per traced
+                    element, ray crossings of nearly parallel rays are considerably less accurate.
         """
 
         assert len(array.shape) == 2
         assert array.shape[0] >= 1  # minimal one ray
         assert array.shape[1] >= 3  # min. x, y and theta
 
-        # store a view to array
-        self.arrays = [assure_number_of_columns(array, 6)]
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+
+        # history of the ray positions and angles with shape (rays, states, 3), allocated with the first store
+        self._history = None
+        self._history_capacity = max(1, history_capacity)
+        self._history_rows = 0
+        self._stored = 0
+        # weak references to the owners of the views of the history handed out, the states they cover are copied
+        # before they are written while one of them lives
+        self._shared = []
+        self.history_store = history_store
+        self.keep_history = keep_history
+
+        self._set_array(assure_number_of_columns(array, 6))
 
         # set default direction to forward
         self.forward[np.isnan(self.forward)] = 1.0
 
     def _get_array(self):
-        return self.arrays[-1]
+        return self._array
 
     def _set_array(self, array):
-        self.arrays[-1] = array
+        # store a view to array, the array is the backing buffer until more rays are appended
+        self._array = array
+        self._buffer = array
+
+        # index of the ray a ray was replicated from (-1 for original rays), the history before the replication is
+        # only stored for the parent ray
+        self._parents = np.full(self.n, -1, dtype=np.int64)
+
+        # rays that are not blocked
+        self._alive = ~(np.isnan(self.y) | np.isnan(self.tan_theta))
+
+        # index of the active rays in the history, None as long as the rays were never compacted
+        self._ids = None
+        self._n_total = self.n
+        self._retired = []
 
     array = property(_get_array, _set_array)
 
@@ -62,38 +121,432 @@ class Rays:
     def n(self):
         return self.array.shape[0]
 
+    @property
+    def dtype(self):
+        """
+        (numpy.dtype) floating point type of the rays
+        """
+        return self.array.dtype
+
+    def _direction_into(self, cos_theta: np.array, sin_theta: np.array, mask: np.array):
+        # cos and sin of the propagation angle, tan_theta=+-inf are rays perpendicular to the abscissa
+        tan_theta = self.tan_theta
+        np.hypot(1., tan_theta, out=cos_theta)
+        np.divide(1., cos_theta, out=cos_theta)
+        with np.errstate(invalid='ignore'):
+            np.multiply(tan_theta, cos_theta, out=sin_theta)
+        np.isinf(tan_theta, out=mask)
+        np.sign(tan_theta, out=sin_theta, where=mask)
+
+        np.less(self.forward, 0., out=mask)
+        np.negative(cos_theta, out=cos_theta, where=mask)
+        np.negative(sin_theta, out=sin_theta, where=mask)
+
+    def _direction_from(self, cos_theta: np.array, sin_theta: np.array, mask: np.array):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(sin_theta, cos_theta, out=self.tan_theta)
+        np.greater(cos_theta, 0., out=mask)
+        np.subtract(mask, 0.5, out=self.forward)
+
+    def _get_direction(self):
+        direction = np.empty((self.n, 2), dtype=self.dtype)
+        self._direction_into(direction[:, 0], direction[:, 1], np.empty(self.n, dtype=bool))
+        return direction
+
+    def _set_direction(self, direction):
+        self._direction_from(direction[:, 0], direction[:, 1], np.empty(self.n, dtype=bool))
+
+    direction = property(_get_direction, _set_direction,
+                         doc="(numpy.array) propagation direction of the rays as (cos, sin) with shape (n, 2), "
+                             "derived from tan_theta and forward")
+
+    def rotate_directions(self, matrix: np.array, workspace: Workspace = None):
+        """
+        Rotates the propagation directions of the rays, the direction vectors (cos, sin) are multiplied with the
+        passed matrix from the right. tan_theta and forward are updated in place.
+        Args:
+            matrix: (numpy.array) 2x2 rotation matrix, or with shape (2, 2, n) one matrix per ray
+            workspace: (Workspace, optional) scratch buffers
+        """
+
+        if workspace is None:
+            workspace = Workspace()
+
+        cos_theta = workspace.get('cos_theta', self.n, self.dtype)
+        sin_theta = workspace.get('sin_theta', self.n, self.dtype)
+        mask = workspace.get('direction_mask', self.n, bool)
+
+        self._direction_into(cos_theta, sin_theta, mask)
+        transform_columns(cos_theta, sin_theta, matrix, workspace)
+        self._direction_from(cos_theta, sin_theta, mask)
+
+    @property
+    def n_total(self):
+        """
+        (int) number of rays including the rays removed from the active rays by compact
+        """
+        return self._n_total
+
+    def _get_alive(self):
+        return self._alive[:self.n]
+
+    def _set_alive(self, alive):
+        self._alive[:self.n] = alive
+
+    alive = property(_get_alive, _set_alive, doc="(numpy.array) boolean mask of the rays that are not blocked")
+
+    @property
+    def parents(self):
+        """
+        (numpy.array) index in the history of the ray each ray was replicated from, -1 for rays that are not a
+        replication
+        """
+        return self._parents[:self.n]
+
+    @property
+    def ids(self):
+        """
+        (numpy.array) index of each ray in the history
+        """
+        if self._ids is None:
+            return np.arange(self.n)
+        return self._ids[:self.n]
+
+    def _get_history_store(self):
+        return self._history_store
+
+    def _set_history_store(self, history_store):
+        assert self._stored == 0  # the history can only be moved before the first state is stored
+        self._history_store = history_store
+
+    history_store = property(_get_history_store, _set_history_store,
+                             doc="(MemmapHistory) out-of-core store of the history, None if the history is kept in "
+                                 "memory")
+
+    @property
+    def arrays(self):
+        """
+        (list[numpy.array]) the stored states with shape (n, 3) followed by the current array
+        """
+        if self._history_store is not None:
+            states = [self._history_store.state(i, self._history_rows) for i in range(self._stored)]
+        else:
+            states = [self._history[:self._history_rows, i, :] for i in range(self._stored)]
+        return states + [self.array]
+
     def copy(self):
-        return Rays(self.array.copy())
+        rays = Rays(self.array.copy(), history_capacity=self._history_capacity)
+        rays.parents[:] = self.parents
+        rays.alive = self.alive
+        return rays
+
+    def checkpoint(self):
+        """
+        Returns a copy of the current state of the rays that can be restored later, e.g. to trace again from an
+        intermediate element. The history is not copied, only the number of stored states.
+        Returns:
+            (tuple) state of the rays for restore
+        """
+        return (self.array.copy(), self.alive.copy(), self.parents.copy(),
+                None if self._ids is None else self.ids.copy(), self._n_total, list(self._retired), self._stored,
+                self._history_rows)
+
+    def restore(self, checkpoint: tuple):
+        """
+        Resets the rays to a checkpoint taken from these rays. The states stored after the checkpoint are discarded
+        and overwritten by the next stores.
+        Args:
+            checkpoint: (tuple) state returned by checkpoint
+        """
+        array, alive, parents, ids, n_total, retired, stored, history_rows = checkpoint
+
+        n = array.shape[0]
+        self._reserve(n)
+        self._array = self._buffer[:n, :]
+        self._array[:] = array
+        self.alive = alive
+        self.parents[:] = parents
+        if ids is None:
+            self._ids = None
+        else:
+            if self._ids is None:
+                self._materialize_ids()
+            self._ids[:n] = ids
+        self._n_total = n_total
+        self._retired = list(retired)
+
+        # rays appended after the checkpoint have no states before it
+        if self._history is not None and self._history_store is None:
+            self._unshare_history()
+            self._history[history_rows:self._history_rows, :, :] = np.nan
+        self._stored = stored
+        self._history_rows = history_rows
+
+    def block(self, start: int, stop: int):
+        """
+        Returns the rays [start, stop) as rays without history that share the array and the alive mask with these
+        rays, such that tracing the block in place traces these rays.
+        Args:
+            start: (int) first ray of the block
+            stop: (int) end of the block
+
+        Returns:
+            (Rays) the rays of the block
+        """
+        rays = Rays(self.array[start:stop], keep_history=False)
+        rays._alive = self._alive[start:stop]
+        return rays
+
+    def _shared_views(self) -> list:
+        # the owners of the views into the current history buffer that are still referenced
+        views = [ref() for ref in self._shared]
+        views = [view for view in views if view is not None]
+        self._shared = [weakref.ref(view) for view in views]
+        return views
+
+    def _unshare_history(self):
+        # copy-on-write: a view handed out by complete_array keeps the states it had, the rays continue in a copy
+        if len(self._shared_views()) > 0:
+            self._history = self._history.copy()
+        self._shared = []
+
+    def _holds_state(self, state: int) -> bool:
+        # if the state of the history already holds the current rays, e.g. the current state written for a view by
+        # complete_array that was not traced on since, such that writing it again would not change the view
+        column = self._history[:self._history_rows, state, :]
+        if self._ids is None:
+            current, others = column[:self.n], column[self.n:]
+        else:
+            others = np.ones(self._history_rows, dtype=bool)
+            others[self.ids] = False
+            current, others = column[self.ids], column[others]
+        return np.array_equal(current, self.array[:, :3], equal_nan=True) and np.isnan(others).all()
+
+    def _reserve_history(self, rows: int, states: int):
+        """
+        Makes sure the history can hold the passed number of rays and states. The history grows by doubling the
+        exceeded dimension, new entries are filled with NaN.
+        Args:
+            rows: (int) number of rays
+            states: (int) number of states
+        """
+
+        if self._history is None:
+            self._history = np.full((rows, max(states, self._history_capacity), 3), np.nan, dtype=self.dtype)
+        else:
+            capacity_rows, capacity_states, _ = self._history.shape
+            if rows > capacity_rows or states > capacity_states:
+                if rows > capacity_rows:
+                    capacity_rows = max(rows, 2 * capacity_rows)
+                if states > capacity_states:
+                    capacity_states = max(states, 2 * capacity_states)
+
+                history = np.full((capacity_rows, capacity_states, 3), np.nan, dtype=self._history.dtype)
+                history[:self._history_rows, :self._stored, :] = self._history[:self._history_rows, :self._stored, :]
+                self._history = history
+
+                # the views handed out keep the previous buffer
+                self._shared = []
+
+        self._history_rows = max(self._history_rows, rows)
+
+    def _write_state(self, state: int):
+        if self._history_store is not None:
+            self._history_rows = max(self._history_rows, self.n_total)
+            self._history_store.write(state, self._history_rows, self.array[:, :3],
+                                      None if self._ids is None else self.ids)
+            return
+
+        self._reserve_history(self.n_total, state + 1)
+
+        # states after the ones of the views handed out are written in place, as are states the views already hold
+        if state < max((view.history.shape[1] for view in self._shared_views()), default=0):
+            if self._holds_state(state):
+                return
+            self._unshare_history()
+
+        if self._ids is None:
+            self._history[:self.n, state, :] = self.array[:, :3]
+            self._history[self.n:self._history_rows, state, :] = np.nan
+        else:
+            self._history[:self._history_rows, state, :] = np.nan
+            self._history[self.ids, state, :] = self.array[:, :3]
 
     def store(self):
-        self.arrays.append(self.arrays[-1])
-        self.arrays[-2] = self.arrays[-2][:, :3].copy()
+        """
+        Stores the current positions and angles of the rays as the next state in the history, does nothing if the
+        history is not kept
+        """
+        if not self.keep_history:
+            return
+
+        self._write_state(self._stored)
+        self._stored += 1
+
+    def store_states(self, k: int):
+        """
+        Stores the next k states at once and returns them for writing, e.g. by a kernel tracing several steps in one
+        pass. The returned states are NaN until they are written.
+        Args:
+            k: (int) number of states
+
+        Returns:
+            (numpy.array) view into the history with shape (n, k, 3)
+        """
+        # the states are written directly, which requires the rays to be the rows of the history
+        assert self._ids is None and self._history_store is None
+
+        self._reserve_history(self.n_total, self._stored + k)
+        self._unshare_history()
+        states = self._history[:self.n, self._stored:self._stored + k, :]
+        self._stored += k
+
+        return states
+
+    def _reserve(self, rows: int):
+        """
+        Makes sure the backing buffer can hold the passed number of rays. The buffer grows by doubling.
+        Args:
+            rows: (int) number of rays
+        """
+        capacity = self._buffer.shape[0]
+        if rows > capacity:
+            n, capacity = self.n, max(rows, 2 * capacity)
+
+            self._buffer = _grown(self._buffer, capacity, n)
+            self._array = self._buffer[:n, :]
+            self._parents = _grown(self._parents, capacity, n)
+            self._alive = _grown(self._alive, capacity, n)
+            if self._ids is not None:
+                self._ids = _grown(self._ids, capacity, n)
+
+    def _resize(self, rows: int):
+        self._reserve(rows)
+        self._array = self._buffer[:rows, :]
+
+    def _materialize_ids(self):
+        self._ids = np.arange(self._buffer.shape[0])
 
     def append(self, rays):
-        self.array = np.vstack((self.array, rays.array))
+        if self._ids is None and rays._ids is not None:
+            self._materialize_ids()
+
+        n = self.n
+        self._resize(n + rays.n)
+        self._array[n:, :] = rays.array
+        self.parents[n:] = np.where(rays.parents >= 0, rays.parents + self._n_total, -1)
+        self.alive[n:] = rays.alive
+        if self._ids is not None:
+            self._ids[n:self.n] = rays.ids + self._n_total
+        self._n_total += rays.n_total
+
+    def replicate_wavelengths(self, index: np.array, wavelengths: list):
+        """
+        Assigns the first wavelength to the selected rays and appends a copy of them for each further wavelength.
+        The copies are appended in blocks per wavelength with one single allocation. The copies reference the
+        selected rays as parents, such that their history up to here is only stored once.
+        Args:
+            index: (numpy.array) boolean mask or indices of the rays to replicate
+            wavelengths: (list[float]) wavelengths in nm
+        """
 
-    def complete_array(self):
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+
+        wavelengths = np.asarray(wavelengths, dtype=float)
+
+        self.wavelength[index] = wavelengths[0]
+
+        n, m, k = self.n, len(index), len(wavelengths)
+        if m == 0 or k < 2:
+            return
+
+        self._resize(n + m * (k - 1))
+
+        copies = self._array[n:, :].reshape((k - 1, m, -1))
+        np.take(self._array, index, axis=0, out=copies[0], mode='clip')
+        copies[1:] = copies[0]
+        copies[:, :, 5] = wavelengths[1:, None]
 
-        rows = max([arr.shape[0] for arr in self.arrays])
+        self.parents[n:].reshape((k - 1, m))[:] = self.ids[index][None, :]
+        self.alive[n:].reshape((k - 1, m))[:] = self.alive[index][None, :]
+        if self._ids is not None:
+            self._ids[n:self.n] = np.arange(self._n_total, self._n_total + m * (k - 1))
+        self._n_total += m * (k - 1)
 
-        arrays = []
-        for arr in self.arrays:
-            new_rows = rows - arr.shape[0]
+    def compact(self):
+        """
+        Removes the blocked rays from the active rays, such that they are not traced any further. Their history
+        is kept and their last state is still part of final_array.
+        """
+
+        alive = self.alive
+        m = np.count_nonzero(alive)
+        if m == self.n:
+            return
 
-            if new_rows > 0:
-                arr = np.vstack((arr, np.zeros((new_rows, arr.shape[1]))))
-                arr[-new_rows:, :] = np.nan
+        if self._ids is None:
+            self._materialize_ids()
 
-            arrays.append(arr)
+        blocked = ~alive
+        self._retired.append((self.ids[blocked], self.array[blocked, :], self.parents[blocked]))
 
-        arrays[-1] = arrays[-1][:, :3]
+        keep = np.flatnonzero(alive)
+        self._buffer[:m, :] = self._buffer[keep, :]
+        self._parents[:m] = self._parents[keep]
+        self._ids[:m] = self._ids[keep]
+        self._alive[:m] = True
+        self._array = self._buffer[:m, :]
 
-        tr = np.transpose(np.asarray(arrays), (1, 0, 2))
+    def _final(self, active: np.array, retired: int, fill):
+        if self._ids is None:
+            return active
 
-        return tr
+        final = np.full((self._n_total,) + active.shape[1:], fill, dtype=active.dtype)
+        for retired_rays in self._retired:
+            final[retired_rays[0]] = retired_rays[retired]
+        final[self.ids] = active
 
-    def ray_crossings(self, element=None):
-        return RayCrossings.from_traced_rays(self.traced_rays(), element)
+        return final
+
+    def final_array(self):
+        """
+        Returns the current state of all rays in the order of the history, including the rays removed by compact
+        with the state they had when they were removed.
+        Returns:
+            (numpy.array) with shape (n_total, 6)
+        """
+        return self._final(self.array, 1, np.nan)
+
+    def complete_array(self):
+        """
+        Returns the history of the rays including the current state. Rays added after a state was stored are NaN in
+        that state. The returned array is a read-only view into the history buffer without copying it. While the
+        view or an array derived from it is referenced, the next write to the history that changes a state of the
+        view first moves the rays to a copy of the buffer (copy-on-write), such that the view keeps its states.
+        Views of rays that were not traced on in between share the buffer. With a history store the returned
+        HistoryArray reads the states from disk when it is indexed.
+        Returns:
+            (numpy.array, HistoryArray) with shape (n, stored states + 1, 3)
+        """
+
+        # the current state occupies the next free slot without being stored
+        self._write_state(self._stored)
+
+        if self._history_store is not None:
+            return self._history_store.array(self._history_rows, self._stored + 1)
+
+        # a view of the same states is handed out again instead of another owner of the buffer
+        shape = (self._history_rows, self._stored + 1, 3)
+        shared = next((view for view in self._shared_views() if view.history.shape == shape), None)
+        if shared is None:
+            shared = _SharedHistory(self._history[:self._history_rows, :self._stored + 1, :])
+            self._shared.append(weakref.ref(shared))
+        return np.asarray(shared)
+
+    def ray_crossings(self, element=None, shared_prefix: bool = False, only_crossing: bool = False):
+        return RayCrossings.from_traced_rays(self.traced_rays(), element, shared_prefix, only_crossing)
 
     def traced_rays(self):
         return TracedRays.from_rays(self)
@@ -104,15 +557,194 @@ class Rays:
         return rs.plot(ax, **kwargs)
 
 
+class PropertyTable:
+    """
+    Compact integer coding of the ray properties. The distinct groups and wavelengths are collected in sorted tables
+    and each ray refers to them by a small integer index, so grouping works on integers instead of rows of floats.
+    """
+
+    def __init__(self, properties_array: np.array):
+        """
+        Args:
+            properties_array: (numpy.array) two dimensional with shape of (n, 2) with group and wavelength
+        """
+        self.groups, group_ids = np.unique(properties_array[:, 0], return_inverse=True)
+        self.wavelengths, wavelength_ids = np.unique(properties_array[:, 1], return_inverse=True)
+        self.group_ids = group_ids.astype(np.int32)
+        self.wavelength_ids = wavelength_ids.astype(np.uint16 if self.wavelengths.shape[0] <= 2 ** 16 else np.uint32)
+        self.valid = ~np.isnan(properties_array).any(axis=1)
+
+    @property
+    def keys(self):
+        """
+        (numpy.array) combined index of group and wavelength, ordered like the rows of unique (group, wavelength)
+        """
+        return self.group_ids.astype(np.int64) * self.wavelengths.shape[0] + self.wavelength_ids
+
+    def members(self):
+        """
+        Collects the rays of each distinct combination of group and wavelength
+        Returns:
+            keys, members (numpy.array, list[numpy.array]) the present keys in ascending order and the ascending indices
+                    of the rays of each key
+        """
+        keys = self.keys
+        counts = np.bincount(keys)
+        present = np.flatnonzero(counts)
+        members = np.split(np.argsort(keys, kind='stable'), np.cumsum(counts[present])[:-1])
+        return present, members
+
+
+def _inversions(values: np.array):
+    """
+    Finds the pairs of positions i < j with values[i] > values[j], in O((n + k) log n) for k pairs with a bottom-up
+    merge of sorted blocks
+    Args:
+        values: (numpy.array) integer values, e.g. ranks
+
+    Returns:
+        i, j (numpy.array, numpy.array) positions of the inverted pairs
+    """
+    n = values.shape[0]
+    values = values.astype(np.int64)
+    positions = np.arange(n)
+    found_i, found_j = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+
+    width = 1
+    while width < n:
+        block = positions // (2 * width)
+        left = (positions // width) % 2 == 0
+
+        # the left halves sorted by block and value, the right elements search their block for larger values
+        keys = block * n + values
+        order = np.argsort(keys[left], kind='stable')
+        left_keys = keys[left][order]
+        left_positions = positions[left][order]
+
+        right = positions[~left]
+        start = np.searchsorted(left_keys, keys[right], side='right')
+        stop = np.searchsorted(left_keys, (block[right] + 1) * n, side='left')
+        counts = stop - start
+
+        total = counts.sum()
+        if total > 0:
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            found_i.append(left_positions[np.repeat(start, counts) + offsets])
+            found_j.append(np.repeat(right, counts))
+        width *= 2
+
+    return np.concatenate(found_i), np.concatenate(found_j)
+
+
+def _crossing_candidates(segment: np.array):
+    """
+    Finds the pairs of rays that may cross within a segment, a superset of the crossings of TracedRays.ray_crossings.
+    The lines of two rays can only cross within the extent of the segment along its main direction if their order
+    across this direction differs at both ends of the extent, i.e. the pairs are the inversions between the orders
+    at both ends. Rays almost perpendicular to the main direction are paired with all rays.
+    Args:
+        segment: (numpy.array) start and end point of each ray with shape (n, 2, 2)
+
+    Returns:
+        first, second (numpy.array, numpy.array) indices of the pairs with first < second, ordered like
+        numpy.triu_indices
+    """
+    n = segment.shape[0]
+    start, v = segment[:, 0, :], segment[:, 1, :] - segment[:, 0, :]
+
+    # rays with NaN never cross
+    finite = np.isfinite(segment).all(axis=(1, 2))
+    valid = ~np.isnan(segment).any(axis=(1, 2))
+
+    # main direction of the segment
+    length = np.hypot(v[:, 0], v[:, 1])
+    usable = finite & (length > 0.)
+    directions = v[usable] / length[usable, None]
+    u = np.linalg.eigh(directions.T @ directions)[1][:, -1] if directions.shape[0] > 0 else np.array([1., 0.])
+    w = np.array([-u[1], u[0]])
+
+    along = v @ u
+    regular = usable & (np.abs(along) > 1e-9 * length)
+
+    indices = np.flatnonzero(regular)
+    first, second = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if indices.size > 1:
+        t = segment[indices] @ u
+        lo, hi = t.min(), t.max()
+        margin = 0.01 * (hi - lo) + 1e-9 * max(abs(lo), abs(hi), 1.)
+
+        # order of the lines across the main direction at both ends of the extent
+        slope = (v[indices] @ w) / along[indices]
+        offset = start[indices] @ w - t[:, 0] * slope
+        ranks = [np.unique(offset + slope * end, return_inverse=True)[1] for end in (lo - margin, hi + margin)]
+        order = np.lexsort((ranks[1], ranks[0]))
+        i, j = _inversions(ranks[1][order])
+        first, second = indices[order[i]], indices[order[j]]
+
+    # irregular rays with all other rays
+    irregular = np.flatnonzero(valid & ~regular)
+    others = np.flatnonzero(valid)
+    if irregular.size > 0:
+        first = np.concatenate([first, np.repeat(irregular, others.size)])
+        second = np.concatenate([second, np.tile(others, irregular.size)])
+
+    first, second = np.minimum(first, second), np.maximum(first, second)
+    pairs = np.unique((first * n + second)[first != second])
+    return pairs // n, pairs % n
+
+
+def _crossing_points(segment: np.array, first: np.array, second: np.array):
+    """
+    Calculates where the line of the second ray crosses the segment of the first ray
+    Args:
+        segment: (numpy.array) start and end point of each ray with shape (n, 2, 2)
+        first: (numpy.array) indices of the first rays
+        second: (numpy.array) indices of the second rays
+
+    Returns:
+        points, crossing (numpy.array, numpy.array) crossing points with shape (pairs, 2) and if the pair crosses
+    """
+    r = np.stack([segment[first], segment[second]], axis=1)
+    v = r[:, :, 1] - r[:, :, 0]
+    p = r[:, 1, 0] - r[:, 0, 0]
+
+    # calculates lambda
+    with np.errstate(divide='ignore', invalid='ignore'):
+        l = (v[:, 1, 0] * p[:, 1] - v[:, 1, 1] * p[:, 0]) / (v[:, 0, 1] * v[:, 1, 0] - v[:, 0, 0] * v[:, 1, 1])
+        points = l[:, None] * v[:, 0, :] + r[:, 0, 0]
+
+    crossing = (l < 1) & (l > 0)
+    return points, crossing
+
+
 class TracedRays:
 
     @staticmethod
     def from_rays(rays: Rays):
-        return TracedRays(rays.complete_array(), rays.properties_array.copy())
-
-    def __init__(self, array: np.array, properties_array: np.array):
+        # a view of the history, which the rays copy before tracing on (see Rays.complete_array)
+        array = rays.complete_array()
+        parents = np.full(array.shape[0], -1, dtype=np.int64)
+        final_parents = rays._final(rays.parents, 2, -1)
+        parents[:final_parents.shape[0]] = final_parents
+        return TracedRays(array, rays.final_array()[:, 4:].copy(), parents)
+
+    def __init__(self, array: np.array, properties_array: np.array, parents: np.array = None):
+        """
+        Interprets the passed array as the history of rays. For an out-of-core history (see MemmapHistory) only
+        indexing and chunks read parts of it, the properties x, y, tan_theta and points read the complete history
+        into memory.
+        Args:
+            array: (numpy.array, HistoryArray) three dimensional with shape of (n, states, 3) with x, y and the
+                    propagation angle
+            properties_array: (numpy.array) two dimensional with shape of (n, 2) with group and wavelength
+            parents: (numpy.array, optional) index of the ray each ray was replicated from, -1 if it is not a
+                    replication. The history of a replicated ray is NaN before its replication.
+        """
         self.array = array
         self.properties_array = properties_array
+        if parents is None:
+            parents = np.full(array.shape[0], -1, dtype=np.int64)
+        self.parents = parents
 
     @property
     def n(self):
@@ -129,56 +761,127 @@ class TracedRays:
 
     def __getitem__(self, item):
         ix, iy = item
+
+        # map the parents to the selected rays
+        selected = np.arange(self.n)[ix]
+        index = np.full(self.n + 1, -1, dtype=np.int64)
+        index[selected] = np.arange(np.size(selected))
+        parents = index[self.parents[selected]]
+
         return TracedRays(self.array[ix, iy, :],
-                          self.properties_array[ix, :])
+                          self.properties_array[ix, :],
+                          parents)
+
+    def chunks(self, chunk_size: int = None):
+        """
+        Iterates over the traced rays in consecutive chunks, each chunk is read into memory on its own. Parents
+        outside of a chunk are -1 in the chunk.
+        Args:
+            chunk_size: (int, optional) number of rays per chunk, by default the chunk size of an out-of-core history
+                    or all rays at once
+        Returns:
+            (generator[TracedRays]) chunks of the traced rays
+        """
+        if chunk_size is None:
+            chunk_size = getattr(self.array, 'chunk_size', max(self.n, 1))
+
+        for i in range(0, self.n, chunk_size):
+            yield self[i:i + chunk_size, :]
+
+    def with_shared_prefix(self):
+        """
+        Returns the traced rays where the history before the replication of a ray is filled in from its parent. The
+        complete history is copied into memory, also for an out-of-core history.
+        Returns:
+            (TracedRays) traced rays with the complete history of each ray
+        """
 
-    def ray_crossings(self, element=None):
+        array = self.array.copy()
+        replicated = np.flatnonzero(self.parents >= 0)
+
+        # fill the leading states that are NaN, repeated for rays replicated from replicated rays
+        while replicated.size > 0:
+            missing = np.cumsum(~np.isnan(array[replicated, :, 0]), axis=1) == 0
+            prefix = array[self.parents[replicated], :, :]
+            filled = missing & ~np.isnan(prefix[:, :, 0])
+            if not filled.any():
+                break
+            array[replicated, :, :] = np.where(filled[:, :, None], prefix, array[replicated, :, :])
+
+        return TracedRays(array, self.properties_array, np.full(self.n, -1, dtype=np.int64))
+
+    def ray_crossings(self, element=None, shared_prefix: bool = False, only_crossing: bool = False):
         """
         Calculate all crossings of the rays and returns the crossings and the properties of the two involved rays
         crossings (n_elements - 1,
+        A crossing of two rays is where the line of the second ray crosses the segment of the first ray between two
+        states. Only the candidate pairs whose lines swap their order within a segment are tested (see
+        _crossing_candidates), instead of all pairs of rays.
         Args:
             element: (int, optional) element
+            shared_prefix: (bool, optional) if replicated rays should cross with the history of their parent before
+                    the replication
+            only_crossing: (bool, optional) if only the pairs crossing in at least one segment are returned, such
+                    that the memory is proportional to the number of crossings instead of the number of pairs. By
+                    default all pairs in the order of numpy.triu_indices are returned, NaN where they do not cross.
+                    The dense result has 2 * 8 bytes per pair and segment, about 200 MB per segment for 5000 rays,
+                    use only_crossing=True for large numbers of rays.
+        The positions are read one segment of two states at a time, also for an out-of-core history.
         Returns:
             crossings, properties1, properties2 (np.array, np.array, np.array)
         """
 
+        if shared_prefix:
+            return self.with_shared_prefix().ray_crossings(element, only_crossing=only_crossing)
+
         if element is not None:
-            i_valid = np.any(~np.isnan(self.points[:, element, :]), axis=1)
-            array = self.array[i_valid, :, :2]
+            i_valid = np.any(~np.isnan(self.array[:, element, :2]), axis=1)
             properties_array = self.properties_array[i_valid, :]
         else:
-            array = self.array[:, :, :2]
+            i_valid = slice(None)
             properties_array = self.properties_array
 
-        d = np.transpose(
-            rolling_window(
-                np.transpose(array, axes=(1, 0, 2)), 2),
-            axes=(0, 1, 3, 2)
-        )
-
-        # indices for all possible pairs
-        i_triu = np.transpose(np.triu_indices(d.shape[1], 1))
-
-        r = d[:, i_triu, :]
-        v = r[:, :, :, 1] - r[:, :, :, 0]
-        p = r[:, :, 1, 0] - r[:, :, 0, 0]
-
-        # calculates lambda
-        l = (v[:, :, 1, 0] * p[:, :, 1] - v[:, :, 1, 1] * p[:, :, 0]) / (
-                v[:, :, 0, 1] * v[:, :, 1, 0] - v[:, :, 0, 0] * v[:, :, 1, 1])
-
-        I = (l < 1) & (l > 0)  # | (np.arange(d.shape[0])[:, None] >= d.shape[0]-2)
-        l[~I] = np.nan
-
-        k = np.ones_like(l)
-        k[~I] = np.nan
+        n = properties_array.shape[0]
+        segments = []
+        for s in range(self.array.shape[1] - 1):
+            segment = np.ascontiguousarray(self.array[i_valid, s:s + 2, :2])
+            first, second = _crossing_candidates(segment)
+            points, crossing = _crossing_points(segment, first, second)
+            segments.append((first[crossing], second[crossing], points[crossing]))
+
+        # row of each pair (first, second) in the order of numpy.triu_indices(n, 1)
+        def rows(first, second):
+            return first * (2 * n - first - 1) // 2 + (second - first - 1)
+
+        if only_crossing:
+            first = np.concatenate([f for f, _, _ in segments] + [np.empty(0, dtype=np.int64)])
+            second = np.concatenate([t for _, t, _ in segments] + [np.empty(0, dtype=np.int64)])
+            pairs, unique = np.unique(rows(first, second), return_index=True)
+            first, second = first[unique], second[unique]
+        else:
+            pairs = None
+            first, second = np.triu_indices(n, 1)
 
-        crossings = l[:, :, None] * v[:, :, 0, :] + r[:, :, 0, 0] * k[:, :, None]
-        crossings = np.transpose(crossings, (1, 0, 2))
+        crossings = np.full((first.shape[0], len(segments), 2), np.nan, dtype=self.array.dtype)
+        for s, (f, t, points) in enumerate(segments):
+            index = rows(f, t)
+            if pairs is not None:
+                index = np.searchsorted(pairs, index)
+            crossings[index, s, :] = points
 
-        return crossings, properties_array[i_triu[:, 0], :], properties_array[i_triu[:, 1], :]
+        return crossings, properties_array[first, :], properties_array[second, :]
 
     def plot(self, ax: Axes, **kwargs):
+        """
+        Plots the traced rays into the passed matplotlib axes. The positions of all rays are read into memory, also
+        for an out-of-core history, plot the chunks separately to limit the memory.
+        Args:
+            ax: (Axes) the axes to plot the rays into
+            **kwargs: properties of the lines, overriding plotting.ray_properties
+
+        Returns:
+            (list) plotted lines
+        """
 
         props = plotting.ray_properties.copy()
         props.update(kwargs)
@@ -186,29 +889,30 @@ class TracedRays:
         self.wavelength[np.isnan(self.wavelength)] = 0.
         self.group[np.isnan(self.group)] = 0.
 
-        plt_groups = np.unique(self.properties_array, axis=0)
+        table = PropertyTable(self.properties_array)
+        keys, members = table.members()
+        n_wavelengths = table.wavelengths.shape[0]
+        plt_groups = np.stack([table.groups[keys // n_wavelengths], table.wavelengths[keys % n_wavelengths]], axis=1)
 
         if len(plt_groups) > 1:
             lines = list()
             if (plt_groups[:, 1] == 0.).all():
                 prop_cycle = iter(rcParams['axes.prop_cycle'])
-                for plt_props in plt_groups:
+                for i in members:
                     group_props = props.copy()
                     group_props.update({'color': next(prop_cycle)['color']})
-                    i = (self.properties_array == plt_props).all(axis=1)
                     lines += ax.plot(self.x[i, :].T, self.y[i, :].T, **group_props)
 
             else:
                 prop_cycle = iter(cycle(['-', '--', '-.', ':']))
                 g_map = {g: next(prop_cycle) for g in np.unique(plt_groups[:, 0])}
                 linestyles = list(map(lambda g: g_map[g], plt_groups[:, 0]))
-                for i, plt_props in enumerate(plt_groups):
-                    _, w = plt_props
+                for j, i in enumerate(members):
+                    w = plt_groups[j, 1]
                     group_props = props.copy()
                     if w != 0:
                         group_props.update({'color': wavelength_to_rgb(w)})
-                    group_props.update({'linestyle': linestyles[i]})
-                    i = (self.properties_array == plt_props).all(axis=1)
+                    group_props.update({'linestyle': linestyles[j]})
                     lines += ax.plot(self.x[i, :].T, self.y[i, :].T, **group_props)
 
         elif len(plt_groups) > 0:
@@ -247,26 +951,29 @@ class RayCrossings1D:
     group_to = _view_property(slice(None), 0, attr='properties_to')
     wavelength_to = _view_property(slice(None), 1, attr='properties_to')
 
+    def _property_ids(self):
+        table = PropertyTable(np.concatenate([self.properties_from, self.properties_to]))
+        n = self.properties_from.shape[0]
+        return (table.valid[:n], table.group_ids[:n], table.group_ids[n:],
+                table.wavelength_ids[:n], table.wavelength_ids[n:])
+
     def image_crossings(self):
-        i = np.zeros_like(self.wavelength_to).astype(bool)
-        for g, w in np.unique(self.properties_from, axis=0):
-            i |= ((self.wavelength_from == w) & (self.wavelength_to == w) & (self.group_from == g) & (
-                    self.group_to == g))
+        valid, group_from, group_to, wavelength_from, wavelength_to = self._property_ids()
+        i = valid & (wavelength_from == wavelength_to) & (group_from == group_to)
         return self[i]
 
     def color_crossings(self):
-        i = np.zeros_like(self.wavelength_to).astype(bool)
-        for g, w in np.unique(self.properties_from, axis=0):
-            i |= ((self.wavelength_from == w) & (self.wavelength_to == w) & (self.group_from == g) & (
-                    self.group_to != g))
+        valid, group_from, group_to, wavelength_from, wavelength_to = self._property_ids()
+        i = valid & (wavelength_from == wavelength_to) & (group_from != group_to)
         return self[i]
 
 
 class RayCrossings(RayCrossings1D):
 
     @staticmethod
-    def from_traced_rays(traced_rays: TracedRays, element=None):
-        return RayCrossings(*traced_rays.ray_crossings(element))
+    def from_traced_rays(traced_rays: TracedRays, element=None, shared_prefix: bool = False,
+                         only_crossing: bool = False):
+        return RayCrossings(*traced_rays.ray_crossings(element, shared_prefix, only_crossing))
 
     def before(self, element: int):
         return RayCrossings1D(self.array[:, element, :], self.properties_from, self.properties_to)
@@ -292,38 +999,111 @@ class RayCrossings(RayCrossings1D):
     points = _view_property(slice(None), slice(None), slice(0, 2))
 
 
-def propagate(rays: Rays, x: float):
+def propagate(rays: Rays, x: float, workspace: Workspace = None):
     """
     Propagates the rays in free space up to the x
     Args:
         rays: (Rays) rays to propagate
-        x: (float) x-coordinate of the plane up to which the rays should propagate
+        x: (float, numpy.array) x-coordinate of the plane up to which the rays should propagate, or one per ray
+        workspace: (Workspace, optional) scratch buffers
 
     Returns:
         (Rays) propagated rays
 
     """
 
-    dx = x - rays.x
+    if kernels.propagate(rays, x):
+        return rays
+
+    if workspace is None:
+        workspace = Workspace()
+
+    dx = workspace.get('propagate_dx', rays.n, rays.dtype)
+    dy = workspace.get('propagate_dy', rays.n, rays.dtype)
+    backwards = workspace.get('propagate_backwards', rays.n, bool)
+    forward = workspace.get('propagate_forward', rays.n, bool)
 
-    rays.y = rays.y + rays.tan_theta * dx
+    np.subtract(x, rays.x, out=dx)
+
+    np.multiply(rays.tan_theta, dx, out=dy)
+    np.add(rays.y, dy, out=rays.y)
     rays.x = x
 
     # block rays travelling in the opposite direction
-    dx[np.isnan(dx)] = 0.
-    rays.y[np.logical_xor(dx > 0, rays.forward > 0)] = np.nan
+    np.greater(dx, 0., out=backwards)
+    np.greater(rays.forward, 0., out=forward)
+    np.logical_xor(backwards, forward, out=backwards)
+    np.copyto(rays.y, np.nan, where=backwards)
+
+    np.logical_not(backwards, out=backwards)
+    np.logical_and(rays.alive, backwards, out=rays.alive)
 
     return rays
 
 
-def point_source_rays(origin=(0., 0.), angle=(-50., 50.), n: int = 9, group: int = None):
+# a group is a random prefix drawn once per process and floating point type, followed by a counter of the groups
+# created by the process. Groups of different processes or sessions, e.g. of persisted histories or of rays created
+# in workers and merged, only collide if their prefixes are equal, i.e. with a probability of 2 ** -prefix_bits per
+# pair of processes: 2 ** -33 for numpy.float64 but 2 ** -4 for numpy.float32.
+_GROUP_COUNTER_BITS = 20
+_group_lock = threading.Lock()
+# per floating point type the used prefixes, the current prefix and the next counter
+_group_registries = {}
+
+
+def _reset_groups():
+    # a forked process draws its own prefixes instead of continuing the counters of its parent
+    global _group_lock
+    _group_lock = threading.Lock()
+    _group_registries.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_groups)
+
+
+def new_group(dtype=np.float64) -> int:
+    """
+    Returns a new identifier for grouping rays, unique within the running process and, up to the probability of
+    equal random prefixes, between processes. The identifier is exact in the floating point type, i.e. it is smaller
+    than 2 ** (mantissa bits + 1).
+    Args:
+        dtype: (numpy.dtype, optional) floating point type of the rays the group is assigned to
+
+    Returns:
+        (int) group identifier
+    """
+    dtype = np.dtype(dtype)
+    prefix_bits = np.finfo(dtype).nmant + 1 - _GROUP_COUNTER_BITS
+    if prefix_bits < 1:
+        raise ValueError('{} is too narrow for groups of {} bits'.format(dtype, _GROUP_COUNTER_BITS))
+
+    with _group_lock:
+        prefixes, prefix, counter = _group_registries.get(dtype, (set(), None, 2 ** _GROUP_COUNTER_BITS))
+        if counter == 2 ** _GROUP_COUNTER_BITS:
+            if len(prefixes) == 2 ** prefix_bits:
+                raise ValueError('all groups of {} are used'.format(dtype))
+            prefix = secrets.randbits(prefix_bits)
+            while prefix in prefixes:
+                prefix = secrets.randbits(prefix_bits)
+            prefixes.add(prefix)
+            # group 0 is left for rays without group
+            counter = 1
+
+        _group_registries[dtype] = (prefixes, prefix, counter + 1)
+
+    return (prefix << _GROUP_COUNTER_BITS) | counter
+
+
+def point_source_rays(origin=(0., 0.), angle=(-50., 50.), n: int = 9, group: int = None, dtype=np.float64):
     """
     Creates a number of rays from a point source between the specified emission angles
     Args:
         origin: (list, numpy.array of 2 floats) position of the point source
         angle: (list, numpy.array of 2 floats) emission angle
         n: (int) number of rays
-        group: (int, None) identifier used for grouping the rays
+        group: (int, None) identifier used for grouping the rays, a new one from new_group() if None
+        dtype: (numpy.dtype, optional) floating point type of the rays (see Rays)
 
     Returns:
         (Rays) the created rays
@@ -332,7 +1112,7 @@ def point_source_rays(origin=(0., 0.), angle=(-50., 50.), n: int = 9, group: int
     origin = np.array(origin)
 
     da = (max(angle) - min(angle)) / float(n - 1)
-    rays = Rays(np.zeros((n, 4)))
+    rays = Rays(np.zeros((n, 4), dtype=dtype))
     rays.points = origin[None, :]
     angle = np.arange(0, n) * da + min(angle)
     rays.tan_theta = np.tan(angle * np.pi / 180.)
@@ -341,8 +1121,12 @@ def point_source_rays(origin=(0., 0.), angle=(-50., 50.), n: int = 9, group: int
     rays.forward = ((angle < 90.) | (angle > 270.)).astype(float)
 
     if group is None:
-        group = uuid.uuid1().int >> 64
+        group = new_group(rays.dtype)
 
-    rays.group = np.array(group).view(dtype=np.float)
+    # the integer group has to be exact within the mantissa of the floating point type
+    if not 0 <= group < 2 ** (np.finfo(rays.dtype).nmant + 1):
+        raise ValueError('group {} cannot be represented exactly as {}, pass a smaller group'.format(
+            group, rays.dtype))
+    rays.group = group
 
     return rays
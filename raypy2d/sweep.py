@@ -0,0 +1,189 @@
+import numpy as np
+from typing import Callable, Iterable, List, Union, TYPE_CHECKING
+
+from .rays import propagate, Rays
+from .utils import assure_number_of_columns, Workspace
+
+if TYPE_CHECKING:
+    from .elements import Element
+    from .paths import OpticalPath
+
+
+class UnsupportedStepError(ValueError):
+    """
+    A step of the configurations cannot be swept, e.g. an element with its own trace or different kinds of elements
+    at the same position
+    """
+
+
+def _stack(elements: List['Element']):
+    """
+    Collects the parameters of elements of the same class, the parameters differing between the elements are
+    stacked into arrays with the elements along the last axis, e.g. the origin with shape (2, len(elements)).
+    Args:
+        elements: (list[Element]) elements of the configurations
+
+    Returns:
+        constants, stacked (dict, dict) attributes shared by all elements and the stacked attributes
+    """
+    constants, stacked = {}, {}
+    for name, value in vars(elements[0]).items():
+        values = [vars(element).get(name) for element in elements]
+        if name == '_revision' or all(np.array_equal(v, value) for v in values[1:]):
+            constants[name] = value
+            continue
+
+        numeric = isinstance(value, (np.ndarray, np.generic, int, float))
+        try:
+            values = np.array(values) if numeric else None
+        except ValueError:
+            values = None
+        if values is None or values.dtype.kind not in 'biuf' or values.shape[1:] != np.shape(value):
+            raise UnsupportedStepError('the attribute {} of the elements differs and cannot be '
+                                       'swept'.format(name))
+        stacked[name] = np.moveaxis(values, 0, -1)
+
+    return constants, stacked
+
+
+def _element(cls: type, constants: dict, stacked: dict, start: int, stop: int, n: int) -> 'Element':
+    """
+    Creates an element of the class whose stacked parameters are arrays with one entry per ray of the configurations
+    [start, stop), see _stack. The element methods broadcast these parameters, such that the element traces the rays
+    of all configurations at once.
+    """
+    element = object.__new__(cls)
+    element.__dict__.update(constants)
+    for name, values in stacked.items():
+        element.__dict__[name] = np.repeat(values[..., start:stop], n, axis=-1)
+    return element
+
+
+class Sweep:
+
+    def __init__(self, configurations: Iterable[Union['OpticalPath', List[Union['Element', float]]]]):
+        """
+        Parameter sweep over configurations of an optical path with the same structure, i.e. the same kind of step
+        at each position, e.g. a grating at different angles or a lens at different distances. All configurations
+        are traced at once as a (configurations, rays) batch: the elements of each step are traced by one element of
+        their class whose parameters are arrays with one entry per ray, so the vectorized kernels of the elements
+        and rays.propagate are applied once to the whole batch. Supported are propagations and elements of the same
+        class per step that use the generic trace of Element, e.g. lenses, mirrors, apertures and gratings.
+        Args:
+            configurations: (iterable[OpticalPath, list[Element, float]]) paths or their steps, e.g. created without
+                    tracing by a function of the swept parameter (see from_function)
+        """
+        from .elements import Element
+
+        configurations = [list(getattr(c, 'steps', c)) for c in configurations]
+        if len(configurations) == 0:
+            raise UnsupportedStepError('at least one configuration is required')
+        m = len(configurations[0])
+        if any(len(steps) != m for steps in configurations):
+            raise UnsupportedStepError('all configurations need the same number of steps')
+
+        self.n_configurations = len(configurations)
+        self.wavelengths = None
+
+        # the steps of all configurations at each position, either propagation distances or the class and the
+        # stacked parameters of the elements
+        self.steps = []
+        for j in range(m):
+            column = [steps[j] for steps in configurations]
+            if all(np.isscalar(step) for step in column):
+                self.steps.append(np.array(column, dtype=float))
+                continue
+
+            # propagations mixed with elements or other steps, e.g. loops, are not supported
+            cls = type(column[0])
+            if not (issubclass(cls, Element) and cls.trace is Element.trace and
+                    all(type(step) is cls for step in column)):
+                raise UnsupportedStepError('step {} cannot be swept, its elements have to be of the same class with '
+                                           'the trace of Element'.format(j))
+
+            # rays without wavelength are replicated before tracing, as the first grating would do
+            if self.wavelengths is None and hasattr(column[0], 'default_wavelengths'):
+                self.wavelengths = list(column[0].default_wavelengths)
+
+            self.steps.append((cls,) + _stack(column))
+
+    @classmethod
+    def from_function(cls, build: Callable, values: Iterable):
+        """
+        Creates the sweep of the configurations built by a function of the swept value
+        Args:
+            build: (callable) function returning the steps (or a path) for a value, the elements should only be
+                    created and placed, not traced
+            values: (iterable) swept values
+
+        Returns:
+            (Sweep) sweep with one configuration per value
+        """
+        return cls(build(value) for value in values)
+
+    def _trace_batch(self, rays: Rays, start: int, stop: int, workspace: Workspace) -> Rays:
+        n = rays.n // (stop - start)
+        for step in self.steps:
+            if isinstance(step, np.ndarray):
+                rays = propagate(rays, np.repeat(step[start:stop], n), workspace)
+            else:
+                rays = _element(*step, start, stop, n).trace(rays, workspace)
+        return rays
+
+    def trace_arrays(self, source: Union[Rays, np.array], chunk_size: int = 2 ** 14):
+        """
+        Traces the rays through all configurations at once, see trace
+        Args:
+            source: (Rays, numpy.array) rays entering every configuration, they are not changed
+            chunk_size: (int, optional) number of rays of the configurations traced together
+
+        Returns:
+            batch, alive, parents (numpy.array) rays with shape (configurations, rays, 6), mask of the not blocked
+            rays with shape (configurations, rays) and the parent of each ray (see Rays.parents)
+        """
+        array = assure_number_of_columns(source.array if isinstance(source, Rays) else source, 6)
+        rays = Rays(np.array(array), keep_history=False)
+        if isinstance(source, Rays):
+            rays.alive = source.alive
+            rays.parents[:] = source.parents
+        if self.wavelengths is not None:
+            rays.replicate_wavelengths(np.isnan(rays.wavelength), self.wavelengths)
+
+        k, n = self.n_configurations, rays.n
+        batch = np.repeat(rays.array[None, :, :], k, axis=0)
+        alive = np.repeat(rays.alive[None, :], k, axis=0)
+
+        # the configurations are consecutive blocks of rays of one batch of rays
+        traced = Rays(batch.reshape((k * n, -1)), keep_history=False)
+        traced.alive = alive.reshape(-1)
+
+        workspace = Workspace()
+        configurations = max(1, chunk_size // n)
+        for start in range(0, k, configurations):
+            stop = min(start + configurations, k)
+            self._trace_batch(traced.block(start * n, stop * n), start, stop, workspace)
+
+        return batch, traced.alive.reshape((k, n)), rays.parents
+
+    def trace(self, source: Union[Rays, np.array], chunk_size: int = 2 ** 14) -> List[Rays]:
+        """
+        Traces the rays through all configurations at once. Rays without wavelength are replicated with the default
+        wavelengths of the first grating before tracing, as a grating of each configuration would do.
+        Args:
+            source: (Rays, numpy.array) rays entering every configuration, they are not changed
+            chunk_size: (int, optional) number of rays of the configurations traced together, such that the
+                    intermediate arrays of a step stay in the cache
+
+        Returns:
+            (list[Rays]) the traced rays of each configuration, views into one batch of rays without history
+        """
+        batch, alive, parents = self.trace_arrays(source, chunk_size)
+        k, n = alive.shape
+
+        traced = Rays(batch.reshape((k * n, -1)), keep_history=False)
+        traced.alive = alive.reshape(-1)
+
+        blocks = [traced.block(i * n, (i + 1) * n) for i in range(k)]
+        for block in blocks:
+            block.parents[:] = parents
+        return blocks
@@ -0,0 +1,224 @@
+import copy
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union, TYPE_CHECKING
+
+from .elements import Element, MultiElement
+from .rays import Rays, propagate
+from .sweep import Sweep, UnsupportedStepError
+from .utils import rotation_matrix
+
+if TYPE_CHECKING:
+    from .paths import OpticalPath
+
+
+class Perturbation:
+
+    def __init__(self, element: 'Element', dx=0., dy=0., theta=0., f=0.):
+        """
+        Random perturbation of the position, tilt and focal length of an element. Each deviation is either the
+        standard deviation of a normal distribution or a function (rng, size) -> samples, e.g.
+        lambda rng, size: rng.uniform(-0.1, 0.1, size).
+        Args:
+            element: (Element) perturbed element of the path
+            dx: (float, callable, optional) deviation of the x-coordinate of the origin
+            dy: (float, callable, optional) deviation of the y-coordinate of the origin
+            theta: (float, callable, optional) deviation of the rotation angle in degrees
+            f: (float, callable, optional) deviation of the focal length, only for elements with focal length
+        """
+        self.element = element
+        self.deviations = {'dx': dx, 'dy': dy, 'theta': theta, 'f': f}
+
+    def sample(self, rng: np.random.Generator, size: int) -> dict:
+        """
+        Draws the deviations of a number of trials
+        Args:
+            rng: (numpy.random.Generator) random number generator
+            size: (int) number of trials
+
+        Returns:
+            (dict) array of the deviations of each parameter
+        """
+        samples = {}
+        for name, deviation in self.deviations.items():
+            if callable(deviation):
+                samples[name] = np.asarray(deviation(rng, size), dtype=float)
+            elif deviation != 0.:
+                samples[name] = rng.normal(0., deviation, size)
+        return samples
+
+    def apply(self, samples: dict, i: int) -> 'Element':
+        """
+        Returns a perturbed copy of the element for one trial. The parts of an element consisting of several
+        elements, e.g. the second interface of a prism, are copied as well and moved and rotated with it.
+        Args:
+            samples: (dict) deviations drawn by sample
+            i: (int) index of the trial
+
+        Returns:
+            (Element) the perturbed copy
+        """
+        element = copy.deepcopy(self.element)
+        parts = element.elements() if isinstance(element, MultiElement) else [element]
+
+        if 'theta' in samples:
+            # rigid rotation of all parts around the origin of the element
+            theta = samples['theta'][i]
+            rotation = rotation_matrix(theta)
+            for part in parts:
+                part.origin = element.origin + np.dot(part.origin - element.origin, rotation.T)
+                part.theta = part.theta + theta
+        if 'dx' in samples or 'dy' in samples:
+            shift = np.array([samples['dx'][i] if 'dx' in samples else 0., samples['dy'][i] if 'dy' in samples else 0.])
+            for part in parts:
+                part.origin = part.origin + shift
+        if 'f' in samples:
+            element.f = element.f + samples['f'][i]
+        return element
+
+
+def _trace_steps(rays: Rays, steps: list) -> Rays:
+    for step in steps:
+        rays = propagate(rays, step) if np.isscalar(step) else step.trace(rays)
+    return rays
+
+
+class ToleranceAnalysis:
+
+    def __init__(self, steps: Union['OpticalPath', List[Union['Element', float]]], perturbations: List[Perturbation]):
+        """
+        Monte Carlo tolerance analysis of an optical path. Each trial perturbs the elements randomly, the trials are
+        traced in batches through the perturbed part of the path as one sweep (see Sweep), while the steps before
+        the first perturbed element are traced only once. Per trial the spot size, the shift of the centroid and
+        the throughput are evaluated in the frame of reference of the last element of the nominal path, e.g. a
+        sensor.
+        Args:
+            steps: (OpticalPath, list[Element, float]) path or its steps, the path is not changed
+            perturbations: (list[Perturbation]) perturbations of elements of the path
+        """
+        self.steps = list(getattr(steps, 'steps', steps))
+        self.perturbations = list(perturbations)
+
+        perturbed = [next((i for i, step in enumerate(self.steps) if step is p.element), None)
+                     for p in self.perturbations]
+        if None in perturbed:
+            raise ValueError('element is not part of the path')
+        if len(set(perturbed)) < len(perturbed):
+            raise ValueError('an element is perturbed more than once, combine its deviations in one Perturbation')
+        self.start = min(perturbed) if perturbed else len(self.steps)
+        self._perturbed = dict(zip(perturbed, self.perturbations))
+
+        # metrics of the nominal path for the source of the last analysis
+        self.nominal = None
+
+    def _metrics(self, batch: np.array, alive: np.array) -> dict:
+        # positions in the frame of reference of the last element of the nominal path
+        frame = next(step for step in reversed(self.steps) if not np.isscalar(step))
+        points = frame.points_to_object_frame_of_reference(batch[:, :, :2].reshape((-1, 2)))
+        y = np.where(alive, points[:, 1].reshape(alive.shape), np.nan)
+
+        counts = np.count_nonzero(alive, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroid = np.nansum(y, axis=1) / counts
+            spot_size = np.sqrt(np.nansum((y - centroid[:, None]) ** 2, axis=1) / counts)
+
+        return {'spot_size': spot_size, 'centroid': centroid, 'throughput': counts / alive.shape[1]}
+
+    def _prefix(self, source: Union[Rays, np.array]) -> Rays:
+        array = source.array if isinstance(source, Rays) else source
+        rays = Rays(np.array(array), keep_history=False)
+        if isinstance(source, Rays):
+            rays.alive = source.alive
+        return _trace_steps(rays, self.steps[:self.start])
+
+    def _trace_trials(self, rays: Rays, seed, trials: int, chunk_size: int) -> dict:
+        rng = np.random.default_rng(seed)
+        samples = {i: p.sample(rng, trials) for i, p in self._perturbed.items()}
+
+        configurations = [[self._perturbed[i].apply(samples[i], t) if i in self._perturbed else step
+                           for i, step in enumerate(self.steps[self.start:], self.start)] for t in range(trials)]
+        try:
+            batch, alive, _ = Sweep(configurations).trace_arrays(rays, chunk_size)
+        except UnsupportedStepError:
+            # steps that cannot be swept are traced trial by trial
+            traced = [_trace_steps(rays.copy(), steps) for steps in configurations]
+            batch = np.stack([t.array for t in traced])
+            alive = np.stack([t.alive for t in traced])
+
+        metrics = self._metrics(batch, alive)
+        for i, p in self._perturbed.items():
+            for name, values in samples[i].items():
+                metrics['{}_{}'.format(self.steps.index(p.element), name)] = values
+        return metrics
+
+    def stream(self, source: Union[Rays, np.array], trials: int, batch_size: int = 1000, seed: int = None,
+               processes: int = None, chunk_size: int = 2 ** 14):
+        """
+        Traces the trials batch by batch and yields the metrics of each batch, such that the memory is bounded by
+        the batch size. The trials of a batch are drawn from their own random stream, the results do not depend on
+        the number of processes.
+        Args:
+            source: (Rays, numpy.array) rays entering the path
+            trials: (int) number of trials
+            batch_size: (int, optional) number of trials traced at once
+            seed: (int, optional) seed of the random perturbations
+            processes: (int, optional) number of processes tracing batches concurrently, by default the batches are
+                    traced in the calling process, the path and the perturbations have to be picklable
+            chunk_size: (int, optional) number of rays traced together within a batch, see Sweep.trace
+
+        Returns:
+            (generator[dict]) per batch the arrays spot_size (RMS of the positions around the centroid), centroid,
+            centroid_shift (relative to the nominal path traced with the same source), throughput (fraction of not
+            blocked rays) and the drawn deviations as '<step>_<parameter>'
+        """
+        rays = self._prefix(source)
+        traced = _trace_steps(rays.copy(), self.steps[self.start:])
+        nominal = self.nominal = self._metrics(traced.array[None], traced.alive[None])
+
+        sizes = [min(batch_size, trials - start) for start in range(0, trials, batch_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+        def finish(metrics):
+            metrics['centroid_shift'] = metrics['centroid'] - nominal['centroid'][0]
+            return metrics
+
+        if processes is None:
+            for s, size in zip(seeds, sizes):
+                yield finish(self._trace_trials(rays, s, size, chunk_size))
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                for metrics in pool.map(self._trace_trials, [rays] * len(sizes), seeds, sizes,
+                                        [chunk_size] * len(sizes)):
+                    yield finish(metrics)
+
+    def run(self, source: Union[Rays, np.array], trials: int, **kwargs) -> dict:
+        """
+        Traces all trials and collects their metrics, see stream
+        Args:
+            source: (Rays, numpy.array) rays entering the path
+            trials: (int) number of trials
+            **kwargs: arguments passed to stream
+
+        Returns:
+            (dict) arrays of the metrics with one entry per trial
+        """
+        batches = list(self.stream(source, trials, **kwargs))
+        return {name: np.concatenate([b[name] for b in batches]) for name in batches[0]}
+
+
+def yield_fraction(metrics: dict, max_spot_size: float = np.inf, max_centroid_shift: float = np.inf,
+                   min_throughput: float = 0.) -> float:
+    """
+    Fraction of the trials of a tolerance analysis meeting the specification
+    Args:
+        metrics: (dict) metrics returned by ToleranceAnalysis.run
+        max_spot_size: (float, optional) maximal spot size
+        max_centroid_shift: (float, optional) maximal absolute shift of the centroid
+        min_throughput: (float, optional) minimal fraction of not blocked rays
+
+    Returns:
+        (float) the yield
+    """
+    passed = (metrics['spot_size'] <= max_spot_size) & (np.abs(metrics['centroid_shift']) <= max_centroid_shift) & \
+        (metrics['throughput'] >= min_throughput)
+    return float(np.mean(passed))
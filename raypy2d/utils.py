@@ -77,7 +77,7 @@ def assure_number_of_columns(array: np.array, n_columns: int):
     new_cols = n_columns - array.shape[1]
 
     if new_cols > 0:
-        array = np.hstack((array, np.zeros((array.shape[0], new_cols))))
+        array = np.hstack((array, np.zeros((array.shape[0], new_cols), dtype=np.result_type(array, np.float32))))
         array[:, -new_cols:] = np.nan
 
     return array
@@ -98,7 +98,7 @@ def assure_number_of_rows(array: np.array, n_rows: int):
     new_rows = n_rows - array.shape[0]
 
     if new_rows > 0:
-        array = np.vstack((array, np.zeros((new_rows, array.shape[1]))))
+        array = np.vstack((array, np.zeros((new_rows, array.shape[1]), dtype=np.result_type(array, np.float32))))
         array[-new_rows:, :] = np.nan
 
     return array
@@ -153,8 +153,66 @@ def place_relative_to(reference_element, element, distance, theta):
     offset += diff
     if isinstance(element, MultiElement):
         for e in element.elements():
-            e.origin += offset
+            e.origin = e.origin + offset
             e.theta += theta
     elif isinstance(element, Element):
-        element.origin += offset
+        element.origin = element.origin + offset
         element.theta += theta
+
+
+class Workspace:
+
+    def __init__(self):
+        """
+        Scratch buffers that are reused between the kernels of a trace. The kernels write their intermediate
+        results into these buffers (with out=) instead of allocating temporary arrays for every element.
+        """
+        self._buffers = {}
+
+    def get(self, name: str, n: int, dtype=float):
+        """
+        Returns a scratch buffer, the buffer is reallocated only if it is too small. The content is undefined.
+        Args:
+            name: (str) name of the buffer, kernels calling each other have to use distinct names
+            n: (int) number of entries
+            dtype: (numpy.dtype, optional) type of the entries
+
+        Returns:
+            (numpy.array) one dimensional buffer with n entries
+        """
+
+        key = (name, np.dtype(dtype))
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape[0] < n:
+            buffer = np.empty(n, dtype=dtype)
+            self._buffers[key] = buffer
+
+        return buffer[:n]
+
+
+def transform_columns(u: np.array, v: np.array, matrix: np.array, workspace: Workspace, where=True):
+    """
+    Multiplies the rows (u, v) with the 2x2 matrix from the right, the result is written back into u and v. The
+    products are added explicitly, the results can differ from numpy.dot in the last bits.
+    Args:
+        u: (numpy.array) first column
+        v: (numpy.array) second column
+        matrix: (numpy.array) 2x2 matrix, or with shape (2, 2, n) one matrix per row
+        workspace: (Workspace) scratch buffers
+        where: (numpy.array, optional) boolean mask of the rows to transform, the other rows are not changed
+    """
+
+    n = u.shape[0]
+    t0 = workspace.get('transform_columns_0', n, u.dtype)
+    t1 = workspace.get('transform_columns_1', n, u.dtype)
+    matrix = matrix.astype(u.dtype, copy=False)
+
+    np.multiply(u, matrix[0, 0], out=t0)
+    np.multiply(v, matrix[1, 0], out=t1)
+    np.add(t0, t1, out=t0)
+
+    np.multiply(u, matrix[0, 1], out=t1)
+    np.multiply(v, matrix[1, 1], out=v, where=where)
+    np.add(t1, v, out=v, where=where)
+
+    np.copyto(u, t0, where=where)
@@ -0,0 +1,143 @@
+import itertools
+import numpy as np
+from typing import List, Union, Iterable, TYPE_CHECKING
+
+from .rays import Rays, propagate
+from .utils import Workspace
+
+if TYPE_CHECKING:
+    from .elements import Element
+    from .paths import OpticalPath
+
+
+def _key(step):
+    # propagations are equal by their plane, elements only if they are the same object
+    return ('propagation', float(step)) if np.isscalar(step) else ('element', id(step))
+
+
+class VariantTree:
+
+    def __init__(self, variants: Iterable[Union['OpticalPath', List[Union['Element', float]]]] = ()):
+        """
+        Trie of the steps of many variants of an optical path, e.g. layouts that differ only in the last elements.
+        Tracing the tree traces every shared prefix once and copies the rays only where the variants diverge, so
+        the work scales with the number of distinct steps instead of variants times steps. Steps are shared if they
+        are the same element object or propagate to the same plane.
+        Args:
+            variants: (iterable[OpticalPath, list[Element, float]]) paths or their steps
+        """
+        # each node is a tuple of the step and its children by key, the root has no step
+        self._root = (None, {})
+        self._leaves = []
+
+        for variant in variants:
+            self.add(variant)
+
+    @classmethod
+    def from_alternatives(cls, stages: List[Union['Element', float, List[Union['Element', float]]]]):
+        """
+        Creates the tree of all combinations of alternative steps
+        Args:
+            stages: (list) steps in the order they are traced, a list of steps are alternatives of which every
+                    variant uses one
+
+        Returns:
+            (VariantTree) tree with one variant per combination, in the order of itertools.product
+        """
+        alternatives = [stage if isinstance(stage, (list, tuple)) else [stage] for stage in stages]
+        return cls(list(steps) for steps in itertools.product(*alternatives))
+
+    @property
+    def n_variants(self):
+        return len(self._leaves)
+
+    @property
+    def n_steps(self):
+        """
+        (int) number of distinct steps traced by trace, i.e. the number of nodes of the tree
+        """
+        count, nodes = 0, [self._root]
+        while nodes:
+            _, children = nodes.pop()
+            count += len(children)
+            nodes.extend(children.values())
+        return count
+
+    def add(self, variant: Union['OpticalPath', List[Union['Element', float]]]) -> int:
+        """
+        Adds a variant to the tree
+        Args:
+            variant: (OpticalPath, list[Element, float]) path or its steps
+
+        Returns:
+            (int) index of the variant in the traced results
+        """
+        steps = getattr(variant, 'steps', variant)
+
+        node = self._root
+        for step in steps:
+            node = node[1].setdefault(_key(step), (step, {}))
+        self._leaves.append(node)
+
+        return len(self._leaves) - 1
+
+    def trace(self, source: Union[Rays, np.array]) -> List[Rays]:
+        """
+        Traces rays through all variants depth first. The first branch of a node continues with the rays of the node
+        in place, the other branches are traced before on a copy, such that at most one copy per level of branching
+        is kept at a time.
+        Args:
+            source: (Rays, numpy.array) rays to trace, they are not changed
+
+        Returns:
+            (list[Rays]) the rays after the last step of each variant without history, variants with the same steps
+            share the same rays
+        """
+        array = source.array if isinstance(source, Rays) else source
+        rays = Rays(np.array(array), keep_history=False)
+        if isinstance(source, Rays):
+            rays.alive = source.alive
+
+        leaves = set(id(leaf) for leaf in self._leaves)
+        results = {}
+        workspace = Workspace()
+
+        # (node, rays entering the node, if the node needs its own copy of the rays)
+        stack = [(self._root, rays, False)]
+        while stack:
+            node, rays, copy = stack.pop()
+            if copy:
+                rays = rays.copy()
+                rays.keep_history = False
+
+            step, children = node
+            if step is None:
+                pass  # root
+            elif np.isscalar(step):
+                rays = propagate(rays, step, workspace)
+            else:
+                rays = step.trace(rays, workspace)
+
+            if id(node) in leaves:
+                # variants ending inside another variant keep the rays before the next steps change them
+                results[id(node)] = rays.copy() if len(children) > 0 else rays
+
+            # the first child is traced last, in place
+            for i, child in enumerate(children.values()):
+                stack.append((child, rays, i > 0))
+
+        return [results[id(leaf)] for leaf in self._leaves]
+
+
+def trace_variants(source: Union[Rays, np.array],
+                   variants: Iterable[Union['OpticalPath', List[Union['Element', float]]]]) -> List[Rays]:
+    """
+    Traces rays through many variants of an optical path, sharing the common prefixes, see VariantTree
+    Args:
+        source: (Rays, numpy.array) rays to trace, they are not changed
+        variants: (iterable[OpticalPath, list[Element, float]]) paths or their steps
+
+    Returns:
+        (list[Rays]) the rays after the last step of each variant
+    """
+    return VariantTree(variants).trace(source)
@@ -51,6 +51,7 @@ setup(
     include_package_data=True,
     author='Tobias Schoch',
     install_requires=install_requires,
+    extras_require={'numba': ['numba']},
     tests_require=['pytest'],
     dependency_links=dependency_links,
     author_email='tobias.schoch@vtxmail.ch'
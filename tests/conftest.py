@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from raypy2d.elements import Aperture, ParabolicMirror, DiffractionGrating, Lens, Sensor
+from raypy2d.paths import Object, OpticalPath
+
+
+def _demo_object(dtype=np.float64):
+    return Object(2.0, [-8., 0.], angle=[-20, 20], n=181, dtype=dtype)
+
+
+@pytest.fixture
+def demo_source():
+    """
+    rays emitted by the object of demo_path, e.g. to trace them again through the path
+    """
+    return _demo_object().rays.array.copy()
+
+
+def _demo_elements():
+    alpha = -5
+    vec = np.array([np.cos(alpha / 180. * np.pi), np.sin(alpha / 180. * np.pi)])
+    return [Aperture(0.2, [0.0, 0], blocker_diameter=20),
+            ParabolicMirror(40, 20., [32., 0], theta=155, flipped=True),
+            DiffractionGrating(1.0, 20., interference=1, theta=-10),
+            Aperture(13.75, theta=alpha, blocker_diameter=28),
+            Lens(28.0, 13.75, vec * 4, theta=alpha, flipped=False),
+            Sensor(5.58, 30 * vec, theta=alpha, flipped=True)]
+
+
+def _demo_path(elements=None, dtype=np.float64, **kwargs):
+    aperture, mirror, grating, stop, lens, sensor = _demo_elements() if elements is None else elements
+
+    path = OpticalPath(_demo_object(dtype), **kwargs)
+    path.append(aperture)
+    path.append(mirror)
+    path.append(grating, distance=20., theta=133)
+    path.append(stop, lens, sensor, distance=13., theta=85)
+
+    return path
+
+
+@pytest.fixture
+def demo_elements():
+    """
+    function creating the elements of demo_path, e.g. to change or tap them before they are traced by build_demo_path
+    """
+    return _demo_elements
+
+
+@pytest.fixture
+def build_demo_path():
+    """
+    function building the demo path with the keyword arguments of the OpticalPath, e.g. to compare paths traced with
+    different options, and optionally the elements of demo_elements
+    """
+    return _demo_path
+
+
+@pytest.fixture
+def demo_path(request):
+    """
+    demo path traced with the rays of an object, parametrise it indirectly with the keyword arguments of the
+    OpticalPath and the dtype of the rays, e.g. {'threads': 3, 'dtype': np.float32}
+    """
+    return _demo_path(**getattr(request, 'param', {}))
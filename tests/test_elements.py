@@ -58,6 +58,109 @@ def test_parabolic_mirror(path_with_parabolic_mirrors):
     plt.show()
 
 
+def test_element_properties():
+    mirror = ParabolicMirror(10., 8., [1., 2.], theta=30.)
+
+    assert np.allclose(mirror.matrix, [[1., 0.], [-0.1, -1.]])
+    assert np.isclose(mirror.x_blocker, 0.4)
+
+    mirror.f = 20.
+    mirror.diameter = 16.
+    assert np.allclose(mirror.matrix, [[1., 0.], [-0.05, -1.]])
+    assert np.isclose(mirror.x_blocker, 0.8)
+    assert mirror.aperture == 16.
+
+    mirror.theta = 90.
+    assert np.allclose(mirror.rotation, [[0., -1.], [1., 0.]])
+    assert np.allclose(mirror.points_to_global_frame_of_reference(np.array([[1., 0.]])), [[1., 3.]])
+    assert np.allclose(np.dot(mirror.transform, [1., 0., 1.]), [1., 3., 1.])
+
+    revision = mirror.revision
+    mirror.origin = mirror.origin + np.array([1., 0.])
+    assert np.allclose(mirror.points_to_object_frame_of_reference(np.array([[2., 3.]])), [[1., 0.]])
+    assert mirror.revision > revision
+
+    # the origin cannot be changed in place, which would not be a new revision
+    with pytest.raises(ValueError):
+        mirror.origin[0] += 1.
+    with pytest.raises(ValueError):
+        mirror.origin += np.array([1., 0.])
+
+    # attributes only used for plotting are not a new revision
+    revision = mirror.revision
+    mirror.flipped = True
+    mirror.draw_arcs = True
+    assert mirror.revision == revision
+
+
+def test_trace_with_workspace():
+    from raypy2d.rays import point_source_rays
+    from raypy2d.utils import Workspace
+
+    elements = [Lens(5, 16., [5., 1.], theta=30.),
+                Aperture(4, [7., 2.]),
+                ParabolicMirror(5., 8., [15., 3.], theta=155),
+                DiffractionGrating(1.6, 16., [10, 3.], theta=15.)]
+
+    workspace = Workspace()
+    rays = point_source_rays([0., 1.], angle=[-50, 50], n=21)
+    reference = point_source_rays([0., 1.], angle=[-50, 50], n=21)
+
+    for element in elements:
+        element.trace(rays, workspace)
+        element.trace(reference)
+
+    assert np.array_equal(rays.array[:, :4], reference.array[:, :4], equal_nan=True)
+
+    # the rays leaving the parabolic mirror as traced before the workspace was introduced. The results are not
+    # bit-identical: the frame transforms multiply and add the 2x2 products explicitly (see transform_columns)
+    # instead of np.dot, whose BLAS kernels may fuse them, so the rays agree to about 1e-12.
+    rays = point_source_rays([0., 1.], angle=[-50, 50], n=21)
+    for element in elements[:3]:
+        element.trace(rays, workspace)
+    expected = np.array([[13.297114660345612, 0.44084415910525854, -3.01470153459707, -0.5],
+                         [13.76691616169259, 0.9999999999999996, -2.4771476848141205, -0.5],
+                         [14.1516499394899, 1.52188275854484, -2.08164710418551, -0.5],
+                         [14.472510037531064, 2.015846608640929, -1.7748587641270912, -0.5],
+                         [14.744203905990265, 2.489933857237727, -1.5268977587103698, -0.5],
+                         [14.977113215443563, 2.9512621324092727, -1.319693998991751, -0.5],
+                         [15.178630531234035, 3.406375973568363, -1.1416464918641838, -0.5],
+                         [15.353995125812567, 3.8615712037287606, -0.9849298179540471, -0.5],
+                         [15.506809389477722, 4.323212493576046, -0.8440340751277089, -0.5]])
+    assert np.array_equal(np.flatnonzero(rays.alive), np.arange(9, 18))
+    assert np.allclose(rays.array[rays.alive, :4], expected, rtol=1e-12, atol=1e-12)
+
+    # the buffers are reused for the same number of rays
+    buffer = workspace.get('propagate_dx', rays.n)
+    assert np.shares_memory(buffer, workspace.get('propagate_dx', rays.n // 2))
+
+
+def test_parabolic_mirror_on_axis():
+    from raypy2d.rays import point_source_rays
+
+    # rays parallel to the axis hit the surface x = y^2 / (4 f) in the frame of the mirror, the same point as rays
+    # with an angle approaching zero
+    f = 10.
+    mirror = ParabolicMirror(f, 8., [0., 0.], theta=180.)
+
+    hits = []
+    for tan_theta in (0., 1e-12):
+        rays = point_source_rays([-20., 0.], angle=[0., 1.], n=8)
+        rays.y = np.linspace(-3.5, 3.5, 8)
+        rays.tan_theta = tan_theta
+        rays = mirror.trace(rays)
+        hits.append(mirror.points_to_object_frame_of_reference(rays.points))
+
+        # the rotation by 180 degrees keeps the slopes, the rays cross the axis at a distance f from the hit point
+        x, y = hits[-1].T
+        assert np.allclose(x - y / rays.tan_theta, x + f)
+
+    x, y = hits[0].T
+    assert np.allclose(x, y ** 2 / (4. * f))
+    assert np.allclose(np.sort(y), np.linspace(-3.5, 3.5, 8))
+    assert np.allclose(hits[0], hits[1], rtol=0., atol=1e-9)
+
+
 def test_diffraction_grating():
     """
     test the diffraction of rays on a grating
@@ -78,6 +181,13 @@ def test_diffraction_grating():
     assert np.isclose(theta_532, -31.8337)
     assert np.isclose(theta_532_2, -31.8337)
 
+    # evanescent orders are blocked on the grating, also without an aperture following it
+    path = OpticalPath(angle=[-60, 60], n=21)
+    path.append(DiffractionGrating(0.3, 15, origin=[10., 0]))
+    rays = path.rays
+    assert np.array_equal(rays.alive, np.isfinite(rays.tan_theta))
+    assert 0 < rays.alive.sum() < rays.n
+
     # path.append(Aperture(20.), distance=20., theta=theta_532)
     # ax = plt.gca()
     # ax.axis('equal')
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from raypy2d import kernels
+from raypy2d.elements import Aperture, Lens, ParabolicMirror, Mirror, DiffractionGrating, Element
+from raypy2d.paths import OpticalPath
+
+
+def _mirrors(**kwargs):
+    path = OpticalPath(angle=[-50, 50], n=41, **kwargs)
+    path.append(Lens(5, 16., [5., 1.], theta=30.))
+    path.append(Aperture(4, [7., 2.]))
+    path.append(Element(4, [7.5, 2.]))
+    path.append(ParabolicMirror(5., 8., [15., 3.], theta=155))
+    path.append(ParabolicMirror(5., 8., [9., 15.], theta=-45))
+    path.append(Mirror(8., [15., 3.], theta=160))
+    path.append(Lens(-4., 20., [0., 0.]))
+    path.propagate(15)
+    return path
+
+
+def _canonical(array):
+    # the sign of NaN is not defined by numpy
+    return np.where(np.isnan(array), np.nan, array).tobytes()
+
+
+def _assert_parity(rays, traced, expected, expected_traced):
+    columns = [0, 1, 2, 3, 5]
+    assert _canonical(rays.array[:, columns]) == _canonical(expected.array[:, columns])
+    assert np.array_equal(rays.alive, expected.alive)
+    assert _canonical(traced.array) == _canonical(expected_traced.array)
+
+
+def test_fused_kernels_parity(demo_path, demo_source, monkeypatch):
+    pytest.importorskip('numba')
+
+    expected = _mirrors().rays
+    monkeypatch.setattr(kernels, 'use_numba', True)
+    rays = _mirrors().rays
+    _assert_parity(rays, rays.traced_rays(), expected, expected.traced_rays())
+
+    # the demo path was traced with numpy, the same rays are traced again with the fused kernels
+    chunk, = demo_path.trace_stream(demo_source, chunk_size=demo_source.shape[0], history=True)
+    _assert_parity(chunk.rays, chunk.traced_rays, demo_path.rays, demo_path.rays.traced_rays())
+
+
+def test_fused_kernels_fallback(monkeypatch):
+    monkeypatch.setattr(kernels, 'use_numba', True)
+
+    # single precision and dispersive elements are traced with numpy
+    rays = OpticalPath(angle=[-50, 50], n=5, dtype=np.float32).rays
+    assert not kernels.trace(Lens(5, 16., [5., 1.]), rays)
+    rays = OpticalPath(angle=[-50, 50], n=5).rays
+    assert not kernels.trace(DiffractionGrating(1.0, 20.), rays)
+    assert kernels.trace(Lens(5, 16., [5., 1.]), rays) == kernels.available()
+
+
+@pytest.mark.parametrize('build', [
+    lambda v: [Lens(10., 5., [5. + v, 0.]), ParabolicMirror(5., 8., [15., 0.], theta=180.), 0.],
+    lambda v: [Lens(10. + v, 5., [5., 0.]), ParabolicMirror(5. + v, 8., [15., 0.], theta=180.), 0.],
+    lambda v: [Aperture(2. + v, [2., 0.]), Lens(10., 5., [5., 0.]),
+               ParabolicMirror(5., 8. + v, [15., 0.], theta=180.), 0.],
+    lambda v: [Lens(10., 5., [5., 0.]), Mirror(8., [15., 0.], theta=180. + v), 0.],
+], ids=['origin', 'f', 'diameter', 'theta'])
+def test_fused_kernels_sweep(build, monkeypatch):
+    from raypy2d.sweep import Sweep, _element
+    from raypy2d.paths import Object
+
+    pytest.importorskip('numba')
+
+    source = Object(1.0, [-5., 0.], angle=[-10, 10], n=21).rays
+    sweep = Sweep.from_function(build, [0., 1., 2.])
+    expected = sweep.trace(source)
+
+    # the elements with one set of parameters per ray are traced with numpy
+    monkeypatch.setattr(kernels, 'use_numba', True)
+    for cls, constants, stacked in (step for step in sweep.steps if not isinstance(step, np.ndarray)):
+        parameters = kernels.element_parameters(_element(cls, constants, stacked, 0, 3, source.n))
+        assert (parameters is None) == (len(stacked) > 0)
+
+    for rays, expected_rays in zip(sweep.trace(source), expected):
+        assert _canonical(rays.array) == _canonical(expected_rays.array)
+        assert np.array_equal(rays.alive, expected_rays.alive)
+
+
+def test_fused_kernels_tolerance(monkeypatch):
+    from raypy2d.elements import Sensor
+    from raypy2d.rays import point_source_rays
+    from raypy2d.tolerance import Perturbation, ToleranceAnalysis
+
+    pytest.importorskip('numba')
+
+    source = point_source_rays([-10., 0.], angle=[-5, 5], n=51)
+    lens, mirror = Lens(10., 3., [0., 0.]), ParabolicMirror(5., 8., [10., 0.], theta=180.)
+    sensor = Sensor(20., [0., 0.])
+    analysis = ToleranceAnalysis([Aperture(10., [-5., 0.]), lens, mirror, 5., sensor],
+                                 [Perturbation(lens, dy=0.2, f=0.5), Perturbation(mirror, dx=0.5, f=0.2)])
+    expected = analysis.run(source, 20, batch_size=8, seed=3)
+
+    # the perturbed origins and focal lengths are arrays with one entry per ray
+    monkeypatch.setattr(kernels, 'use_numba', True)
+    metrics = analysis.run(source, 20, batch_size=8, seed=3)
+    assert metrics.keys() == expected.keys()
+    for name in metrics:
+        assert np.array_equal(metrics[name], expected[name], equal_nan=True)
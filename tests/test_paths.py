@@ -2,10 +2,11 @@ from matplotlib import pyplot as plt
 import raypy2d
 from raypy2d import plotting
 from raypy2d.elements import Aperture, Lens, ParabolicMirror, Mirror, DiffractionGrating, Sensor
-from raypy2d.rays import propagate, point_source_rays
+from raypy2d.rays import propagate, point_source_rays, Rays
 from raypy2d.paths import OpticalPath, Object
-from raypy2d.analysis import plot_sensor_img
+from raypy2d.analysis import plot_sensor_img, sensor_statistics
 import numpy as np
+import pytest
 
 
 def test_group_elements():
@@ -123,4 +124,738 @@ def test_sensor_image():
 
     #plot_sensor_img(path, axs[0], only_wavelength=True)
 
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+def test_memmap_history(tmp_path, build_demo_path):
+    from raypy2d.history import MemmapHistory
+
+    traced = build_demo_path(compaction=0.9).rays.traced_rays()
+    stored = build_demo_path(history_store=MemmapHistory(str(tmp_path), chunk_size=16),
+                             compaction=0.9).rays.traced_rays()
+
+    assert stored.array.shape == traced.array.shape
+    assert np.array_equal(np.asarray(stored.array), traced.array, equal_nan=True)
+    assert np.array_equal(stored.array[5:9, 1:3, :2], traced.array[5:9, 1:3, :2], equal_nan=True)
+    assert np.array_equal(stored.array[traced.parents >= 0, -1, 0], traced.array[traced.parents >= 0, -1, 0],
+                          equal_nan=True)
+    assert np.array_equal(stored.x, traced.x, equal_nan=True)
+
+    chunks = list(stored.chunks())
+    assert len(chunks) == int(np.ceil(stored.n / 16))
+    assert np.array_equal(np.concatenate([chunk.array for chunk in chunks]), traced.array, equal_nan=True)
+    assert np.array_equal(stored.with_shared_prefix().array, traced.with_shared_prefix().array, equal_nan=True)
+
+    # crossings are read one segment at a time, the group ids of separately built paths differ
+    crossings, *properties = stored.ray_crossings(2)
+    expected, *expected_properties = traced.ray_crossings(2)
+    assert np.array_equal(crossings, expected, equal_nan=True)
+    for stored_properties, traced_properties in zip(properties, expected_properties):
+        assert np.array_equal(stored_properties[:, 1], traced_properties[:, 1], equal_nan=True)
+
+
+def test_sensor_statistics(tmp_path):
+    from raypy2d.history import MemmapHistory
+
+    path = OpticalPath(Object(4., n=11, angle=[-10, 10]), history_store=MemmapHistory(str(tmp_path), chunk_size=8))
+    path.append(Lens(10., 6., [20., 0.]))
+    path.append(Sensor(10., [35., 0.], theta=180.))
+
+    sensor = path.elements[-1].to_element_frame_of_reference(path.rays.copy())
+    hit = ~np.isnan(sensor.array[:, :3]).any(axis=1)
+    assert 0 < np.sum(hit) < path.rays.n
+
+    statistics, efficiency = sensor_statistics(path)
+    assert efficiency == np.sum(hit) / path.rays.n_total
+    assert np.array_equal(statistics['group'], np.unique(sensor.group))
+    assert np.array_equal(statistics['wavelength'], [0.] * 3)
+    for i, group in enumerate(statistics['group']):
+        y = sensor.y[hit & (sensor.group == group)]
+        assert np.allclose([statistics[name][i] for name in ['mean', 'std', 'min', 'max']],
+                           [y.mean(), y.std(ddof=1), y.min(), y.max()])
+
+    # the moments of the chunks are merged per group
+    chunked, _ = sensor_statistics(path, chunk_size=3)
+    for name in statistics:
+        assert np.allclose(chunked[name], statistics[name], rtol=1e-12, atol=1e-12)
+
+    statistics, _ = sensor_statistics(path, only_wavelength=True, chunk_size=5)
+    assert 'group' not in statistics
+    assert np.allclose([statistics['mean'][0], statistics['std'][0]], [sensor.y[hit].mean(), sensor.y[hit].std(ddof=1)])
+
+
+def test_trace_stream():
+    source = point_source_rays([0., 0.], angle=[-20, 20], n=101, group=1)
+
+    path = OpticalPath(angle=[-20, 20], n=101, group=1)
+    path.append(Aperture(0.2, [8.0, 0], blocker_diameter=20))
+    path.append(Lens(10., 12., [20., 0.]))
+    path.propagate(5.)
+    path.append(Sensor(10., [40., 0.], theta=180.))
+
+    chunks = list(path.trace_stream(source, chunk_size=32, history=True))
+    assert [chunk.rays.n for chunk in chunks] == [32, 32, 32, 5]
+    assert np.array_equal(np.concatenate([chunk.rays.array for chunk in chunks]), path.rays.array, equal_nan=True)
+
+    traced = path.rays.traced_rays()
+    assert np.array_equal(np.concatenate([chunk.traced_rays.array for chunk in chunks]), traced.array, equal_nan=True)
+
+    hits = np.concatenate([chunk.sensor_hits[0].array for chunk in chunks])
+    expected = path.sensors[0].to_element_frame_of_reference(path.rays.copy())
+    assert np.array_equal(hits, expected.array, equal_nan=True)
+
+    # the path itself is not traced again
+    assert np.array_equal(path.rays.traced_rays().array, traced.array, equal_nan=True)
+
+    # generators of arrays are traced in chunks as well, dispersed rays are replicated per chunk
+    path.append(DiffractionGrating(1.6, 10., interference=-1, theta=-10), distance=20., theta=170.)
+    chunks = path.trace_stream((source.array[i:i + 50] for i in range(0, 101, 50)), chunk_size=40)
+    assert sum(chunk.rays.n for chunk in chunks) == path.rays.n
+
+
+def test_history_off_with_taps(build_demo_path, demo_elements, demo_source):
+
+    def trace(**kwargs):
+        elements = demo_elements()
+        pupil, sensor = elements[0], elements[-1]
+        return build_demo_path(elements, taps=[pupil, sensor], **kwargs), pupil, sensor
+
+    path, pupil, sensor = trace()
+    path_off, pupil_off, sensor_off = trace(history=False)
+
+    # the group ids of separately built paths differ
+    columns = [0, 1, 2, 3, 5]
+    assert path_off.rays._history is None
+    assert np.array_equal(path_off.rays.array[:, columns], path.rays.array[:, columns], equal_nan=True)
+    assert path_off.rays.traced_rays().array.shape == (path.rays.n, 1, 3)
+
+    traced = path.rays.traced_rays()
+    n = demo_source.shape[0]
+    assert np.array_equal(path_off.taps[pupil_off].array[:, :3], traced.array[:n, 1, :], equal_nan=True)
+    assert np.array_equal(path_off.taps[sensor_off].array[:, columns], path.taps[sensor].array[:, columns],
+                          equal_nan=True)
+
+    chunk, = path_off.trace_stream(demo_source)
+    assert chunk.traced_rays is None
+    assert np.array_equal(chunk.taps[sensor_off].array[:, columns], path.taps[sensor].array[:, columns],
+                          equal_nan=True)
+
+
+def test_trace_parallel(demo_path, demo_source):
+    path, source = demo_path, demo_source
+
+    chunk, = path.trace_stream(source, chunk_size=source.shape[0])
+    rays = path.trace_parallel(source, processes=2, block_size=50)
+
+    # identical bits, except for the sign of NaN which depends on the alignment of the arrays in numpy
+    canonical = np.where(np.isnan(rays.array), np.nan, rays.array)
+    expected = np.where(np.isnan(chunk.rays.array), np.nan, chunk.rays.array)
+    assert canonical.tobytes() == expected.tobytes()
+    assert np.array_equal(rays.alive, chunk.rays.alive)
+    assert np.array_equal(rays.parents, chunk.rays.parents)
+
+    # rows with NaN are blocked rays as in the serial trace, also without an element blocking them
+    path = OpticalPath(angle=[-20, 20], n=11)
+    path.propagate(10.)
+    source[3, 1] = np.nan
+    chunk, = path.trace_stream(source, chunk_size=source.shape[0])
+    rays = path.trace_parallel(source, processes=2, block_size=50)
+    assert not chunk.rays.alive[3]
+    assert np.array_equal(rays.alive, chunk.rays.alive)
+    assert np.array_equal(np.where(np.isnan(rays.array), np.nan, rays.array).tobytes(),
+                          np.where(np.isnan(chunk.rays.array), np.nan, chunk.rays.array).tobytes())
+
+
+def test_trace_parallel_loop():
+    import pickle
+    from raypy2d import parallel
+
+    source = Object(2.0, [-8., 0.], angle=[-20, 20], n=67).rays.array.copy()
+
+    # the grating replicating the rays is only traced within the loop
+    path = OpticalPath(angle=[-20, 20], n=3)
+    path.append(Aperture(0.2, [0.0, 0], blocker_diameter=20))
+    grating = DiffractionGrating(1.0, 20., [20., 0.], interference=1, theta=-10)
+    path.repeat([grating, Lens(28.0, 13.75, [30., 0.])], 2)
+    path.append(Sensor(5.58, [60., 0.], flipped=True))
+
+    k, split = parallel.replication_layout(path, source)
+    assert k == 3 and split[-1] == source.shape[0]
+
+    # the description holds only plain parameters, the elements are created again from them
+    descriptor = parallel.path_descriptor(path)
+    loop, = [step for step in descriptor if step[0] == 'loop']
+    assert loop[1] == 2 and loop[2][0][2] == 'DiffractionGrating'
+    assert loop[2][0][3]['default_wavelengths'] == grating.default_wavelengths
+    assert b'DiffractionGrating' not in pickle.dumps(loop[2][0][3])
+    steps = parallel.build_steps(descriptor)
+    assert [type(step) for step in steps] == [type(step) for step in path.steps]
+
+    chunk, = path.trace_stream(source, chunk_size=source.shape[0])
+    rays = path.trace_parallel(source, processes=2, block_size=50)
+
+    canonical = np.where(np.isnan(rays.array), np.nan, rays.array)
+    expected = np.where(np.isnan(chunk.rays.array), np.nan, chunk.rays.array)
+    assert rays.n == 3 * source.shape[0]
+    assert canonical.tobytes() == expected.tobytes()
+    assert np.array_equal(rays.alive, chunk.rays.alive)
+    assert np.array_equal(rays.parents, chunk.rays.parents)
+
+    with pytest.raises(ValueError):
+        parallel.replication_layout([object()], source)
+
+    # rays blocked in the source stay blocked
+    path = OpticalPath(angle=[-20, 20], n=3)
+    path.append(Lens(20., 40., [10., 0.]))
+    path.propagate(30.)
+    blocked = Rays(source.copy())
+    blocked.alive = np.arange(blocked.n) % 3 != 0
+    rays = path.trace_parallel(blocked, processes=2, block_size=50)
+    expected = Rays(source.copy())
+    expected.alive = blocked.alive
+    for step in path.steps:
+        expected = propagate(expected, step) if np.isscalar(step) else step.trace(expected)
+    assert np.array_equal(rays.alive, blocked.alive) and np.array_equal(expected.alive, blocked.alive)
+    assert np.array_equal(rays.array, expected.array, equal_nan=True)
+
+
+@pytest.mark.parametrize('demo_path', [{'threads': 3, 'block_size': 16}], indirect=True)
+def test_thread_pool(demo_path, demo_source):
+
+    # the threads are stopped when the path is closed
+    with demo_path as path:
+        executor = path._executor
+        assert executor is not None
+
+        # the same rays traced again in the calling thread
+        path.threads = None
+        chunk, = path.trace_stream(demo_source, chunk_size=demo_source.shape[0], history=True)
+    assert path._executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(print)
+
+    threaded, rays = path.rays, chunk.rays
+    columns = [0, 1, 2, 3, 5]
+    assert np.array_equal(threaded.array[:, columns], rays.array[:, columns], equal_nan=True)
+    assert np.array_equal(threaded.alive, rays.alive)
+    assert np.array_equal(threaded.traced_rays().array, chunk.traced_rays.array, equal_nan=True)
+
+
+def test_compile(demo_path, demo_source, monkeypatch):
+    from raypy2d import kernels
+
+    path, source = demo_path, demo_source
+
+    plan = path.compile()
+    assert [(start, stop, element is None) for start, stop, element in plan.segments] == \
+           [(0, 2, True), (2, 3, False), (3, 6, True)]
+    assert not plan.matrix.flags.writeable
+
+    chunk, = path.trace_stream(source, chunk_size=source.shape[0], history=True)
+
+    # changes of the elements after compiling do not change the plan
+    path.elements[0].origin = [1., 1.]
+
+    def disabled(*args):
+        raise AssertionError('the fused kernels are not enabled')
+
+    # without use_numba the steps are traced with numpy, also if numba is installed
+    with monkeypatch.context() as patch:
+        patch.setattr(kernels, 'use_numba', False)
+        patch.setattr(kernels, '_trace_steps', disabled)
+        assert np.array_equal(plan.trace(source).array, chunk.rays.array, equal_nan=True)
+
+    monkeypatch.setattr(kernels, 'use_numba', True)
+    for numba in (kernels.numba, None):
+        monkeypatch.setattr(kernels, 'numba', numba)
+        rays = plan.trace(source)
+        assert np.array_equal(rays.array, chunk.rays.array, equal_nan=True)
+        assert np.array_equal(rays.alive, chunk.rays.alive)
+        assert rays.traced_rays().array.shape[1] == 1
+
+        traced = plan.trace(source, history=True).traced_rays()
+        assert np.array_equal(traced.array, chunk.traced_rays.array, equal_nan=True)
+
+
+
+def test_compile_step_kinds(monkeypatch):
+    from raypy2d import kernels
+    from raypy2d.elements import DiffractionPrism
+    from raypy2d.loop import Loop
+    from raypy2d.sweep import _stack, _element
+
+    path = OpticalPath(origin=[-5., 0.2], angle=[-10, 10], n=20)
+    # one set of lens parameters per 5 rays, as traced by a sweep
+    path.append(_element(Lens, *_stack([Lens(30. + i, 10., [-2., 0.]) for i in range(4)]), 0, 4, 5))
+    path.repeat(_cavity(15.), 5)
+    path.append(Lens(20., 10., [5., 0.]))
+    path.append(DiffractionGrating(1.6, 20., [10., 0.], theta=-10))
+    path.append(DiffractionPrism(25., origin=[15., 0.], theta=-30))
+    path.propagate(60.)
+    assert 0 < path.rays.alive.sum() < path.rays.n
+
+    source = point_source_rays([-5., 0.2], angle=[-10, 10], n=20)
+    traced = path.rays.traced_rays().array
+
+    # the group ids of the source differ from the path
+    columns = [0, 1, 2, 3, 5]
+    for use_numba in (False, True):
+        monkeypatch.setattr(kernels, 'use_numba', use_numba)
+        for paraxial in (False, True):
+            plan = path.compile(paraxial)
+            assert [type(element) for _, _, element in plan.segments] == \
+                   [Lens, Loop, type(None), DiffractionGrating, DiffractionPrism, type(None)]
+
+            rays = plan.trace(source, history=True)
+            assert np.array_equal(rays.array[:, columns], path.rays.array[:, columns], equal_nan=True)
+            assert np.array_equal(rays.alive, path.rays.alive)
+            assert np.array_equal(rays.traced_rays().array, traced, equal_nan=True)
+
+def test_paraxial():
+    source = Object(0.5, [-10., 0.], angle=[-8, 8], n=41).rays.array.copy()
+
+    path = OpticalPath(angle=[-8, 8], n=3)
+    path.append(Aperture(3., [0., 0.]))
+    path.append(Lens(20., 2.), distance=5., theta=0.)
+    path.append(Lens(-30., 2.), distance=8.)
+    path.append(Lens(15., 3., theta=180.), distance=4.)
+    path.propagate(29.)
+    path.append(Lens(25., 20., theta=5.), distance=15.)
+    path.append(Lens(10., 20.), distance=3.)
+
+    system, = path.paraxial_systems()
+    assert np.array_equal(system.planes, [0., 5., 13., 17., 29.])
+
+    # two thin lenses
+    f1, f2, d = 20., -30., 8.
+    two_lenses = OpticalPath(angle=[-8, 8], n=3)
+    two_lenses.append(Lens(f1, 6.), Lens(f2, 8., [d, 0.]))
+    lenses, = two_lenses.paraxial_systems()
+    efl = f1 * f2 / (f1 + f2 - d)
+    assert np.isclose(lenses.effective_focal_length, efl)
+    assert np.isclose(lenses.back_focal_length, efl * (f1 - d) / f1)
+    assert np.isclose(lenses.principal_planes[1], d + efl * (f1 - d) / f1 - efl)
+    assert np.isclose(lenses.image_distance(1e12), lenses.back_focal_length)
+    assert np.isclose(Lens(10., 5.).matrix[1, 0], -0.1)
+
+    plan = path.compile(paraxial=True)
+    assert [(start, stop, type(element).__name__) for start, stop, element in plan.segments] == \
+           [(0, 1, 'NoneType'), (1, 5, 'ParaxialSystem'), (5, 7, 'NoneType')]
+
+    exact = path.compile().trace(source)
+    rays = plan.trace(source)
+    assert np.array_equal(rays.alive, exact.alive)
+    assert 0 < rays.alive.sum() < rays.n
+    assert np.allclose(rays.array[rays.alive], exact.array[exact.alive], rtol=1e-12, atol=1e-12,
+                       equal_nan=True)
+
+    # the history is traced exactly
+    traced = plan.trace(source, history=True)
+    assert np.array_equal(traced.array, path.compile().trace(source, history=True).array, equal_nan=True)
+
+
+def _cavity(f, diameter=4.):
+    # folded cavity between two mirrors, the lens is passed in both directions
+    return [Lens(f, 10., [10., 0.]), Mirror(diameter, [20., 0.]), Lens(f, 10., [10., 0.], theta=180.),
+            Mirror(diameter, [0., 0.])]
+
+
+def test_repeat():
+    from raypy2d.loop import Loop
+
+    source = point_source_rays([-5., 0.2], angle=[-20, 20], n=101)
+
+    loop = Loop(_cavity(15.), 200)
+    assert loop.stable and np.isclose(loop.round_trip_length, 40.)
+    assert np.isclose(np.linalg.det(loop.round_trip_matrix), 1.)
+    assert np.allclose(np.abs(loop.eigenvalues), 1.)
+    assert np.isclose(np.cos(loop.round_trip_phase), loop.stability)
+
+    unstable = Loop(_cavity(4., 40.), 3)
+    assert unstable.round_trip is not None and not unstable.stable and abs(unstable.stability) > 1.
+
+    tilted = Loop([Lens(15., 10., [10., 0.], theta=1.)] + _cavity(15.)[1:], 20)
+    assert tilted.round_trip is None and not tilted.stable
+
+    for loop in (loop, unstable, tilted):
+        exact = Rays(source.array.copy())
+        for _ in range(loop.n):
+            for element in loop.elements:
+                exact = element.trace(exact)
+
+        rays = loop.trace(Rays(source.array.copy()))
+        assert np.array_equal(rays.alive, exact.alive)
+        assert 0 < rays.alive.sum() < rays.n
+        assert np.allclose(rays.array[rays.alive], exact.array[exact.alive], rtol=1e-8, atol=1e-8, equal_nan=True)
+
+    path = OpticalPath(origin=[-5., 0.2], angle=[-20, 20], n=101)
+    path.append(Lens(30., 10., [-2., 0.]))
+    states = path.rays.traced_rays().array.shape[1]
+
+    # only the state after the last pass is stored
+    loop = path.repeat(_cavity(15.), 50)
+    assert path.steps[-1] is loop and len(path.elements) == 5
+    assert path.rays.traced_rays().array.shape[1] == states + 1
+
+    # the loop is a step of its own in compiled plans and bounds the paraxial runs
+    path.append(Lens(20., 10., [5., 0.]), Aperture(6., [8., 0.]))
+    path.propagate(9.)
+    systems = path.paraxial_systems()
+    assert len(systems) == 1 and np.array_equal(systems[0].planes, [5., 8., 9.])
+
+    # the group ids of the source differ from the path
+    columns = [0, 1, 2, 3, 5]
+    for paraxial in (False, True):
+        plan = path.compile(paraxial)
+        assert any(element is not None and type(element).__name__ == 'Loop' for _, _, element in plan.segments)
+
+        rays = plan.trace(source, history=True)
+        assert 0 < rays.alive.sum() < rays.n
+        assert np.array_equal(rays.alive, path.rays.alive)
+        assert np.array_equal(rays.array[:, columns], path.rays.array[:, columns], equal_nan=True)
+        assert np.array_equal(rays.traced_rays().array, path.rays.traced_rays().array, equal_nan=True)
+
+        rays = plan.trace(source)
+        assert np.array_equal(rays.alive, path.rays.alive)
+        assert np.allclose(rays.array[:, columns], path.rays.array[:, columns], rtol=1e-12, atol=1e-12,
+                           equal_nan=True)
+
+
+def test_retrace(build_demo_path, demo_elements):
+
+    for compaction in (None, 0.9):
+        path = build_demo_path(incremental=True, compaction=compaction)
+        assert path.changed() is None and path.retrace() == 0
+
+        lens = path.elements[4]
+        lens.theta += 2.
+        lens.f = 15.
+        assert path.changed() == 4
+        assert path.retrace() == 2
+
+        # the group ids of separately built paths differ
+        elements = demo_elements()
+        elements[4].theta += 2.
+        elements[4].f = 15.
+        expected = build_demo_path(elements, compaction=compaction)
+        columns = [0, 1, 2, 3, 5]
+        assert np.array_equal(path.rays.final_array()[:, columns], expected.rays.final_array()[:, columns],
+                              equal_nan=True)
+        assert np.array_equal(path.rays.traced_rays().array, expected.rays.traced_rays().array, equal_nan=True)
+        assert path.changed() is None
+
+
+def test_retrace_loop():
+
+    def build(f, **kwargs):
+        path = OpticalPath(origin=[-5., 0.2], angle=[-20, 20], n=101, **kwargs)
+        path.append(Lens(30., 10., [-2., 0.]))
+        loop = path.repeat(_cavity(f), 50)
+        path.propagate(-10.)
+        return path, loop
+
+    path, loop = build(15., incremental=True)
+    stability = loop.stability
+
+    # the round trip follows the refocused lenses of the loop
+    for lens in loop.elements[::2]:
+        lens.f = 12.
+    assert path.changed() == 1 and path.retrace() == 2
+    assert loop.stability != stability
+
+    expected, expected_loop = build(12.)
+    assert np.isclose(loop.stability, expected_loop.stability)
+    assert np.allclose(loop.round_trip_matrix, expected_loop.round_trip_matrix)
+    columns = [0, 1, 2, 3, 5]
+    assert np.array_equal(path.rays.final_array()[:, columns], expected.rays.final_array()[:, columns],
+                          equal_nan=True)
+    assert path.changed() is None
+
+
+def test_variants():
+    from raypy2d.variants import VariantTree, trace_variants
+
+    source = Object(2.0, [-8., 0.], angle=[-20, 20], n=11).rays
+
+    prefix = [Aperture(0.2, [0.0, 0], blocker_diameter=20), Lens(28.0, 13.75, [10., 0.])]
+    gratings = [DiffractionGrating(1.0, 20., [30., 0.], interference=1, theta=theta) for theta in (-10., 0., 10.)]
+    sensors = [Sensor(5.58, [x, 0.]) for x in (40., 45.)]
+
+    tree = VariantTree.from_alternatives(prefix + [gratings, sensors])
+    assert tree.n_variants == 6 and tree.n_steps == 2 + 3 + 6
+
+    # a variant ending inside another variant
+    assert tree.add(prefix) == 6
+
+    results = tree.trace(source)
+    assert np.array_equal(trace_variants(source, [prefix])[0].array, results[6].array, equal_nan=True)
+
+    for i, (grating, sensor) in enumerate([(g, s) for g in gratings for s in sensors] + [(None, None)]):
+        expected = Rays(source.array.copy())
+        for element in prefix + [e for e in (grating, sensor) if e is not None]:
+            expected = element.trace(expected)
+        assert np.array_equal(results[i].array, expected.array, equal_nan=True)
+        assert np.array_equal(results[i].alive, expected.alive)
+
+
+def test_sweep(build_demo_path, demo_elements, demo_source):
+    from raypy2d.sweep import Sweep, UnsupportedStepError
+
+    def build(v):
+        aperture, mirror, grating, stop, lens, sensor = elements = demo_elements()
+        aperture.theta = 2. * (v > 0)
+        mirror.f += v
+        grating.theta -= 3 * v
+        lens.f += v
+        steps = build_demo_path(elements, history=False).steps
+
+        # a propagation in front of the sensor
+        return steps[:-1] + [21. + v / 10.] + steps[-1:]
+
+    values = np.linspace(-3., 3., 7)
+
+    results = Sweep.from_function(build, values).trace(demo_source, chunk_size=500)
+    assert len(results) == len(values)
+    for value, rays in zip(values, results):
+        expected = Rays(demo_source.copy())
+        for step in build(value):
+            expected = propagate(expected, step) if np.isscalar(step) else step.trace(expected)
+
+        assert np.array_equal(rays.alive, expected.alive)
+        assert np.array_equal(rays.parents, expected.parents)
+        assert np.array_equal(np.where(np.isnan(rays.array), np.nan, rays.array).tobytes(),
+                              np.where(np.isnan(expected.array), np.nan, expected.array).tobytes())
+
+    # the sensor absorbs the rays, some of them hit it
+    assert 0 < sum(np.isfinite(rays.y).sum() for rays in results) < sum(rays.n for rays in results)
+
+    with pytest.raises(UnsupportedStepError):
+        Sweep([[Lens(10., 5.)], [Mirror(5.)], [DiffractionGrating(1., 5.)]])
+    with pytest.raises(UnsupportedStepError):
+        Sweep([[Lens(10., 5.), 3.], [2., 3.]])
+    with pytest.raises(UnsupportedStepError):
+        Sweep([[DiffractionGrating(1., 5.)], [DiffractionGrating(1., 5., default_wavelengths=[532.])]])
+    with pytest.raises(UnsupportedStepError):
+        Sweep([[Lens(10., 5.)], [Lens(10., 5.), 3.]])
+
+
+def test_tolerance():
+    from raypy2d.tolerance import Perturbation, ToleranceAnalysis, yield_fraction
+
+    source = point_source_rays([-10., 0.], angle=[-5, 5], n=51)
+    lens, sensor = Lens(10., 3., [0., 0.]), Sensor(20., [10., 0.])
+    steps = [Aperture(10., [-5., 0.]), lens, sensor]
+
+    uniform = Perturbation(lens, f=lambda rng, size: rng.uniform(-1., 1., size)).sample(np.random.default_rng(0), 20)
+    assert list(uniform) == ['f'] and np.all(np.abs(uniform['f']) <= 1.)
+
+    analysis = ToleranceAnalysis(steps, [Perturbation(lens, dy=0.2, f=0.5), Perturbation(sensor, dx=0.5, theta=2.)])
+    assert analysis.start == 1
+    with pytest.raises(ValueError):
+        ToleranceAnalysis(steps, [Perturbation(lens, dy=0.2), Perturbation(lens, f=0.5)])
+    with pytest.raises(ValueError, match='not part of the path'):
+        ToleranceAnalysis(steps, [Perturbation(Lens(10., 3.), f=0.5)])
+
+    # both interfaces of a prism are moved and rotated as one body
+    from raypy2d.elements import DiffractionPrism
+    prism = DiffractionPrism(15., origin=[20., 0.])
+    moved = Perturbation(prism, dx=1., theta=1.).apply({'dx': np.array([5.]), 'theta': np.array([90.])}, 0)
+    assert moved.second_interface is not prism.second_interface
+    assert np.allclose(prism.second_interface.origin, [20. + 15. * np.sqrt(3.) / 4., 15. / 4.])
+    assert np.allclose(moved.origin, [25., 0.]) and np.isclose(moved.theta, 90.)
+    assert np.allclose(moved.second_interface.origin, [25. - 15. / 4., 15. * np.sqrt(3.) / 4.])
+    assert np.isclose(moved.second_interface.theta, 150.)
+
+    metrics = analysis.run(source, 50, batch_size=16, seed=3)
+    assert all(values.shape == (50,) for values in metrics.values())
+    assert np.isclose(analysis.nominal['centroid'][0], 0.) and analysis.nominal['throughput'][0] == 1.
+
+    # reproducible and independent of the processes
+    assert np.array_equal(metrics['spot_size'], analysis.run(source, 50, batch_size=16, seed=3)['spot_size'])
+    parallel = analysis.run(source, 50, batch_size=16, seed=3, processes=2)
+    assert np.allclose(metrics['centroid_shift'], parallel['centroid_shift'], equal_nan=True)
+
+    # one trial traced on its own
+    i = 7
+    perturbed_lens = Lens(10. + metrics['1_f'][i], 3., [0., metrics['1_dy'][i]])
+    perturbed_sensor = Sensor(20., [10. + metrics['2_dx'][i], 0.], theta=metrics['2_theta'][i])
+    rays = Rays(source.array.copy())
+    for element in [steps[0], perturbed_lens, perturbed_sensor]:
+        rays = element.trace(rays)
+    y = sensor.points_to_object_frame_of_reference(rays.points[rays.alive])[:, 1]
+    assert np.isclose(metrics['throughput'][i], rays.alive.mean())
+    assert np.isclose(metrics['centroid'][i], y.mean()) and np.isclose(metrics['spot_size'][i], y.std())
+
+    assert 0. <= yield_fraction(metrics, max_spot_size=0.1, min_throughput=0.9) <= 1.
+    assert yield_fraction(metrics) == 1.
+
+    # the nominal path is traced again for another source
+    shifted = point_source_rays([-10., 1.], angle=[-5, 5], n=51)
+    metrics = analysis.run(shifted, 50, batch_size=16, seed=3)
+    expected = ToleranceAnalysis(steps, analysis.perturbations).run(shifted, 50, batch_size=16, seed=3)
+    assert not np.isclose(analysis.nominal['centroid'][0], 0.)
+    assert np.array_equal(metrics['centroid_shift'], expected['centroid_shift'], equal_nan=True)
+    assert np.allclose(metrics['centroid_shift'], metrics['centroid'] - analysis.nominal['centroid'][0])
+
+
+def test_optimizer():
+    from raypy2d.optimize import Variable, Optimizer, rms_spot_size, throughput, dispersion_length
+
+    path = OpticalPath(origin=[-100., 0.], angle=[-5., 5.], n=11, incremental=True)
+    path.append(Aperture(30., [-50., 0.]))
+    path.append(Lens(50., 40., [0., 0.]))
+    sensor = Sensor(20., [80., 0.])
+    path.append(sensor)
+
+    optimizer = Optimizer(path, [Variable(sensor, 'x', bounds=(60., 150.), step=5.)],
+                          [(rms_spot_size(), 1.), (throughput(), -0.1)])
+    result = optimizer.minimize(xtol=1e-6)
+
+    assert result.converged
+    assert np.isclose(result.values[0], 100., atol=1e-4) and np.isclose(sensor.origin[0], 100., atol=1e-4)
+    assert np.isclose(result.merit, -0.1, atol=1e-5)
+    assert result.evaluations == optimizer.evaluations and len(result.iterations) > 0
+    assert all(it['time'] >= 0. and it['evaluations'] >= 1 for it in result.iterations)
+
+    # only the sensor is traced again, the path ends at the best values
+    assert result.traced_steps <= result.evaluations + 1
+    assert np.isclose(rms_spot_size()(path), 0., atol=1e-4)
+    assert dispersion_length()(path) == 0.
+
+    # merits cached before a change of the path are not reused, the image of the moved lens is at 101.67
+    path.elements[1].origin = [10., 0.]
+    result = optimizer.minimize(xtol=1e-6)
+    assert np.isclose(result.values[0], 10. + 1. / (1. / 50. - 1. / 110.), atol=1e-3)
+    assert np.isclose(result.merit, optimizer.merit(path))
+
+    # the maximal number of evaluations includes the shrinks of the simplex
+    optimizer = Optimizer(path, [Variable(sensor, 'x', bounds=(60., 150.), step=5.), Variable(sensor, 'theta')],
+                          rms_spot_size())
+    for max_evaluations in range(3, 12):
+        result = optimizer.minimize(max_evaluations=max_evaluations)
+        assert not result.converged and result.evaluations <= max_evaluations
+
+
+def _jacobian_layouts():
+    from raypy2d.elements import DiffractionPrism
+    from raypy2d.loop import Loop
+
+    # steps of each kind the dual trace supports and the differentiated parameters (element, name), the elements of
+    # loops are counted once in the order of the steps
+    return {
+        'generic': (lambda: [Aperture(30., [-20., 0.]), Lens(50., 40., [0., 0.5]), 40.,
+                             Mirror(40., [60., 0.], theta=10.), Sensor(80., [10., 20.], theta=175.)],
+                    [(1, 'f'), (1, 'y'), (2, 'theta'), (2, 'x'), (3, 'theta')]),
+        'parabolic': (lambda: [ParabolicMirror(50., 60., [10., 0.], theta=175.), Sensor(80., [-30., 5.], theta=5.)],
+                      [(0, 'f'), (0, 'x'), (0, 'theta'), (1, 'y')]),
+        'grating': (lambda: [DiffractionGrating(1.6, 40., [30., 0.], theta=170.), Sensor(80., [60., -10.], theta=5.)],
+                    [(0, 'grating'), (0, 'theta'), (1, 'x')]),
+        'prism': (lambda: [DiffractionPrism(15., origin=[10., 0.], theta=-10.), Sensor(80., [40., -5.], theta=5.)],
+                  [(0, 'y'), (1, 'x'), (1, 'theta')]),
+        'loop': (lambda: [Loop([Lens(15., 10., [10., 0.], theta=1.), Mirror(20., [20., 0.]),
+                                Lens(15., 10., [10., 0.], theta=180.), Mirror(20., [0., 0.])], 3), 30.],
+                 [(0, 'f'), (0, 'theta'), (1, 'x'), (3, 'theta')]),
+        'blocked': (lambda: [Lens(20., 40., [0., 0.]), Aperture(2., [10., 0.]), Sensor(80., [40., 0.], theta=2.)],
+                    [(0, 'f'), (1, 'y'), (2, 'theta')]),
+    }
+
+
+def _jacobian_elements(steps):
+    from raypy2d.loop import Loop
+
+    elements = []
+    for step in steps:
+        if isinstance(step, Loop):
+            elements.extend(step.elements)
+        elif not np.isscalar(step):
+            elements.append(step)
+    return elements
+
+
+def _traced_path(steps):
+    # the steps traced one by one by an optical path, with the rays after each step
+    from raypy2d.loop import Loop
+
+    path = OpticalPath(origin=[-50., 0.], angle=[-3., 3.], n=7)
+    traced = [path.rays.copy()]
+    for step in steps:
+        if isinstance(step, Loop):
+            path.repeat(step.elements, step.n)
+        elif np.isscalar(step):
+            path.propagate(step)
+        else:
+            path.append(step)
+        traced.append(path.rays.copy())
+    return traced
+
+
+@pytest.mark.parametrize('layout', ['generic', 'parabolic', 'grating', 'prism', 'loop', 'blocked'])
+def test_jacobian(layout):
+    from raypy2d.optimize import Variable
+    from raypy2d.derivatives import trace_with_jacobian
+
+    build, parameters = _jacobian_layouts()[layout]
+    steps = build()
+    elements = _jacobian_elements(steps)
+    traced = _traced_path(steps)
+    source = traced[0]
+
+    # the values of the dual trace are the rays traced by the path after each step
+    for k in range(1, len(steps) + 1):
+        rays, jacobian = trace_with_jacobian(source, steps[:k], [Variable(elements[i], name)
+                                                                 for i, name in parameters])
+        assert jacobian.shape == (rays.n, 3, len(parameters))
+        assert np.all(np.isnan(jacobian[~rays.alive]))
+        assert np.array_equal(rays.alive, traced[k].alive)
+        assert np.allclose(rays.array[rays.alive, :4], traced[k].array[traced[k].alive, :4], rtol=1e-8, atol=1e-8)
+        assert np.array_equal(rays.wavelength, traced[k].wavelength, equal_nan=True)
+    assert 0 < rays.alive.sum() and (layout != 'blocked' or not rays.alive.all())
+
+    # the derivatives are the central finite differences of the rays traced by the path
+    h = 1e-6
+    for j, (i, name) in enumerate(parameters):
+        differences = []
+        for sign in (1., -1.):
+            steps = build()
+            variable = Variable(_jacobian_elements(steps)[i], name)
+            variable.value = variable.value + sign * h
+            differences.append(_traced_path(steps)[-1])
+        assert all(np.array_equal(d.alive, rays.alive) for d in differences)
+        alive = rays.alive
+        finite = (differences[0].array[alive, :3] - differences[1].array[alive, :3]) / (2. * h)
+        assert np.allclose(finite, jacobian[alive, :, j], atol=1e-5), (layout, name)
+
+
+def test_jacobian_perpendicular():
+    from raypy2d.optimize import Variable
+    from raypy2d.derivatives import trace_with_jacobian
+
+    def build():
+        return [Lens(20., 40., [0., 0.], theta=90.), Sensor(80., [0., 30.], theta=90.)]
+
+    def trace(steps):
+        rays = Rays(source.copy())
+        for step in steps:
+            rays = step.trace(rays)
+        return rays
+
+    # rays travelling upwards perpendicular to the abscissa, tan_theta=inf
+    source = np.array([[x, -20., np.inf, 1.] for x in (-5., -2.5, 2.5, 5.)])
+    parameters = [(0, 'f'), (0, 'x'), (1, 'y')]
+
+    steps = build()
+    rays, jacobian = trace_with_jacobian(source, steps, [Variable(steps[i], name) for i, name in parameters])
+    expected = trace(steps)
+    assert rays.alive.all() and np.array_equal(rays.alive, expected.alive)
+    assert np.allclose(rays.array[:, :4], expected.array[:, :4], rtol=1e-8, atol=1e-8)
+    assert np.all(np.isfinite(jacobian))
+
+    h = 1e-6
+    for j, (i, name) in enumerate(parameters):
+        differences = []
+        for sign in (1., -1.):
+            steps = build()
+            variable = Variable(steps[i], name)
+            variable.value = variable.value + sign * h
+            differences.append(trace(steps).array[:, :3])
+        assert np.allclose((differences[0] - differences[1]) / (2. * h), jacobian[:, :, j], rtol=1e-5, atol=1e-5)
@@ -4,32 +4,6 @@ from raypy2d.paths import OpticalPath
 import pytest
 
 
-@pytest.fixture
-def demo_path():
-    from raypy2d.elements import Aperture, ParabolicMirror, DiffractionGrating, Lens, Sensor
-    from raypy2d.paths import Object, OpticalPath
-
-    path = OpticalPath(Object(2.0, [-8., 0.], angle=[-20, 20], n=181))
-
-    # path.append(Aperture(1, [6.0, 0], blocker_diameter=20))
-    path.append(Aperture(0.2, [0.0, 0], blocker_diameter=20))
-
-    path.append(ParabolicMirror(40, 20., [32., 0], theta=155, flipped=True))
-    # path.append(Mirror(20., [50., 0], theta=165, flipped=True))
-    # path.append(DiffractionGrating(1.6, 20., interference=-1, theta=-10), distance=15., theta=130.)
-    path.append(DiffractionGrating(1.0, 20., interference=1, theta=-10), distance=20., theta=133)
-    # path.append(Mirror(20., flipped=True, theta=30), distance=20., theta=105)
-    alpha = -5
-    vec = np.array([np.cos(alpha / 180. * np.pi), np.sin(alpha / 180. * np.pi)])
-    sin_alpha = np.cos(alpha / 180. * np.pi)
-    path.append(Aperture(13.75, theta=alpha, blocker_diameter=28),
-                Lens(28.0, 13.75, vec * 4, theta=alpha, flipped=False),
-                # Lens(12.0, 11, vec*20, theta=alpha, flipped=False),
-                Sensor(5.58, 30 * vec, theta=alpha, flipped=True), distance=13., theta=85)
-
-    return path
-
-
 def test_rays_object():
     """
     test the ray interpretation of a numpy array
@@ -78,6 +52,84 @@ def test_traced_rays_object():
     assert tr.x.shape == (10, 2)
 
 
+def test_rays_history_growth():
+    rays = Rays(np.random.rand(4, 3), history_capacity=2)
+
+    for i in range(5):
+        rays.x = i
+        rays.store()
+
+    rays.append(Rays(np.random.rand(2, 3)))
+    rays.x = 10.
+
+    tr = rays.traced_rays()
+    assert np.shares_memory(tr.array, rays._history)
+
+    assert tr.array.shape == (6, 6, 3)
+    assert (tr.x[:4, :5] == np.arange(5)[None, :]).all()
+    assert np.isnan(tr.x[4:, :5]).all()
+    assert (tr.x[:, 5] == 10.).all()
+
+    # the traced rays keep their states when the rays are traced on, the history itself is read-only
+    x = tr.x
+    del tr
+    rays.x = 11.
+    rays.store()
+    assert (x[:, 5] == 10.).all() and not np.shares_memory(x, rays._history)
+
+    # without views the history is written in place
+    history = rays._history
+    del x
+    rays.store()
+    assert rays._history is history
+    with pytest.raises(ValueError):
+        rays.complete_array()[0, 0, 0] = 1.
+    assert len(rays.arrays) == 8
+
+
+
+def test_rays_history_views():
+    rays = Rays(np.random.rand(4, 3), history_capacity=8)
+    rays.store()
+    history = rays._history
+
+    # views of rays that were not traced on since share the buffer
+    tr = rays.traced_rays()
+    again = rays.traced_rays()
+    assert np.shares_memory(again.array, tr.array) and rays._history is history
+
+    # states the views hold already and states after them are written in place
+    rays.store()
+    rays.x = 2.
+    rays.store()
+    x = rays.traced_rays().x
+    assert rays._history is history and tr.array.shape[1] == 2 and (x[:, -1] == 2.).all()
+
+    # the history is copied before a state of a view changes
+    rays.x = 3.
+    assert (rays.traced_rays().x[:, -1] == 3.).all()
+    assert rays._history is not history and (x[:, -1] == 2.).all()
+
+def test_rays_replicate_wavelengths():
+    arr = np.random.rand(5, 3)
+    rays = Rays(arr)
+
+    rays.replicate_wavelengths(np.array([True, False, True, False, True]), [532., 430., 650.])
+
+    assert rays.n == 11
+    assert (rays.wavelength[[0, 2, 4]] == 532.).all()
+    assert np.isnan(rays.wavelength[[1, 3]]).all()
+    assert (rays.wavelength[5:8] == 430.).all()
+    assert (rays.wavelength[8:] == 650.).all()
+    assert (rays.points[5:8] == arr[[0, 2, 4], :2]).all()
+    assert (rays.points[8:] == arr[[0, 2, 4], :2]).all()
+
+    # appending grows the backing buffer by doubling
+    rays.append(Rays(np.random.rand(2, 3)))
+    assert rays.n == 13
+    assert rays._buffer.shape[0] >= 13
+
+
 def test_traced_rays_index(demo_path: OpticalPath):
     tr = demo_path.rays.traced_rays()
     assert tr.n == 1629
@@ -106,3 +158,215 @@ def test_ray_crossings(demo_path):
     im = r.image_crossings().before(5)
 
     assert im.n == 147
+
+
+def _all_pairs_crossings(tr: TracedRays):
+    # previous implementation of TracedRays.ray_crossings intersecting all pairs of rays in every segment
+    from raypy2d.utils import rolling_window
+
+    d = np.transpose(rolling_window(np.transpose(tr.array[:, :, :2], axes=(1, 0, 2)), 2), axes=(0, 1, 3, 2))
+    i_triu = np.transpose(np.triu_indices(d.shape[1], 1))
+
+    r = d[:, i_triu, :]
+    v = r[:, :, :, 1] - r[:, :, :, 0]
+    p = r[:, :, 1, 0] - r[:, :, 0, 0]
+    l = (v[:, :, 1, 0] * p[:, :, 1] - v[:, :, 1, 1] * p[:, :, 0]) / (
+            v[:, :, 0, 1] * v[:, :, 1, 0] - v[:, :, 0, 0] * v[:, :, 1, 1])
+
+    I = (l < 1) & (l > 0)
+    l[~I] = np.nan
+    k = np.ones_like(l)
+    k[~I] = np.nan
+
+    crossings = l[:, :, None] * v[:, :, 0, :] + r[:, :, 0, 0] * k[:, :, None]
+    return np.transpose(crossings, (1, 0, 2)), tr.properties_array[i_triu[:, 0]], tr.properties_array[i_triu[:, 1]]
+
+
+def test_ray_crossings_candidates(demo_path):
+    from raypy2d.rays import _crossing_points
+
+    rng = np.random.default_rng(3)
+    array = rng.normal(size=(40, 4, 3)) * 10.
+    array[:, :, 0] += np.arange(4) * 5.
+    array[rng.random((40, 4)) < 0.1, :] = np.nan
+    array[:3, 1, 0] = array[:3, 0, 0]
+    traced = [TracedRays(array, rng.integers(0, 3, (40, 2)).astype(float)), demo_path.rays.traced_rays()]
+
+    for tr in traced:
+        crossings, properties_from, properties_to = tr.ray_crossings()
+
+        # all pairs tested
+        first, second = np.triu_indices(tr.n, 1)
+        assert np.array_equal(properties_from, tr.properties_array[first])
+        assert np.array_equal(properties_to, tr.properties_array[second])
+        for s in range(tr.array.shape[1] - 1):
+            points, crossing = _crossing_points(tr.points[:, s:s + 2, :], first, second)
+            points[~crossing] = np.nan
+            assert np.array_equal(crossings[:, s, :], points, equal_nan=True)
+
+        # same result as intersecting all pairs
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expected = _all_pairs_crossings(tr)
+        assert np.array_equal(crossings, expected[0], equal_nan=True)
+        assert np.array_equal(properties_from, expected[1]) and np.array_equal(properties_to, expected[2])
+
+        crossing = ~np.isnan(crossings).all(axis=(1, 2))
+        assert crossing.any()
+        only = tr.ray_crossings(only_crossing=True)
+        assert np.array_equal(only[0], crossings[crossing], equal_nan=True)
+        assert np.array_equal(only[1], properties_from[crossing])
+        assert np.array_equal(only[2], properties_to[crossing])
+
+
+def test_traced_rays_shared_prefix(demo_path: OpticalPath):
+    rays = demo_path.rays
+    tr = rays.traced_rays()
+
+    replicated = np.flatnonzero(tr.parents >= 0)
+    assert replicated.size == 2 * 543
+
+    # the history before the grating is only stored for the parent ray
+    assert np.isnan(tr.x[replicated, :3]).all()
+
+    expanded = tr.with_shared_prefix()
+    assert np.array_equal(expanded.array[replicated, :3], tr.array[tr.parents[replicated], :3], equal_nan=True)
+    assert np.array_equal(expanded.array[:, 3:], tr.array[:, 3:], equal_nan=True)
+
+    sub = tr[replicated[:10], :]
+    assert (sub.parents == -1).all()
+    sub = tr[::2, :]
+    assert (sub.parents[sub.parents >= 0] < sub.n).all()
+
+    r = rays.ray_crossings(2, shared_prefix=True)
+    assert r.n > demo_path.rays.ray_crossings(2).n
+
+
+def test_rays_compaction(build_demo_path):
+
+    def trace(compaction):
+        return build_demo_path(compaction=compaction).rays
+
+    rays = trace(None)
+    compacted = trace(0.5)
+
+    assert rays.n == rays.n_total
+    assert compacted.n < compacted.n_total
+    assert compacted.alive.all()
+
+    # the blocked rays are not replicated on the grating
+    assert compacted.n_total < rays.n_total
+
+    final = compacted.final_array()
+    assert final.shape[0] == compacted.n_total
+    assert (final[compacted.ids] == compacted.array).all()
+
+    # the rays passing the aperture are traced identically
+    columns = [0, 1, 2, 3, 5]
+    passed = rays.alive & (rays.parents < 0)
+    compacted_passed = compacted.alive & (compacted.parents < 0)
+    assert np.array_equal(rays.array[passed][:, columns], compacted.array[compacted_passed][:, columns])
+
+    tr = compacted.traced_rays()
+    assert tr.n == compacted.n_total
+
+    # the removed rays are not traced on after they were blocked
+    removed = ~np.isin(np.arange(tr.n), compacted.ids)
+    assert removed.any() and np.isnan(tr.x[removed, -1]).all()
+
+
+def test_rays_direction():
+    angles = np.array([0., 30., 90., 135., 180., -90., -60.])
+    rays = Rays(np.zeros((len(angles), 3)))
+    rays.direction = np.stack((np.cos(angles * np.pi / 180.), np.sin(angles * np.pi / 180.)), axis=1)
+
+    assert (rays.forward[[0, 1, 6]] > 0.).all()
+    assert (rays.forward[[3, 4]] < 0.).all()
+
+    direction = rays.direction
+    assert np.allclose(np.arctan2(direction[:, 1], direction[:, 0]) * 180. / np.pi, angles)
+    assert np.allclose(np.hypot(direction[:, 0], direction[:, 1]), 1.)
+
+
+@pytest.mark.parametrize('demo_path', [{'dtype': np.float32}], indirect=True)
+def test_rays_single_precision(demo_path, demo_source):
+    # the same rays traced again in double precision
+    chunk, = demo_path.trace_stream(demo_source, chunk_size=demo_source.shape[0], history=True)
+    rays, rays32 = chunk.rays, demo_path.rays
+
+    assert rays.dtype == np.float64
+    assert rays32.dtype == np.float32
+    assert rays32.array.dtype == np.float32
+
+    tr, tr32 = chunk.traced_rays, rays32.traced_rays()
+    assert tr32.array.dtype == np.float32
+    assert (np.isnan(tr.points) == np.isnan(tr32.points)).all()
+    assert np.nanmax(np.abs(tr.points - tr32.points)) < 1e-5
+    assert np.unique(rays32.group).shape[0] == 3
+
+    # groups beyond the mantissa are not folded into other groups
+    from raypy2d.rays import point_source_rays
+    assert point_source_rays(n=3, group=2 ** 24 - 1, dtype=np.float32).group[0] == 2 ** 24 - 1
+    with pytest.raises(ValueError):
+        point_source_rays(n=3, group=2 ** 24, dtype=np.float32)
+
+    # the history capacity is still the second positional argument
+    assert Rays(np.random.rand(3, 3), 8)._history_capacity == 8
+    assert Rays(np.random.rand(3, 3), dtype=np.float32).dtype == np.float32
+
+
+def test_new_group(monkeypatch):
+    import multiprocessing
+    from raypy2d import rays
+    from raypy2d.rays import new_group, point_source_rays
+
+    assert new_group() != new_group()
+    assert point_source_rays(n=3).group[0] != point_source_rays(n=3).group[0]
+    assert (point_source_rays(n=3, group=5).group == 5).all()
+
+    # exact in the floating point type
+    assert 0 < new_group() < 2 ** 53 and 0 < new_group(np.float32) < 2 ** 24
+    assert point_source_rays(n=3, dtype=np.float32).group[0] < 2 ** 24
+    with pytest.raises(ValueError):
+        new_group(np.float16)
+
+    # a forked process draws its own prefix
+    if 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(1) as pool:
+            child = pool.apply(new_group)
+        assert child >> 20 != new_group() >> 20
+
+    # an exhausted counter continues with a new prefix
+    monkeypatch.setattr(rays, '_GROUP_COUNTER_BITS', 2)
+    monkeypatch.setattr(rays, '_group_registries', {})
+    groups = [new_group(np.float32) for _ in range(30)]
+    assert len(set(groups)) == 30 and all(g % 4 != 0 for g in groups)
+    assert len(set(g >> 2 for g in groups)) == 10
+
+
+def test_property_table():
+    from raypy2d.rays import PropertyTable, RayCrossings1D
+
+    properties = np.array([[2., 430.], [1., 532.], [2., 430.], [1., np.nan], [2., 650.], [1., 532.]])
+    table = PropertyTable(properties)
+    assert table.group_ids.dtype == np.int32 and table.wavelength_ids.dtype == np.uint16
+    assert np.array_equal(table.groups, [1., 2.])
+    assert np.array_equal(table.valid, [True, True, True, False, True, True])
+    keys, members = table.members()
+    assert [list(m) for m in members] == [[1, 5], [3], [0, 2], [4]]
+
+    # same selection as comparing the rows of floats
+    rng = np.random.default_rng(0)
+    properties_from = rng.choice([1., 2., np.nan], (200, 1))
+    properties_to = rng.choice([1., 2., np.nan], (200, 1))
+    wavelengths_from = rng.choice([430., 532., np.nan], (200, 1))
+    wavelengths_to = rng.choice([430., 532., np.nan], (200, 1))
+    crossings = RayCrossings1D(rng.random((200, 2)),
+                               np.hstack([properties_from, wavelengths_from]),
+                               np.hstack([properties_to, wavelengths_to]))
+
+    same_wavelength = crossings.wavelength_from == crossings.wavelength_to
+    valid = ~np.isnan(crossings.group_from)
+    expected_image = same_wavelength & valid & (crossings.group_from == crossings.group_to)
+    expected_color = same_wavelength & valid & (crossings.group_from != crossings.group_to)
+    assert np.array_equal(crossings.image_crossings().array, crossings.array[expected_image])
+    assert np.array_equal(crossings.color_crossings().array, crossings.array[expected_color])